@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
-import subprocess
 import json
 import os
-from paramiko import RSAKey, SSHClient, AutoAddPolicy
+import threading
 from pathlib import Path
-from time import sleep
+from time import sleep, perf_counter
+from concurrent.futures import ThreadPoolExecutor
 import glob
 
+import backend
+import fleethistory
+import launcher
+from sshpool import SSHPool, emit
+import tracing
+import spotprices
+import transfer
+
 IMAGE_ID = "ami-5d2dcf3e" # scheduler image
 SECURITY_GROUP = "sg-8f621df7"
 INSTANCE_TYPE = 'c4.4xlarge'
@@ -21,111 +29,399 @@ PORT = 3000
 NUMCLIENTS = 100
 OUTPUTDIR = "~/output"
 
-def get_instances(region):
-    proc = subprocess.run(['aws', 'ec2', 'describe-instances',
-                           '--region', region], stdout=subprocess.PIPE)
-    instances_data = json.loads(proc.stdout)
-    reservations = instances_data['Reservations']
-    return {instance['InstanceId']: instance
-            for instance in list(map(lambda r: r['Instances'][0], reservations))
-            if instance['State']['Name'] != 'terminated'}
-
-def start_scheduler():
-    cmd = ['aws', 'ec2', 'run-instances',
-           '--image-id', IMAGE_ID,
-           '--instance-type', INSTANCE_TYPE,
-           '--key-name', KEY,
-           '--security-group-ids', SECURITY_GROUP,
-           '--region', REGION,
-           '--tag-specifications',
-           'ResourceType=instance,Tags=[{}Key=Name,Value=scheduler{}]'.format('{','}')]
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE)
-    iid = json.loads(proc.stdout)['Instances'][0]['InstanceId']
-    print("Starting {}...".format(iid), end="", flush=True)
-
-    instance = get_instances(REGION)[iid]
-    while instance['State']['Name'] != 'running':
-        sleep(3)
-        instance = get_instances(REGION)[iid]
+def single_region(options):
+    if len(options.region) != 1:
+        print("{} needs exactly one region!".format(options.command))
+        exit(-1)
+    return options.region[0]
 
-    print("Started!")
-
-    k = RSAKey.from_private_key_file(Path(KEYFILE).expanduser())
-    c = SSHClient()
-    c.set_missing_host_key_policy(AutoAddPolicy())
-
-    ip = instance['PublicIpAddress']
-    print("Connecting to {}".format(ip))
-    c.connect(hostname=ip, username="ubuntu", pkey=k)
+def launch_scheduler(region):
+    output = backend.call('ec2', 'run_instances', region,
+                          ImageId=IMAGE_ID,
+                          InstanceType=INSTANCE_TYPE,
+                          KeyName=KEY,
+                          SecurityGroupIds=[SECURITY_GROUP],
+                          MinCount=1, MaxCount=1,
+                          TagSpecifications=[{
+                              'ResourceType': 'instance',
+                              'Tags': [{'Key': 'Name', 'Value': 'scheduler'}]
+                          }])
+    return output['Instances'][0]
 
+# sends the work over and starts the scheduler in tmux, `say` prints progress
+# (`end` and `flush` like print)
+def setup_scheduler(options, pool, ip, say=print):
     # send progress if there is any
     archives = glob.glob('archive/*.tar')
-    if len(archives) > 0:
+    if options.stream != None:
+        sent = [0]
+        def stream_progress(n):
+            sent[0] += n
+            say("\rStreaming {}...{:.1f} MB".format(options.stream, sent[0] / 2**20),
+                end="", flush=True)
+        status, raw, nbytes, secs = transfer.stream_dir(pool.transport(ip), options.stream,
+                                                        compression=options.compression,
+                                                        on_progress=stream_progress)
+        if status != 0:
+            say("\rStreaming {}...Failed (exit {})!".format(options.stream, status))
+            return False
+        say("\rStreaming {}...Done! {:.1f} MB unpacked, sent {}".format(
+            options.stream, raw / 2**20, transfer.format_rate(nbytes, secs)))
+    elif len(archives) > 0:
         tar = archives[0]
-        print("Sending {}...".format(tar), end="", flush=True)
-        sftp = c.open_sftp()
+        say("Sending {}...".format(tar), end="", flush=True)
+        sftp = pool.sftp(ip)
         def transfer_progress(completed, todo):
-            print("\rSending {}...{:.2%}".format(tar, completed/todo), end="", flush=True)
-        sftp.put(tar, "{}".format(Path(tar).name), callback=transfer_progress)
-        print("\rSending {}...Done!  ".format(tar))
+            say("\rSending {}...{:.2%}".format(tar, completed/todo), end="", flush=True)
+        with tracing.span('put', 'sftp', host=ip, path=tar) as stats:
+            stats['bytes'] = sftp.put(tar, "{}".format(Path(tar).name),
+                                      callback=transfer_progress).st_size
+        sftp.close()
+        say("\rSending {}...Done!  ".format(tar))
 
-        print("Unpacking archives...", end="", flush=True)
+        say("Unpacking archives...", end="", flush=True)
         cmd = 'tar -xf {}'.format(Path(tar).name)
-        c.exec_command(cmd)
-        print("Done!")
+        pool.run(ip, cmd)
+        say("Done!")
 
     # start the scheduler
-    print("Starting scheduler...", end="", flush=True)
+    say("Starting scheduler...", end="", flush=True)
     cmd = "tmux new -d -s scheduler './sklearn-pmlb-benchmarks/src/scheduler.py --resume {} --max-connections {}'".format(OUTPUTDIR, NUMCLIENTS)
+    pool.run(ip, cmd)
+    say("Done!")
+    return True
 
-    c.exec_command(cmd)
-    c.close()
-    print("Done!")
+def start_scheduler(options):
+    region = single_region(options)
+    iid = launch_scheduler(region)['InstanceId']
+    print("Starting {}...".format(iid), end="", flush=True)
+
+    pool = SSHPool(KEYFILE)
+    started = []
+    try:
+        # running and answering over SSH
+        ready, _ = launcher.wait_ready(region, [iid], pool,
+                                       on_ready=lambda _, inst: started.append(inst))
+        if len(ready) == 0:
+            print("Failed!")
+            exit(-1)
+        instance = started[0]
+        print("Started at {}!".format(launcher.address(instance)))
+        if not setup_scheduler(options, pool, launcher.address(instance)):
+            exit(-1)
+    finally:
+        pool.close()
     print("Started at {}:{}".format(instance['PrivateIpAddress'], PORT))
 
-def finish_scheduler():
+def finish_scheduler(options):
     print("[wip] stop")
 
-def start_spot():
-    cmd = ['aws', 'ec2', 'request-spot-fleet',
-           # '--dry',
-           '--region', REGION,
-           '--spot-fleet-request-config', 'file://config.json'
-    ]
+def start_spot(options):
+    config = load_config(options.config)
 
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE)
-    spot_id = json.loads(proc.stdout)['SpotFleetRequestId']
+    output = backend.call('ec2', 'request_spot_fleet', single_region(options),
+                          # DryRun=True,
+                          SpotFleetRequestConfig=config)
+    spot_id = output['SpotFleetRequestId']
     print("Started {}!".format(spot_id))
 
-def info_spot():
-    cmd = ['aws', 'ec2', 'describe-spot-fleet-requests']
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE)
-    configs = json.loads(proc.stdout)['SpotFleetRequestConfigs']
-    active_requests = {conf['SpotFleetRequestId']: conf for conf in configs if
-                       conf['SpotFleetRequestState'] == "active"}
-
-    for sfr, data in active_requests.items():
-        cmd = ['aws', 'ec2', 'describe-spot-fleet-instances',
-               '--spot-fleet-request-id', sfr]
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE)
-        output = json.loads(proc.stdout)['ActiveInstances']
-        for info in output:
-            print("{} : {}".format(info['InstanceId'], info['InstanceType']))
-    # for conf in configs:
-    #     print(conf['SpotFleetRequestId'], conf['SpotFleetRequestState'])
-    # cmd = ['aws', 'ec2', 'des',
-    #        '--spot-instance-request-ids', spot_id]
-
-
-def cancel_spot():
+def load_config(path):
+    with open(path) as f:
+        return json.load(f)
+
+# WeightedCapacity per (type, subnet) and per type from a fleet config
+def capacity_weights(config):
+    res = {}
+    overrides = list(config.get('LaunchSpecifications', []))
+    for ltc in config.get('LaunchTemplateConfigs', []):
+        overrides += ltc.get('Overrides', [])
+    for o in overrides:
+        if 'InstanceType' not in o:
+            continue
+        weight = float(o.get('WeightedCapacity', 1))
+        res[(o['InstanceType'], o.get('SubnetId'))] = weight
+        res.setdefault((o['InstanceType'], None), weight)
+    return res
+
+def instance_weight(weights, inst):
+    key = (inst['InstanceType'], inst.get('SubnetId'))
+    return weights.get(key, weights.get((key[0], None), 1.0))
+
+def get_fleet_requests(region):
+    configs = []
+    for page in backend.paginate('ec2', 'describe_spot_fleet_requests', region):
+        configs += page['SpotFleetRequestConfigs']
+    return {conf['SpotFleetRequestId']: conf for conf in configs if
+            conf['SpotFleetRequestState'] == "active"}
+
+def get_fleet_instances(region, sfr):
+    res = []
+    for page in backend.paginate('ec2', 'describe_spot_fleet_instances', region,
+                                 SpotFleetRequestId=sfr):
+        res += page['ActiveInstances']
+    return res
+
+# {region: {sfr: (request config, [instance])}}, with every instance joined to
+# its describe-instances entry. The per-fleet lists are fetched all at once and
+# each region's instances are then described in as few calls as possible.
+def get_fleets(regions, workers=16):
+    with ThreadPoolExecutor(max_workers=min(len(regions), 8)) as pool:
+        requests = dict(zip(regions, pool.map(get_fleet_requests, regions)))
+
+    jobs = [(region, sfr) for region in regions for sfr in requests[region]]
+    fleets = {region: {} for region in regions}
+    if len(jobs) == 0:
+        return fleets
+    with ThreadPoolExecutor(max_workers=min(len(jobs), workers)) as pool:
+        for (region, sfr), active in zip(jobs, pool.map(lambda job: get_fleet_instances(*job), jobs)):
+            fleets[region][sfr] = (requests[region][sfr], active)
+
+    def describe(region):
+        iids = [info['InstanceId'] for _, active in fleets[region].values() for info in active]
+        return launcher.describe(region, iids) if len(iids) > 0 else {}
+
+    active_regions = [region for region in regions if len(fleets[region]) > 0]
+    with ThreadPoolExecutor(max_workers=min(len(active_regions), 8)) as pool:
+        details = dict(zip(active_regions, pool.map(describe, active_regions)))
+
+    for region in active_regions:
+        for sfr, (conf, active) in fleets[region].items():
+            fleets[region][sfr] = (conf, [dict(info, **details[region].get(info['InstanceId'], {}))
+                                          for info in active])
+    return fleets
+
+def info_spot(options):
+    weights = capacity_weights(load_config(options.config))
+    fleets = get_fleets(options.region)
+
+    for region in options.region:
+        prefix = "[{}] ".format(region) if len(options.region) > 1 else ""
+        for sfr, (conf, instances) in fleets[region].items():
+            target = conf['SpotFleetRequestConfig'].get('TargetCapacity', 0)
+            fulfilled = sum(instance_weight(weights, inst) for inst in instances)
+            print("{}{} : {:g}/{} capacity ({:.0%}) from {} instances".format(
+                prefix, sfr, fulfilled, target, fulfilled / target if target else 0,
+                len(instances)))
+            for inst in instances:
+                print("{}{} : {} : {} : {} : {}".format(
+                    prefix, inst['InstanceId'], inst['InstanceType'],
+                    inst.get('State', {}).get('Name', '?'),
+                    inst.get('Placement', {}).get('AvailabilityZone', '?'),
+                    inst.get('PublicIpAddress', inst.get('PrivateIpAddress', '-'))))
+
+def prices(options):
+    region = single_region(options)
+    config = load_config(options.config)
+    table = spotprices.overrides(config, region)
+    store = spotprices.open_store(options.data_dir)
+
+    wanted = set(zip(table['type'], table['zone']))
+    added = spotprices.update(store, region, wanted, options.days, options.product)
+    print("Fetched {} new price points for {} types in {} zones".format(
+        added, table['type'].nunique(), table['zone'].nunique()))
+
+    # observed interruption rates, for the types with enough fleet history
+    rates = fleethistory.interruption_rates(options.data_dir)
+    summary = spotprices.summarize(store, table, options.days, rates=rates,
+                                   restart_hours=options.restart_hours)
+    print("{:<12} {:<12} {:>6} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+        'type', 'zone', 'weight', 'current', 'mean', 'p95', 'per unit', 'adjusted'))
+    for _, r in summary.iterrows():
+        print("{:<12} {:<12} {:>6g} {:>9.4f} {:>9.4f} {:>9.4f} {:>10.5f} {:>10.5f}".format(
+            r['type'], r['zone'], r['weight'], r['current'], r['mean'], r['p95'],
+            r['per_unit'], r['adjusted']))
+
+    if options.emit != None:
+        optimized = spotprices.optimize(config, table, summary, options.top, options.bid_margin)
+        with open(options.emit, 'w') as f:
+            json.dump(optimized, f, indent=2)
+        print("Wrote {} overrides with a bid of {} per unit to {}".format(
+            sum(len(ltc['Overrides']) for ltc in optimized['LaunchTemplateConfigs']),
+            optimized.get('SpotPrice'), options.emit))
+
+def print_rates(label, table):
+    print("{:<14} {:>9} {:>9} {:>13} {:>10} {:>14}".format(
+        label, 'instances', 'hours', 'interruptions', 'per hour', 'replaced after'))
+    for key, r in table.iterrows():
+        print("{:<14} {:>9} {:>9.1f} {:>13} {:>10.4f} {:>13.0f}s".format(
+            key or '?', r['instances'], r['hours'], r['interruptions'], r['rate'],
+            r['replaced_after']))
+
+def history(options):
+    region = single_region(options)
+    log = fleethistory.open_log(options.data_dir)
+    sfrs = options.fleet or list(get_fleet_requests(region).keys())
+    added = fleethistory.sync(log, sfrs, fleethistory.aws_source(region))
+    for sfr, n in added.items():
+        print("{} : {} new events".format(sfr, n))
+
+    if log.size == 0:
+        return
+    lives = fleethistory.lifetimes(log.events())
+    print_rates('type', fleethistory.rates(lives, 'type'))
+    print()
+    print_rates('zone', fleethistory.rates(lives, 'zone'))
+
+CLIENT_SESSION = 'session'
+CLIENT_CMDS = [
+    "cd sklearn-benchmarks && git pull",
+    # a session left over from an earlier attempt would block the new one
+    "tmux kill-session -t {session} 2>/dev/null; "
+    "tmux -v new -d -s {session} './sklearn-benchmarks/model_code/client.py -p {port} -o {scheduler} --loop'",
+]
+# seconds a client has to stay up before it counts as started
+CLIENT_SETTLE = 5
+
+# runs CLIENT_CMDS on `ip` and checks the tmux session is still there after
+# CLIENT_SETTLE seconds, up to `retries` times. Returns whether it worked.
+def start_client(pool, ip, scheduler_ip, port, retries, prefix):
+    delays = launcher.backoff(start=2.0)
+    for attempt in range(1, retries + 1):
+        try:
+            for cmd in CLIENT_CMDS:
+                cmd = cmd.format(session=CLIENT_SESSION, port=port, scheduler=scheduler_ip)
+                status = pool.run(ip, cmd, lambda line: emit(prefix, line))
+                if status != 0:
+                    raise RuntimeError("`{}` exited with {}".format(cmd, status))
+            if pool.run(ip, "sleep {}; tmux has-session -t {}".format(
+                    CLIENT_SETTLE, CLIENT_SESSION)) != 0:
+                raise RuntimeError("the client exited right away")
+            return True
+        except Exception as e:
+            emit(prefix, "attempt {}/{} failed: {}".format(attempt, retries, e))
+            pool.close(ip)
+        if attempt < retries:
+            sleep(next(delays))
+    return False
+
+# Polls the fleet's instances until their capacity reaches the target, calling
+# `on_new(iids)` with the ones it hasn't seen yet. Returns the capacity reached.
+def watch_fleet(region, sfr, weights, target, on_new, timeout):
+    seen = set()
+    fulfilled = 0
+    deadline = perf_counter() + timeout
+    delays = launcher.backoff()
+    while perf_counter() < deadline:
+        active = get_fleet_instances(region, sfr)
+        new = [info['InstanceId'] for info in active if info['InstanceId'] not in seen]
+        fulfilled = sum(instance_weight(weights, info) for info in active)
+        if len(new) > 0:
+            seen.update(new)
+            on_new(new)
+            delays = launcher.backoff()
+        if fulfilled >= target:
+            break
+        sleep(min(next(delays), max(0, deadline - perf_counter())))
+    return fulfilled
+
+# Launches the scheduler and the client fleet at once. Clients are handed the
+# scheduler's private ip (known as soon as it's launched) and each one is set
+# up as soon as it answers over SSH, at most --workers at a time.
+def bootstrap(options):
+    region = single_region(options)
+    config = load_config(options.config)
+    weights = capacity_weights(config)
+    target = config.get('TargetCapacity', 0)
+    pool = SSHPool(KEYFILE)
+    t0 = perf_counter()
+
+    scheduler = {}
+    scheduler_known = threading.Event()
+    slots = threading.Semaphore(options.workers)
+    lock = threading.Lock()
+    started, failed = {}, set()
+
+    def run_scheduler():
+        try:
+            inst = launch_scheduler(region)
+            scheduler['iid'] = inst['InstanceId']
+            scheduler['ip'] = inst['PrivateIpAddress']
+        except backend.AwsError as e:
+            emit("[scheduler]", "launch failed: {}".format(e))
+            return
+        finally:
+            scheduler_known.set()
+        emit("[scheduler]", "{} launched at {}".format(scheduler['iid'], scheduler['ip']))
+
+        # setup_scheduler's progress is written for a terminal, only whole lines go out
+        line = ['']
+        def say(msg, end='\n', flush=False):
+            line[0] = msg[1:] if msg.startswith('\r') else line[0] + msg
+            if end == '\n':
+                emit("[scheduler]", line[0].rstrip())
+                line[0] = ''
+
+        def setup(iid, inst):
+            scheduler['ok'] = setup_scheduler(options, pool, launcher.address(inst), say)
+
+        ready, _ = launcher.wait_ready(region, [scheduler['iid']], pool, t0, on_ready=setup,
+                                       timeout=options.timeout)
+        if len(ready) == 0:
+            emit("[scheduler]", "never became reachable")
+
+    def setup_client(iid, inst):
+        prefix = "[{}]".format(iid)
+        scheduler_known.wait()
+        if 'ip' not in scheduler:
+            emit(prefix, "no scheduler to connect to")
+            ok = False
+        else:
+            with slots:
+                ok = start_client(pool, launcher.address(inst), scheduler['ip'], options.port,
+                                  options.retries, prefix)
+        with lock:
+            if ok:
+                started[iid] = perf_counter() - t0
+                emit(prefix, "client started after {:.1f}s ({} so far)".format(
+                    started[iid], len(started)))
+            else:
+                failed.add(iid)
+
+    # every instance the fleet reports goes to the same waiter, so the clients
+    # share one pool of --workers threads however the fleet batches them
+    clients = launcher.ReadyWaiter(region, pool, t0, on_ready=setup_client,
+                                   workers=options.workers, timeout=options.timeout)
+    try:
+        scheduler_job = threading.Thread(target=run_scheduler)
+        scheduler_job.start()
+        try:
+            sfr = backend.call('ec2', 'request_spot_fleet', region,
+                               SpotFleetRequestConfig=config)['SpotFleetRequestId']
+            print("Requested {} for {} capacity".format(sfr, target))
+            fulfilled = watch_fleet(region, sfr, weights, target, clients.add, options.timeout)
+        finally:
+            _, unreachable = clients.close()
+            scheduler_job.join()
+        failed.update(unreachable)
+    finally:
+        pool.close()
+
+    print("Fleet {} reached {:g}/{} capacity".format(sfr, fulfilled, target))
+    if scheduler.get('ok'):
+        print("Scheduler {} at {}:{}".format(scheduler['iid'], scheduler['ip'], PORT))
+    else:
+        print("Scheduler {} failed!".format(scheduler.get('iid', '-')))
+    if len(started) > 0:
+        times = sorted(started.values())
+        print("{} clients started, the first after {:.1f}s and the last after {:.1f}s".format(
+            len(times), times[0], times[-1]))
+    if len(failed) > 0:
+        print("{} clients failed: {}".format(len(failed), ' '.join(sorted(failed))))
+    if not scheduler.get('ok') or len(failed) > 0:
+        exit(-1)
+
+def cancel_spot(options):
     cmd = ['aws', 'ec2', 'cancel-spot-instance-requests',
            '--spot-instance-request-ids', spot_id]
 
 
 choices = {"start-scheduler": start_scheduler,
+           "bootstrap": bootstrap,
            "finish-scheduler": finish_scheduler,
            "start-spot": start_spot,
            "info-spot": info_spot,
+           "prices": prices,
+           "history": history,
            "cancel-spot": cancel_spot
 }
 
@@ -134,10 +430,52 @@ def make_parser():
     parser = argparse.ArgumentParser(description=descr)
 
     parser.add_argument("command", action="store", choices=list(choices.keys()))
+    parser.add_argument("--region", action="store", nargs='+', default=[REGION])
+    parser.add_argument("--backend", action="store", default=backend.mode,
+                        choices=[backend.SDK, backend.CLI])
+    parser.add_argument("--endpoint-url", action="store")
+    parser.add_argument("--config", action="store", default="config.json")
+    parser.add_argument("--trace", action="store", metavar="FILE",
+                        help="record a span per AWS/SSH call, .json for a Chrome trace")
+    parser.add_argument("--data-dir", action="store", default="data")
+    parser.add_argument("--stream", action="store")
+    parser.add_argument("--compression", action="store", default="gz",
+                        choices=list(transfer.UNPACK.keys()))
+
+    # bootstrap options
+    parser.add_argument("--port", action="store", default=PORT, type=int)
+    parser.add_argument("--workers", action="store", default=16, type=int,
+                        help="clients set up at once")
+    parser.add_argument("--retries", action="store", default=3, type=int)
+    parser.add_argument("--timeout", action="store", default=900, type=int,
+                        help="seconds to wait for the fleet and each host")
+
+    # history options
+    parser.add_argument("--fleet", action="store", nargs='*', default=[],
+                        help="fleet requests to track, defaults to the active ones")
+
+    # prices options
+    parser.add_argument("--days", action="store", default=7, type=int)
+    parser.add_argument("--product", action="store", default=spotprices.PRODUCT)
+    parser.add_argument("--restart-hours", action="store", default=0.5, type=float,
+                        help="hours of work lost per interruption")
+    parser.add_argument("--emit", action="store",
+                        help="write a copy of --config with the cheapest overrides and a bid")
+    parser.add_argument("--top", action="store", default=6, type=int)
+    parser.add_argument("--bid-margin", action="store", default=0.2, type=float)
 
     return parser
 
 if __name__ == "__main__":
     options = make_parser().parse_args()
+    backend.set_mode(options.backend, options.endpoint_url)
+    if options.trace != None:
+        tracing.start(options.trace)
+    options.region = backend.resolve_regions(options.region, REGION)
+    try:
+        os.mkdir(options.data_dir)
+    except OSError:
+        pass
 
-    choices[options.command]()
+    with tracing.span(options.command, 'command'):
+        choices[options.command](options)
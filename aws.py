@@ -2,88 +2,120 @@
 
 import argparse
 import subprocess
-import json
 import os
-from paramiko import RSAKey, SSHClient, AutoAddPolicy
-from pathlib import Path
-from datetime import datetime, timedelta
-from time import sleep
-
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-
-# IMAGE_ID = 'ami-003caac684d26c013'
-# SECURITY_ID = 'sg-0986839b16b02894f'
+import sys
+from pathlib import Path, PurePosixPath
+from datetime import datetime, timedelta, timezone
+from time import sleep, perf_counter
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+# pandas, matplotlib and paramiko (via sshpool) together take over a second to
+# import, so they're imported by the subcommands that use them
+import backend
+import daemon
+import dashboard
+import inventory
+import launcher
+import selector
+from selector import parse_tags
+import transfer
+import tracing
+
+IMAGE_ID = 'ami-003caac684d26c013'
+SECURITY_ID = 'sg-0986839b16b02894f'
+
+DEFAULT_REGION = 'us-west-1'
 
 # KEY = "tiger"
 # KEYFILE = "~/.ssh/{}.pem".format(KEY)
 
+# `serve` sets these so SSH connections and the CPU store outlive one command
+_pools = None
+_stores = None
+# the figure `cpu --graph --watch` keeps redrawing
+_plot = None
+
+
+def keep_warm():
+    global _pools, _stores
+    _pools, _stores = {}, {}
 
-def get_instances(region):
-    proc = subprocess.run(['aws', 'ec2', 'describe-instances',
-                           '--region', region], stdout=subprocess.PIPE)
-    instances_data = json.loads(proc.stdout)
-    reservations = instances_data['Reservations']
-    # print(len(reservations[7]['Instances']))
+def ssh_pool(keyfile):
+    from sshpool import SSHPool
+    if _pools is None:
+        return SSHPool(keyfile)
+    if keyfile not in _pools:
+        _pools[keyfile] = SSHPool(keyfile)
+    return _pools[keyfile]
 
+def release(pool):
+    if _pools is None or pool not in _pools.values():
+        pool.close()
+
+
+def get_instances(region, filters=None):
+    params = {}
+    if filters:
+        params['Filters'] = filters
     res = {}
+    for page in backend.paginate('ec2', 'describe_instances', region, **params):
+        for r in page['Reservations']:
+            for inst in r['Instances']:
+                if inst['State']['Name'] != 'terminated':
+                    res[inst['InstanceId']] = inst
+    return res
 
-    for r in reservations:
-        for inst in r['Instances']:
-            if inst['State']['Name'] != 'terminated':
-                res[inst['InstanceId']] = inst
+# how many regions are queried at once
+REGION_WORKERS = 8
+
+def load_instances(options):
+    filters = selector.pushdown_filters(options)
+
+    def load(region):
+        instances = inventory.load(region, options.data_dir, options.ttl,
+                                   get_instances, refresh=options.refresh,
+                                   filters=filters)
+        for inst in instances.values():
+            inst['Region'] = region
+        return instances
+
+    if len(options.region) == 1:
+        return load(options.region[0])
+
+    res = {}
+    with ThreadPoolExecutor(max_workers=min(len(options.region), REGION_WORKERS)) as pool:
+        for instances in pool.map(load, options.region):
+            res.update(instances)
     return res
 
-def parse_tags(instance):
+def group_by_region(iids, instances):
     res = {}
-    if 'Tags' in instance:
-        for tag in instance['Tags']:
-            res[tag['Key']] = tag['Value']
+    for iid in iids:
+        res.setdefault(instances[iid]['Region'], []).append(iid)
     return res
 
 def filter_instances(instances, options):
-    valid_iids = []
-    for iid in options.iid:
-        valid_iids.append(iid)
-
-    for name in options.nametag:
-        for iid, v in instances.items():
-            tags = parse_tags(v)
-            if 'Name' in parse_tags(v):
-                if tags['Name'] == name:
-                    valid_iids.append(iid)
-
-    if len(options.iid) > 0 or len(options.nametag) > 0:
-        if options.inverse:
-            return {iid: data for iid, data in instances.items() if not iid in valid_iids}
-        else:
-            return {iid: data for iid, data in instances.items() if iid in valid_iids}
-    else:
-        return instances
+    return selector.select(instances, options)
 
 def select_dict(d, a, b):
-    allowed = list(d.keys())[a:b]
-    return {k: v for k, v in d.items() if k in allowed}
+    return dict(list(d.items())[a:b])
 
 def iso_to_datetime(iso_str):
-    date_time_split = iso_str.split("T")
-    date, time = date_time_split[0], date_time_split[1]
-
-    # date
-    date_split = date.split('-')
-    year, month, day = int(date_split[0]), int(date_split[1]), int(date_split[2])
-
-    # time
-    time = time[:-1]
-    time_split = time.split(':')
-    hour, minute, second = int(time_split[0]), int(time_split[1]), int(time_split[2])
-
-    return datetime(year, month, day, hour=hour, minute=minute, second=second)
+    # the cli prints timestamps of JSON protocol services (cloudwatch) as epoch seconds
+    if isinstance(iso_str, (int, float)):
+        return datetime.fromtimestamp(iso_str, timezone.utc).replace(tzinfo=None, microsecond=0)
+    # the cli prints a trailing 'Z', the sdk path prints '+00:00'
+    dt = datetime.fromisoformat(iso_str.replace('Z', '+00:00'))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.replace(microsecond=0)
 
 def h_info(options, instances, keyfile):
     for iid, instance in instances.items():
         tags = parse_tags(instance)
+        if len(options.region) > 1:
+            print("[{}] ".format(instance['Region']), end='')
         if 'Name' in tags:
             print("{} : ".format(tags['Name']), end='')
         print(iid)
@@ -113,101 +145,520 @@ def h_connect(options, instances, keyfile):
         subprocess.run(cmd)
         print("Done with {}!".format(ip))
 
+def h_exec(options, instances, keyfile):
+    if options.cmd == None:
+        print("Need to specify a command with --cmd!")
+        exit(-1)
+
+    from sshpool import emit
+    pool = ssh_pool(keyfile)
+
+    def run(item):
+        iid, instance = item
+        prefix = "[{}]".format(parse_tags(instance).get('Name', iid))
+        ip = instance.get('PublicIpAddress')
+        if ip is None:
+            emit(prefix, "no public ip")
+            return iid, None
+        try:
+            status = pool.run(ip, options.cmd, lambda line: emit(prefix, line))
+        except Exception as e:
+            emit(prefix, "failed: {}".format(e))
+            return iid, None
+        return iid, status
+
+    try:
+        with ThreadPoolExecutor(max_workers=options.workers) as executor:
+            results = dict(executor.map(run, instances.items()))
+    finally:
+        release(pool)
+
+    codes = {}
+    for iid, status in results.items():
+        codes.setdefault(status, []).append(iid)
+    print("Ran on {} instances:".format(len(results)))
+    for status, iids in sorted(codes.items(), key=lambda kv: (kv[0] is None, kv[0] or 0)):
+        label = "unreachable" if status is None else "exit {}".format(status)
+        print(" [-] {} : {}".format(label, len(iids)))
+        if status != 0:
+            for iid in iids:
+                print("   * {}".format(iid))
+
+def h_push(options, instances, keyfile):
+    if options.path == None:
+        print("Need to specify a path!")
+        exit(-1)
+
+    if options.relay > 0 and options.dest and PurePosixPath(options.dest).is_absolute():
+        print("--relay only works with a --dest relative to the home directory!")
+        exit(-1)
+
+    files = [(local, PurePosixPath(options.dest, rel) if options.dest else rel)
+             for local, rel in transfer.local_files(options.path, options.recursive)]
+    sizes = {remote: os.path.getsize(str(local)) for local, remote in files}
+    targets = [(iid, inst) for iid, inst in instances.items() if 'PublicIpAddress' in inst]
+
+    from sshpool import emit
+    pool = ssh_pool(keyfile)
+    meter = transfer.Meter()
+    start = perf_counter()
+
+    def push_direct(item):
+        iid, instance = item
+        prefix = "[{}]".format(parse_tags(instance).get('Name', iid))
+        try:
+            for local, remote in files:
+                n = transfer.upload(pool, instance['PublicIpAddress'], local, remote,
+                                    meter.add)
+                emit(prefix, "{} : {}".format(remote, "sent" if n > 0 else "up to date"))
+        except Exception as e:
+            emit(prefix, "failed: {}".format(e))
+            return iid, False
+        return iid, True
+
+    # every instance that has the files serves them to the ones that don't yet
+    seeds = Queue()
+    serving = []
+
+    def push_relay(item):
+        iid, instance = item
+        prefix = "[{}]".format(parse_tags(instance).get('Name', iid))
+        ip = instance['PublicIpAddress']
+        seed = seeds.get()
+        try:
+            for local, remote in files:
+                if transfer.remote_sha256(pool, ip, remote) == transfer.sha256_file(local):
+                    emit(prefix, "{} : up to date".format(remote))
+                    continue
+                if transfer.relay(pool, ip, seed, options.relay_port, remote,
+                                  sizes[remote]) != 0:
+                    raise RuntimeError("relay of {} from {} failed".format(remote, seed))
+                meter.add(sizes[remote])
+                emit(prefix, "{} : relayed from {}".format(remote, seed))
+        except Exception as e:
+            emit(prefix, "failed: {}".format(e))
+            return iid, False
+        finally:
+            seeds.put(seed)
+
+        serving.append(ip)
+        if serve(instance):
+            seeds.put(instance['PrivateIpAddress'])
+        return iid, True
+
+    def serve(instance):
+        ip = instance['PublicIpAddress']
+        if transfer.serve(pool, ip, instance['PrivateIpAddress'], options.relay_port,
+                          list(sizes)) != 0:
+            emit("[{}]".format(parse_tags(instance).get('Name', ip)),
+                 "couldn't start serving on port {}".format(options.relay_port))
+            return False
+        return True
+
+    results = {}
+    try:
+        direct = targets if options.relay == 0 else targets[:options.relay]
+        with ThreadPoolExecutor(max_workers=options.workers) as executor:
+            results.update(executor.map(push_direct, direct))
+
+        if options.relay > 0:
+            for iid, instance in direct:
+                if results[iid]:
+                    serving.append(instance['PublicIpAddress'])
+                    if serve(instance):
+                        seeds.put(instance['PrivateIpAddress'])
+            rest = targets[options.relay:]
+            if len(rest) > 0 and seeds.qsize() == 0:
+                print("No instance was seeded, can't relay!")
+            elif len(rest) > 0:
+                with ThreadPoolExecutor(max_workers=options.workers) as executor:
+                    results.update(executor.map(push_relay, rest))
+    finally:
+        for ip in serving:
+            transfer.stop_serving(pool, ip, options.relay_port)
+        release(pool)
+
+    failed = [iid for iid, ok in results.items() if not ok]
+    print("Pushed to {}/{} instances, {}".format(len(results) - len(failed), len(targets),
+                                                transfer.format_rate(meter.bytes, perf_counter() - start)))
+    for iid in failed:
+        print(" [-] failed : {}".format(iid))
+
+def h_pull(options, instances, keyfile):
+    if options.path == None:
+        print("Need to specify a path!")
+        exit(-1)
+
+    targets = [(iid, inst) for iid, inst in instances.items() if 'PublicIpAddress' in inst]
+    from sshpool import emit
+    pool = ssh_pool(keyfile)
+    meter = transfer.Meter()
+    start = perf_counter()
+
+    def pull(item):
+        iid, instance = item
+        name = parse_tags(instance).get('Name', iid)
+        prefix = "[{}]".format(name)
+        ip = instance['PublicIpAddress']
+        try:
+            sftp = pool.sftp(ip)
+            try:
+                files = transfer.remote_files(sftp, options.path, options.recursive)
+            finally:
+                sftp.close()
+            for remote, rel in files:
+                local = Path(options.dest or '.', name if name == iid else "{}-{}".format(name, iid), *rel.parts)
+                n = transfer.download(pool, ip, remote, local, meter.add)
+                emit(prefix, "{} : {}".format(local, "received" if n > 0 else "up to date"))
+        except Exception as e:
+            emit(prefix, "failed: {}".format(e))
+            return iid, False
+        return iid, True
+
+    try:
+        with ThreadPoolExecutor(max_workers=options.workers) as executor:
+            results = dict(executor.map(pull, targets))
+    finally:
+        release(pool)
+
+    failed = [iid for iid, ok in results.items() if not ok]
+    print("Pulled from {}/{} instances, {}".format(len(results) - len(failed), len(targets),
+                                                  transfer.format_rate(meter.bytes, perf_counter() - start)))
+    for iid in failed:
+        print(" [-] failed : {}".format(iid))
+
+# TerminateInstances takes at most 1000 ids per request
+TERMINATE_BATCH = 1000
+
+def terminate_batch(region, iids, dry_run=False):
+    try:
+        output = backend.call('ec2', 'terminate_instances', region,
+                              InstanceIds=iids, DryRun=dry_run)
+    except backend.AwsError as e:
+        if e.code == 'DryRunOperation':
+            return {iid: 'would terminate' for iid in iids}
+        # one bad id fails the whole request, split it to find the culprit
+        if e.code.startswith('InvalidInstanceID') and len(iids) > 1:
+            res = terminate_batch(region, iids[:len(iids)//2], dry_run)
+            res.update(terminate_batch(region, iids[len(iids)//2:], dry_run))
+            return res
+        return {iid: 'failed ({})'.format(e.code) for iid in iids}
+
+    return {info['InstanceId']: '{} -> {}'.format(info['PreviousState']['Name'],
+                                                 info['CurrentState']['Name'])
+            for info in output['TerminatingInstances']}
+
+def terminate(by_region, dry_run=False):
+    jobs = []
+    for region, iids in by_region.items():
+        for b in range(0, len(iids), TERMINATE_BATCH):
+            jobs.append((region, iids[b:b+TERMINATE_BATCH]))
+
+    res = {}
+    if len(jobs) == 0:
+        return res
+    with ThreadPoolExecutor(max_workers=min(len(jobs), 8)) as pool:
+        for outcome in pool.map(lambda job: terminate_batch(*job, dry_run=dry_run), jobs):
+            res.update(outcome)
+    return res
+
 def h_terminate(options, instances, keyfile):
-    for iid, instance in instances.items():
-        cmd = ['aws', 'ec2', 'terminate-instances',
-               '--instance-ids', '{}'.format(iid),
-               '--region', options.region]
-        subprocess.run(cmd, stdout=subprocess.PIPE)
-        print("Terminating {}".format(iid))
-
-def get_cpu_data(iid, start_time, end_time):
-    cmd = ['aws', 'cloudwatch', 'get-metric-statistics',
-        '--metric-name', 'CPUUtilization',
-        '--start-time', start_time.isoformat(timespec='minutes'),
-        '--end-time', end_time.isoformat(timespec='minutes'),
-        '--period', '300',
-        '--namespace', 'AWS/EC2',
-        '--statistics', 'Average',
-        '--dimensions', 'Name=InstanceId,Value={}'.format(iid)]
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE)
-    output = json.loads(proc.stdout)
-    data = {}
-    for point in sorted(output['Datapoints'], key=lambda o: o['Timestamp']):
-        data[iso_to_datetime(point['Timestamp'])] = [float(point['Average'])]
-    return data
+    if len(instances) == 0:
+        return
+
+    by_region = group_by_region(instances.keys(), instances)
+
+    if options.confirm and not options.dry_run:
+        print("About to terminate {} instances:".format(len(instances)))
+        for region, iids in by_region.items():
+            print(" [-] {} : {}".format(region, ' '.join(iids)))
+        if input("Continue? [y/N] ").strip().lower() != 'y':
+            print("Aborted.")
+            return
+
+    outcomes = terminate_and_forget(options, by_region)
+    for iid in instances:
+        print("Terminating {} : {}".format(iid, outcomes.get(iid, 'no response')))
+
+def terminate_and_forget(options, by_region):
+    outcomes = terminate(by_region, dry_run=options.dry_run)
+    if not options.dry_run:
+        for region, iids in by_region.items():
+            inventory.forget(region, options.data_dir, set(iids))
+    return outcomes
+
+def h_launch(options, instances, keyfile):
+    if options.count == None or options.basename == None:
+        print("Need to specify a basename + count!")
+        exit(-1)
+    region = options.region[0]
+    if len(options.region) > 1:
+        print("launch needs exactly one region!")
+        exit(-1)
+
+    # templated tags differ per instance and are added after the launch
+    templated = [pair for pair in options.launch_tag if '{' in pair]
+    shared = launcher.instance_tags([pair for pair in options.launch_tag if '{' not in pair],
+                                    options.basename, 0)
+    params = {'ImageId': options.image_id,
+              'InstanceType': options.type,
+              'KeyName': options.key,
+              'SecurityGroupIds': [options.security_group]}
+
+    t0 = perf_counter()
+    launched, errors = launcher.run_instances(region, options.count, params, shared,
+                                              start=options.start, dry_run=options.dry_run)
+    for e in errors:
+        print("Launch failed : {}".format(e))
+    if options.dry_run:
+        if len(errors) == 0:
+            print("Would launch {} instances".format(options.count))
+        return
+    print("Requested {}/{} instances in {:.1f}s".format(len(launched), options.count,
+                                                       perf_counter() - t0))
+    if len(launched) == 0:
+        return
+
+    tags = {iid: launcher.instance_tags(templated, options.basename, i) for iid, i in launched}
+    launcher.tag_instances(region, tags)
+    inventory.expire(region, options.data_dir)
+
+    names = {iid: tags[iid].get('Name', shared.get('Name', iid)) for iid, _ in launched}
+    from sshpool import emit
+
+    def on_ready(iid, inst):
+        emit("[{}]".format(names[iid]), "{} ready at {} after {:.1f}s".format(
+            iid, launcher.address(inst), perf_counter() - t0))
+
+    pool = None if options.no_ssh_check else ssh_pool(keyfile)
+    try:
+        ready, failed = launcher.wait_ready(region, [iid for iid, _ in launched], pool, t0,
+                                            on_ready, workers=options.workers)
+    finally:
+        if pool is not None:
+            release(pool)
+
+    print("{}/{} instances ready".format(len(ready), len(launched)))
+    if len(ready) > 0:
+        print(" [-] first usable after {:.1f}s".format(min(ready.values())))
+        print(" [-] {} after {:.1f}s".format(
+            "all ready" if len(failed) == 0 else "last ready", max(ready.values())))
+    for iid in sorted(failed):
+        print(" [-] not ready : {} ({})".format(names[iid], iid))
+
+# GetMetricData takes at most 500 queries per request
+METRIC_BATCH = 500
+
+def get_cpu_matrix(iids, start_time, end_time, region):
+    with tracing.span('get_cpu_matrix', 'cpu', region=region, items=len(iids)):
+        return _get_cpu_matrix(iids, start_time, end_time, region)
+
+def _get_cpu_matrix(iids, start_time, end_time, region):
+    import pandas as pd
+    series = {iid: {} for iid in iids}
+    for b in range(0, len(iids), METRIC_BATCH):
+        batch = iids[b:b+METRIC_BATCH]
+        # query ids have to start with a lowercase letter
+        queries = [{'Id': 'q{}'.format(i),
+                    'MetricStat': {
+                        'Metric': {'Namespace': 'AWS/EC2',
+                                   'MetricName': 'CPUUtilization',
+                                   'Dimensions': [{'Name': 'InstanceId',
+                                                   'Value': iid}]},
+                        'Period': 300,
+                        'Stat': 'Average'},
+                    'ReturnData': True}
+                   for i, iid in enumerate(batch)]
+        pages = backend.paginate('cloudwatch', 'get_metric_data', region,
+                                 MetricDataQueries=queries,
+                                 StartTime=start_time.replace(second=0, microsecond=0),
+                                 EndTime=end_time.replace(second=0, microsecond=0),
+                                 ScanBy='TimestampAscending')
+        for page in pages:
+            for result in page['MetricDataResults']:
+                points = series[batch[int(result['Id'][1:])]]
+                for t, v in zip(result['Timestamps'], result['Values']):
+                    points[iso_to_datetime(t)] = float(v)
+
+    matrix = pd.DataFrame(series, columns=iids, dtype=float)
+    matrix.index = pd.DatetimeIndex(matrix.index)
+    return matrix.sort_index()
+
+def open_cpu_store(data_dir):
+    from tsstore import SeriesStore, migrate_pickles
+    path = Path(data_dir, 'cpu').resolve()
+    if _stores is not None and path in _stores:
+        # reopened only if someone else committed since
+        store, mtime = _stores[path]
+        if store.index_path.exists() and store.index_path.stat().st_mtime_ns == mtime:
+            return store
+    store = SeriesStore(path)
+    migrated = migrate_pickles(store, data_dir)
+    if migrated > 0:
+        print("Migrated {} .pkl files into {}".format(migrated, store.path))
+    if store.fragmented():
+        store.compact()
+    return store
+
+# remembers the store as of its last commit, see open_cpu_store
+def keep_cpu_store(store):
+    if _stores is not None and store.index_path.exists():
+        _stores[store.path] = (store, store.index_path.stat().st_mtime_ns)
+
+# aligned time x instance matrix, instances without data are all NaN
+def cpu_matrix(store, iids, start=None):
+    import pandas as pd
+    with tracing.span('cpu_matrix', 'store') as stats:
+        columns = {}
+        for iid in iids:
+            times, values = store.read(iid, start=start)
+            columns[iid] = pd.Series(values, index=pd.DatetimeIndex(times))
+        matrix = pd.DataFrame(columns, columns=iids, dtype=float)
+        stats['items'] = matrix.size
+        return matrix.sort_index()
+
+# instances whose stored CPU is missing or older than 10 minutes, with the
+# time to fetch from
+def stale_cpu(store, iids, now_time):
+    stale = {}
+    for iid in iids:
+        last_datapoint = store.last_time(iid)
+        if last_datapoint is None:
+            stale[iid] = now_time - timedelta(hours=24)
+        elif now_time - last_datapoint > timedelta(minutes=10):
+            stale[iid] = last_datapoint
+    return stale
+
+def fetch_cpu(store, stale, instances, now_time):
+    import pandas as pd
+    if len(stale) > 0:
+        by_region = group_by_region(stale.keys(), instances)
+
+        def fetch(region):
+            iids = by_region[region]
+            return get_cpu_matrix(iids, min(stale[iid] for iid in iids),
+                                  now_time, region)
+
+        with ThreadPoolExecutor(max_workers=min(len(by_region), REGION_WORKERS)) as pool:
+            matrix = pd.concat(list(pool.map(fetch, by_region.keys())), axis=1)
+        with tracing.span('append', 'store') as stats:
+            added = 0
+            for iid in stale:
+                new_data = matrix[iid].dropna()
+                added += store.append(iid, new_data.index.values, new_data.values)
+            stats['items'] = added
+        store.commit()
+    keep_cpu_store(store)
 
 def h_cpu(options, instances, keyfile):
+    import pandas as pd
+    import policy
     iids = list(instances.keys())
     now_time = datetime.utcnow()
-    datas = {}
-    print("[0/{}]".format(len(iids)), end="")
-    for i, iid in enumerate(iids):
-        print("\r[{}/{}] : {}".format(i+1, len(iids), iid), end='')
-        path = Path(options.data_dir, "{}.pkl".format(iid))
-        data = None
-        if path.exists():
-            data = pd.read_pickle(str(path))
-            last_datapoint = data.index[-1].to_pydatetime()
-            if now_time - last_datapoint > timedelta(minutes=10):
-                new_data = get_cpu_data(iid, last_datapoint, now_time)
-                df = pd.DataFrame(new_data).transpose()
-                data = data.append(df).drop_duplicates()
-                data.to_pickle(str(path))
-        else:
-            start_time = now_time - timedelta(hours=24)
-            data = get_cpu_data(iid, start_time, now_time)
-            data = pd.DataFrame(data).transpose()
-            if (len(data) > 0):
-                data.to_pickle(str(path))
-        if (len(data) > 0):
-            datas[iid] = data
-
-    print()
-    if options.graph:
-        for iid, data in datas.items():
-            index = int((options.delta * 60) / 5)
-            plt.plot(data[-index+1:], linestyle='-', marker='o', label=iid)
-        plt.grid()
-        plt.ylim([0,100])
-        plt.xticks(rotation=30)
-        plt.legend()
-        plt.show()
-    else:
-        to_kill = []
-        for iid, data in datas.items():
-            print("{} : {:.2f}".format(iid, data[0].mean()))
-            if data[0].mean() < 55:
-                to_kill.append(iid)
-        if options.drop:
-            newInstances = {iid: inst for iid, inst in instances.items() if iid in to_kill}
-            print(list(newInstances.keys()))
-            h_terminate(options, newInstances, keyfile)
+    store = open_cpu_store(options.data_dir)
+
+    stale = stale_cpu(store, iids, now_time)
+    print("Fetching {}/{} instances".format(len(stale), len(iids)))
+    fetch_cpu(store, stale, instances, now_time)
+
+    if options.graph or options.output:
+        global _plot
+        import plotting
+        plot = _plot
+        if plot is None:
+            plot = plotting.CpuPlot(options.plot, options.delta * 60, options.max_points,
+                                    options.output)
+            if options.watch:
+                _plot = plot
+        matrix = cpu_matrix(store, iids, now_time - timedelta(hours=options.delta))
+        with tracing.span('plot', 'cpu', items=matrix.size):
+            plot.update(matrix.dropna(axis=1, how='all'), now_time)
+        if options.output:
+            print("Saved {}".format(options.output))
+        elif not options.watch:
+            import matplotlib.pyplot as plt
+            plt.show()
+        return
+
+    drop_policy = policy.Policy.from_options(options)
+    if options.backtest:
+        matrix = cpu_matrix(store, iids)
+        kills = policy.replay(drop_policy, matrix, instances)
+        print("Replayed {} instances over {} points: {} would have been dropped".format(
+            len(iids), len(matrix), len(kills)))
+        for _, k in kills.iterrows():
+            print("{} : {} : {}".format(k['time'], k['iid'], k['reason']))
+        return
+
+    matrix = cpu_matrix(store, iids, now_time - drop_policy.history_needed())
+    recent = policy.load_kills(options.data_dir)
+    with tracing.span('evaluate', 'policy', items=len(iids)):
+        decisions = policy.evaluate(drop_policy, matrix, instances, pd.Timestamp(now_time), recent)
+    for iid, d in decisions.iterrows():
+        print("{} : {:.2f} [{}] {}".format(iid, d['cpu'], d['decision'], d['reason']))
+
+    if options.drop:
+        to_kill = list(decisions.index[decisions['decision'] == policy.KILL])
+        newInstances = {iid: inst for iid, inst in instances.items() if iid in to_kill}
+        print(list(newInstances.keys()))
+        h_terminate(options, newInstances, keyfile)
+        if not options.dry_run and len(to_kill) > 0:
+            policy.save_kills(options.data_dir, recent + [pd.Timestamp(now_time)] * len(to_kill),
+                              pd.Timestamp(now_time))
 
 choices = {
     "info": h_info,
     "connect": h_connect,
     "terminate": h_terminate,
     "cpu": h_cpu,
+    "exec": h_exec,
+    "push": h_push,
+    "pull": h_pull,
+    "launch": h_launch,
 }
 
+# subcommands that don't act on existing instances
+NO_INVENTORY = {"launch"}
+
 def make_parser():
     descr = "Tool to automate AWS things."
     parser = argparse.ArgumentParser(description=descr)
 
-    parser.add_argument("info_type", action="store", choices=list(choices.keys()))
-    parser.add_argument("--region", action="store", default="us-west-1")
+    parser.add_argument("info_type", action="store", choices=list(choices.keys()) + ["serve"])
+    parser.add_argument("--region", action="store", nargs='+', default=[DEFAULT_REGION])
+    parser.add_argument("--backend", action="store", default=backend.mode,
+                        choices=[backend.SDK, backend.CLI])
+    parser.add_argument("--endpoint-url", action="store")
     parser.add_argument("--key", action="store", default="tiger")
     parser.add_argument("--data-dir", action="store", default="data")
+    parser.add_argument("--ttl", action="store", default=120, type=int)
+    parser.add_argument("--refresh", action="store_true")
+    parser.add_argument("--cache-stats", action="store_true")
+    parser.add_argument("--trace", action="store", metavar="FILE",
+                        help="record a span per AWS/SSH call, .json for a Chrome trace")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="don't hand the command to a running `serve`")
     parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--metrics-every", action="store", default=60, type=int,
+                        help="seconds between CPU refreshes in the cpu --watch dashboard")
+    parser.add_argument("--no-dashboard", action="store_true",
+                        help="print cpu --watch as before instead of the live dashboard")
     parser.add_argument("--graph", action="store_true")
     parser.add_argument("--drop", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--confirm", action="store_true")
 
     # filter options
     parser.add_argument("--iid", action="store", nargs='*')
     parser.add_argument("--nametag", action="store", nargs='*')
     parser.add_argument("-i", "--inverse", action="store_true")
     parser.add_argument("--select", action="store", default="")
+    parser.add_argument("--tag", action="store", nargs='*', default=[])
+    parser.add_argument("--tag-regex", action="store", nargs='*', default=[])
+    parser.add_argument("--instance-type", action="store", nargs='*', default=[])
+    parser.add_argument("--in-state", action="store", nargs='*', default=[])
+    parser.add_argument("--launched-after", action="store")
+    parser.add_argument("--launched-before", action="store")
 
     # display options
     parser.add_argument("--pub-ip", action="store_true")
@@ -216,6 +667,36 @@ def make_parser():
     parser.add_argument("--state", action="store_true")
 
     parser.add_argument("--delta", action="store", default=1, type=int)
+    parser.add_argument("--plot", action="store", default="auto",
+                        choices=["auto", "lines", "bands", "heatmap"])
+    parser.add_argument("--output", action="store", metavar="FILE",
+                        help="save the graph to a .png/.svg instead of opening a window")
+    parser.add_argument("--max-points", action="store", default=500, type=int,
+                        help="points per line or heatmap columns drawn at most")
+
+    # drop policy
+    parser.add_argument("--threshold", action="store", default=55.0, type=float)
+    parser.add_argument("--window", action="store", default=60, type=int,
+                        help="minutes of CPU averaged per decision")
+    parser.add_argument("--hysteresis", action="store", default=3, type=int,
+                        help="consecutive points the average has to stay under the threshold")
+    parser.add_argument("--min-age", action="store", default=30, type=int,
+                        help="minutes since launch before an instance can be dropped")
+    parser.add_argument("--cooldown", action="store", default=10, type=int,
+                        help="minutes after a drop before the next one")
+    parser.add_argument("--max-kill-rate", action="store", default=10, type=int,
+                        help="most instances dropped per hour")
+    parser.add_argument("--protect", action="store", nargs='*', default=["Name=scheduler*"])
+    parser.add_argument("--backtest", action="store_true")
+
+    # exec options
+    parser.add_argument("--cmd", action="store")
+    parser.add_argument("--workers", action="store", default=16, type=int)
+
+    # push/pull options
+    parser.add_argument("--dest", action="store")
+    parser.add_argument("--relay", action="store", default=0, type=int)
+    parser.add_argument("--relay-port", action="store", default=8000, type=int)
 
     # other options
     parser.add_argument("--path", action="store")
@@ -229,35 +710,97 @@ def make_parser():
     parser.add_argument("--count", action="store", type=int)
     parser.add_argument("--basename", action="store")
 
+    # launch options
+    parser.add_argument("--image-id", action="store", default=IMAGE_ID)
+    parser.add_argument("--security-group", action="store", default=SECURITY_ID)
+    parser.add_argument("--launch-tag", action="store", nargs='*', default=["Name={basename}{i}"],
+                        help="KEY=TEMPLATE tags, {basename} and {i} are filled in per instance")
+    parser.add_argument("--no-ssh-check", action="store_true")
+
     return parser
 
-if __name__ == "__main__":
-    options = make_parser().parse_args()
+# the instances a command works on
+def select_instances(options):
+    with tracing.span('load_instances', 'inventory') as stats:
+        instances = load_instances(options)
+        stats['items'] = len(instances)
+    with tracing.span('filter_instances', 'inventory') as stats:
+        filtered = filter_instances(instances, options)
+        stats['items'] = len(filtered)
+
+    if options.select != "":
+        parts = options.select.split(":")
+        lower, upper = int(parts[0]), int(parts[1])
+        filtered = select_dict(filtered, lower, upper)
+    return filtered
+
+# brings the CPU store up to date for `instances` and returns it
+def refresh_cpu(options, instances):
+    now_time = datetime.utcnow()
+    store = open_cpu_store(options.data_dir)
+    fetch_cpu(store, stale_cpu(store, list(instances.keys()), now_time), instances, now_time)
+    return store
+
+# one invocation of the CLI, either standalone or inside `serve`
+def run(options):
     keyfile = "~/.ssh/{}.pem".format(options.key)
+    backend.set_mode(options.backend, options.endpoint_url)
+    inventory.reset_stats()
 
     try:
         os.mkdir(options.data_dir)
     except OSError:
         pass
 
+    options.region = backend.resolve_regions(options.region, DEFAULT_REGION)
     if options.iid == None: options.iid = []
     if options.nametag == None: options.nametag = []
 
     try:
-        while True:
-            instances = get_instances(options.region)
-            filtered = filter_instances(instances, options)
+        if dashboard.wanted(options):
+            with tracing.span('dashboard', 'command'):
+                dashboard.run(options, lambda: select_instances(options),
+                              lambda instances: refresh_cpu(options, instances),
+                              lambda instances: terminate_and_forget(
+                                  options, group_by_region(instances.keys(), instances)))
+            return
 
-            if options.select != "":
-                parts = options.select.split(":")
-                lower, upper = int(parts[0]), int(parts[1])
-                filtered = select_dict(filtered, lower, upper)
+        while True:
+            if options.info_type in NO_INVENTORY:
+                with tracing.span(options.info_type, 'command'):
+                    choices[options.info_type](options, {}, keyfile)
+                break
 
-            choices[options.info_type](options, filtered, keyfile)
+            filtered = select_instances(options)
+            with tracing.span(options.info_type, 'command', items=len(filtered)):
+                choices[options.info_type](options, filtered, keyfile)
             if options.watch:
-                sleep(45)
+                if _plot is not None and _plot.live:
+                    _plot.wait(45)
+                else:
+                    sleep(45)
                 print()
             else:
                 break
     except KeyboardInterrupt:
         pass
+
+    if options.cache_stats:
+        inventory.report()
+
+if __name__ == "__main__":
+    options = make_parser().parse_args()
+    if options.info_type == "serve":
+        keep_warm()
+        daemon.serve(options.data_dir, make_parser, run)
+        exit(0)
+
+    # hand the command to `serve` if it's running, otherwise run it here
+    if not options.no_daemon and daemon.forwardable(options):
+        code = daemon.forward(options.data_dir, sys.argv[1:])
+        if code is not None:
+            exit(code)
+
+    if options.trace != None:
+        tracing.start(options.trace)
+    run(options)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Shared layer for talking to AWS. Calls go through one pooled boto3 client per
+# (service, region, endpoint) when boto3 is installed, and fall back to forking
+# the `aws` CLI otherwise. Responses come back in the same JSON shape the CLI prints, so
+# callers don't need to care which path was taken.
+
+import subprocess
+import json
+import os
+import threading
+from importlib.util import find_spec
+from datetime import datetime
+from time import sleep
+
+import tracing
+
+# boto3 takes a while to import, so it's only imported once a client is needed
+HAVE_BOTO3 = find_spec('boto3') is not None
+
+SDK = 'sdk'
+CLI = 'cli'
+
+MAX_ATTEMPTS = 5
+POOL_SIZE = 32
+
+# can be pointed at a local mock endpoint (e.g. `moto_server`)
+ENDPOINT_URL = os.environ.get('AWS_ENDPOINT_URL')
+
+mode = SDK if HAVE_BOTO3 else CLI
+
+_clients = {}
+_lock = threading.Lock()
+
+
+class AwsError(Exception):
+    def __init__(self, code, message):
+        super().__init__("{}: {}".format(code, message))
+        self.code = code
+        self.message = message
+
+
+def set_mode(new_mode, endpoint_url=None):
+    global mode, ENDPOINT_URL
+    if new_mode == SDK and not HAVE_BOTO3:
+        print("boto3 isn't installed, falling back to the aws cli")
+        new_mode = CLI
+    mode = new_mode
+    # reset every time, `serve` runs many commands in one process
+    ENDPOINT_URL = endpoint_url if endpoint_url is not None \
+        else os.environ.get('AWS_ENDPOINT_URL')
+
+def get_client(service, region):
+    key = (service, region, ENDPOINT_URL)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                config = Config(retries={'max_attempts': MAX_ATTEMPTS,
+                                         'mode': 'adaptive'},
+                                max_pool_connections=POOL_SIZE)
+                # clients are thread safe, sessions aren't
+                session = boto3.session.Session()
+                client = session.client(service, region_name=region,
+                                        endpoint_url=ENDPOINT_URL,
+                                        config=config)
+                _clients[key] = client
+    return client
+
+def _jsonify(obj):
+    if isinstance(obj, dict):
+        return {k: _jsonify(v) for k, v in obj.items() if k != 'ResponseMetadata'}
+    if isinstance(obj, list):
+        return [_jsonify(v) for v in obj]
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return obj
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("Can't serialize {}".format(type(obj)))
+
+def _call_sdk(service, op, region, params, stats):
+    from botocore.exceptions import ClientError
+    client = get_client(service, region)
+    try:
+        response = getattr(client, op)(**params)
+    except ClientError as e:
+        err = e.response.get('Error', {})
+        stats['retries'] = e.response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        raise AwsError(err.get('Code', 'Unknown'), err.get('Message', str(e)))
+    stats['retries'] = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    return _jsonify(response)
+
+def _call_cli(service, op, region, params, stats):
+    cmd = ['aws', service, op.replace('_', '-'),
+           '--region', region,
+           '--output', 'json']
+    if ENDPOINT_URL is not None:
+        cmd += ['--endpoint-url', ENDPOINT_URL]
+    if params:
+        cmd += ['--cli-input-json', json.dumps(params, default=_json_default)]
+
+    for attempt in range(MAX_ATTEMPTS):
+        stats['retries'] = attempt
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stats['bytes'] = len(proc.stdout)
+        if proc.returncode == 0:
+            return json.loads(proc.stdout) if proc.stdout.strip() else {}
+        err = str(proc.stderr, 'utf-8')
+        if 'Throttl' not in err and 'RequestLimitExceeded' not in err:
+            break
+        sleep(2 ** attempt * 0.1)
+
+    code = 'Unknown'
+    if '(' in err and ')' in err:
+        code = err[err.index('(')+1:err.index(')')]
+    raise AwsError(code, err.strip())
+
+# number of entries in the first list of a response, e.g. MetricDataResults
+def _items(response):
+    if 'Reservations' in response:
+        return sum(len(r['Instances']) for r in response['Reservations'])
+    for v in response.values():
+        if isinstance(v, list):
+            return len(v)
+    return 0
+
+def call(service, op, region, **params):
+    with tracing.span(op, 'aws', service=service, region=region) as stats:
+        if mode == SDK:
+            response = _call_sdk(service, op, region, params, stats)
+        else:
+            response = _call_cli(service, op, region, params, stats)
+        if tracing.enabled:
+            stats['items'] = _items(response)
+        return response
+
+# yields every page of `op`, following NextToken until it runs out
+def paginate(service, op, region, **params):
+    while True:
+        page = call(service, op, region, **params)
+        yield page
+        token = page.get('NextToken')
+        if not token:
+            break
+        params['NextToken'] = token
+
+# expands 'all' into every region enabled for the account
+def resolve_regions(regions, default_region):
+    if 'all' not in regions:
+        return regions
+    output = call('ec2', 'describe_regions', default_region)
+    return sorted(r['RegionName'] for r in output['Regions'])
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# Times aws.py and aws-spot.py end to end against the fake backend for a few
+# fleet sizes, counts the AWS calls each step makes and compares both against
+# bench/baseline.json. Exits with 1 if anything regressed.
+#
+#   ./bench/bench_aws.py                   # compare against the baseline
+#   ./bench/bench_aws.py --save-baseline   # record a new one
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import aws
+from fake_backend import FakeAWS
+
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+REGION = 'us-west-1'
+
+
+def load_spot():
+    spec = importlib.util.spec_from_file_location('aws_spot', str(ROOT / 'aws-spot.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_options(data_dir, *args):
+    options = aws.make_parser().parse_args(list(args) + ['--data-dir', data_dir])
+    options.region = [REGION]
+    options.iid = options.iid or []
+    options.nametag = options.nametag or []
+    return options
+
+# runs every step once for `n` instances, returns {step: {seconds, calls}}
+def run(n, latency):
+    fake = FakeAWS(n, latency).install()
+    spot = load_spot()
+    data_dir = tempfile.mkdtemp()
+    res = {}
+
+    def step(name, f, *args):
+        fake.reset_calls()
+        start = perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            out = f(*args)
+        res[name] = {'seconds': round(perf_counter() - start, 4), 'calls': sum(fake.calls.values())}
+        return out
+
+    try:
+        instances = step('get_instances', aws.get_instances, REGION)
+        for inst in instances.values():
+            inst['Region'] = REGION
+
+        options = make_options(data_dir, 'info', '--tag', 'Name=client1*', '--in-state', 'running')
+        selected = step('filter_instances', aws.filter_instances, instances, options)
+        step('load_instances (cold)', aws.load_instances, options)
+        step('load_instances (warm)', aws.load_instances, options)
+
+        options = make_options(data_dir, 'info', '--pub-ip', '--tags', '--state')
+        step('h_info', aws.h_info, options, instances, None)
+
+        options = make_options(data_dir, 'cpu')
+        step('h_cpu (cold)', aws.h_cpu, options, instances, None)
+        step('h_cpu (warm)', aws.h_cpu, options, instances, None)
+
+        spot_options = spot.make_parser().parse_args(['info-spot', '--config', str(ROOT / 'config.json')])
+        step('info_spot', spot.info_spot, spot_options)
+
+        options = make_options(data_dir, 'terminate')
+        step('h_terminate', aws.h_terminate, options, selected, None)
+    finally:
+        fake.uninstall()
+    return res
+
+# a step regresses if it makes more calls, or gets slower by more than
+# `tolerance` and at least 10ms
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, steps in results.items():
+        for name, r in steps.items():
+            b = baseline.get(size, {}).get(name)
+            if b is None:
+                continue
+            if r['calls'] > b['calls']:
+                regressions.append("{} @ {}: {} calls, was {}".format(name, size, r['calls'], b['calls']))
+            if r['seconds'] > b['seconds'] * (1 + tolerance) and r['seconds'] - b['seconds'] > 0.01:
+                regressions.append("{} @ {}: {:.3f}s, was {:.3f}s".format(name, size, r['seconds'], b['seconds']))
+    return regressions
+
+def make_parser():
+    descr = "Benchmarks aws.py and aws-spot.py against a simulated AWS backend."
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument("--sizes", action="store", nargs='+', type=int, default=[10, 1000, 50000])
+    parser.add_argument("--latency", action="store", type=float, default=0.02,
+                        help="seconds added to every call")
+    parser.add_argument("--tolerance", action="store", type=float, default=0.5,
+                        help="how much slower than the baseline a step can get")
+    parser.add_argument("--baseline", action="store", default=str(BASELINE))
+    parser.add_argument("--save-baseline", action="store_true")
+
+    return parser
+
+if __name__ == "__main__":
+    options = make_parser().parse_args()
+
+    baseline = {}
+    if Path(options.baseline).exists():
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for n in options.sizes:
+        results[str(n)] = run(n, options.latency)
+        print("{} instances, {:.0f}ms per call".format(n, options.latency * 1000))
+        print("{:24} {:>10} {:>8} {:>12}".format("step", "seconds", "calls", "baseline (s)"))
+        for name, r in results[str(n)].items():
+            b = baseline.get(str(n), {}).get(name, {}).get('seconds', float('nan'))
+            print("{:24} {:>10.3f} {:>8} {:>12.3f}".format(name, r['seconds'], r['calls'], b))
+        print()
+
+    if options.save_baseline:
+        baseline.update(results)
+        with open(options.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("Saved baseline to {}".format(options.baseline))
+    else:
+        regressions = compare(results, baseline, options.tolerance)
+        for r in regressions:
+            print("REGRESSION {}".format(r))
+        if len(regressions) > 0:
+            exit(1)
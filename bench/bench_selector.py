@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Times instance selection on a synthetic inventory, comparing the indexed
+# selector against the old list-scanning filter.
+
+import argparse
+import random
+import sys
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import selector
+from selector import parse_tags
+
+TYPES = ['c4.large', 'c4.xlarge', 'c5.large', 'c5.2xlarge', 't2.micro']
+STATES = ['running', 'running', 'running', 'stopped', 'pending']
+
+
+def make_inventory(n, seed=0):
+    rng = random.Random(seed)
+    res = {}
+    for i in range(n):
+        iid = 'i-{:017x}'.format(i)
+        name = 'scheduler' if i == 0 else 'client{}'.format(i % 1000)
+        res[iid] = {'InstanceId': iid,
+                    'InstanceType': rng.choice(TYPES),
+                    'State': {'Name': rng.choice(STATES)},
+                    'LaunchTime': '2026-10-{:02d}T{:02d}:00:00+00:00'.format(
+                        rng.randint(1, 28), rng.randint(0, 23)),
+                    'Tags': [{'Key': 'Name', 'Value': name},
+                             {'Key': 'experiment', 'Value': 'exp{}'.format(i % 7)}]}
+    return res
+
+# the filter_instances/select_dict pair aws.py used to have
+def old_filter(instances, options):
+    valid_iids = []
+    for iid in options.iid:
+        valid_iids.append(iid)
+
+    for name in options.nametag:
+        for iid, v in instances.items():
+            tags = parse_tags(v)
+            if 'Name' in parse_tags(v):
+                if tags['Name'] == name:
+                    valid_iids.append(iid)
+
+    if len(options.iid) > 0 or len(options.nametag) > 0:
+        if options.inverse:
+            return {iid: data for iid, data in instances.items() if not iid in valid_iids}
+        else:
+            return {iid: data for iid, data in instances.items() if iid in valid_iids}
+    else:
+        return instances
+
+def old_select_dict(d, a, b):
+    allowed = list(d.keys())[a:b]
+    return {k: v for k, v in d.items() if k in allowed}
+
+def make_options(**kwargs):
+    defaults = {'iid': [], 'nametag': [], 'inverse': False, 'tag': [],
+                'tag_regex': [], 'instance_type': [], 'in_state': [],
+                'launched_after': None, 'launched_before': None}
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+def timed(f, *args):
+    start = perf_counter()
+    res = f(*args)
+    return res, perf_counter() - start
+
+def make_parser():
+    descr = "Benchmarks instance selection on a synthetic inventory."
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument("--count", action="store", type=int, default=50000)
+    parser.add_argument("--skip-old", action="store_true")
+
+    return parser
+
+if __name__ == "__main__":
+    options = make_parser().parse_args()
+    instances = make_inventory(options.count)
+
+    _, t = timed(selector.get_index, instances)
+    print("Index build ({} instances): {:.3f}s".format(options.count, t))
+
+    cases = [
+        ("--nametag scheduler", make_options(nametag=['scheduler'])),
+        ("--nametag scheduler -i", make_options(nametag=['scheduler'], inverse=True)),
+        ("--nametag client1..client20", make_options(nametag=['client{}'.format(i) for i in range(1, 21)])),
+        ("--iid x100", make_options(iid=list(instances.keys())[::options.count // 100])),
+        ("--tag Name=client1* --in-state running", make_options(tag=['Name=client1*'], in_state=['running'])),
+        ("--tag-regex experiment=exp[0-2]", make_options(tag_regex=['experiment=exp[0-2]'])),
+        ("--launched-after 2026-10-20", make_options(launched_after='2026-10-20')),
+    ]
+
+    print("{:45} {:>10} {:>10} {:>8}".format("selector", "old (s)", "new (s)", "matched"))
+    for label, opts in cases:
+        new, t_new = timed(selector.select, instances, opts)
+        t_old = float('nan')
+        if not options.skip_old and opts.tag == [] and opts.tag_regex == [] \
+           and opts.in_state == [] and opts.launched_after is None:
+            old, t_old = timed(old_filter, instances, opts)
+            assert list(old.keys()) == list(new.keys())
+        print("{:45} {:>10.4f} {:>10.4f} {:>8}".format(label, t_old, t_new, len(new)))
+
+    half = len(instances) // 2
+    _, t_old = timed(old_select_dict, instances, 0, half) if not options.skip_old else (None, float('nan'))
+    _, t_new = timed(lambda d, a, b: dict(list(d.items())[a:b]), instances, 0, half)
+    print("{:45} {:>10.4f} {:>10.4f} {:>8}".format("--select 0:{}".format(half), t_old, t_new, half))
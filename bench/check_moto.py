@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Runs aws.py info, cpu and terminate against moto's mock AWS endpoint, once
+# per backend, and checks the results against what moto holds. Prints the
+# time each step took with `--backend cli` (a forked `aws` per call) and
+# `--backend sdk` (pooled boto3 clients). The cli backend is skipped when the
+# `aws` CLI isn't on the PATH.
+#
+#   ./bench/check_moto.py --instances 50
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aws
+import backend
+import inventory
+
+REGION = 'us-west-1'
+
+
+def start_moto(port):
+    import logging
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # moto accepts any credentials, but boto3 and the CLI want some
+    for k in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ[k] = 'testing'
+    os.environ.pop('AWS_PROFILE', None)
+    server = ThreadedMotoServer(port=port, verbose=False)
+    server.start()
+    return server, 'http://127.0.0.1:{}'.format(port)
+
+# `n` running instances with an hour of 5 minute CPU points each
+def seed(endpoint, n):
+    import boto3
+    import requests
+    requests.post('{}/moto-api/reset'.format(endpoint))
+    ec2 = boto3.client('ec2', region_name=REGION, endpoint_url=endpoint)
+    image = ec2.describe_images()['Images'][0]['ImageId']
+    iids = [inst['InstanceId'] for inst in
+            ec2.run_instances(ImageId=image, MinCount=n, MaxCount=n,
+                              InstanceType='t2.micro')['Instances']]
+    for i, iid in enumerate(iids):
+        ec2.create_tags(Resources=[iid], Tags=[{'Key': 'Name', 'Value': 'client{}'.format(i)}])
+
+    cloudwatch = boto3.client('cloudwatch', region_name=REGION, endpoint_url=endpoint)
+    now = datetime.utcnow()
+    for i, iid in enumerate(iids):
+        cloudwatch.put_metric_data(Namespace='AWS/EC2', MetricData=[{
+            'MetricName': 'CPUUtilization',
+            'Dimensions': [{'Name': 'InstanceId', 'Value': iid}],
+            'Timestamp': now - timedelta(minutes=5 * k),
+            'Value': float((i * 7 + k) % 100)} for k in range(12)])
+    return ec2, iids
+
+def states(ec2, iids):
+    return {inst['InstanceId']: inst['State']['Name']
+            for r in ec2.describe_instances(InstanceIds=iids)['Reservations']
+            for inst in r['Instances']}
+
+def run(*args):
+    options = aws.make_parser().parse_args(list(args))
+    out = io.StringIO()
+    start = perf_counter()
+    with contextlib.redirect_stdout(out):
+        aws.run(options)
+    return perf_counter() - start, out.getvalue()
+
+def check(name, ok, output=''):
+    if not ok:
+        print("{} FAILED".format(name))
+        print(output)
+        sys.exit(1)
+
+# runs every step with `mode`, returns {step: seconds}
+def steps(mode, endpoint, n):
+    ec2, iids = seed(endpoint, n)
+    data_dir = tempfile.mkdtemp()
+    common = ['--backend', mode, '--endpoint-url', endpoint, '--region', REGION,
+              '--data-dir', data_dir, '--no-daemon']
+    res = {}
+    try:
+        res['info (cold)'], out = run('info', *common)
+        check("info lists every instance", all(iid in out for iid in iids), out)
+        res['info (cached)'], out = run('info', *common)
+        check("cached info lists every instance", all(iid in out for iid in iids), out)
+
+        res['cpu'], out = run('cpu', *common)
+        check("cpu fetches every instance", "Fetching {}/{}".format(n, n) in out, out)
+        check("cpu decides on every instance", out.count('[keep]') == n, out)
+
+        half = iids[:n // 2]
+        res['terminate'], out = run('terminate', '--iid', *half, *common)
+        check("terminate reports every instance", out.count("Terminating") == len(half), out)
+        gone = states(ec2, half)
+        check("terminated in moto", all(s in ('shutting-down', 'terminated') for s in gone.values()),
+              gone)
+        _, out = run('info', *common)
+        check("terminated instances are forgotten",
+              not any(iid in out for iid in half) and all(iid in out for iid in iids[n // 2:]), out)
+    finally:
+        shutil.rmtree(data_dir)
+        # in-process caches would carry over to the next backend
+        inventory._memory.clear()
+        aws._stores = None
+    return res
+
+def make_parser():
+    descr = "Checks aws.py against moto and times the cli and sdk backends."
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument("--instances", action="store", type=int, default=50)
+    parser.add_argument("--port", action="store", type=int, default=5123)
+    parser.add_argument("--backends", action="store", nargs='+', default=[backend.CLI, backend.SDK],
+                        choices=[backend.CLI, backend.SDK])
+
+    return parser
+
+if __name__ == "__main__":
+    options = make_parser().parse_args()
+    modes = options.backends
+    if backend.CLI in modes and shutil.which('aws') is None:
+        print("No aws CLI on the PATH, skipping --backend cli")
+        modes = [m for m in modes if m != backend.CLI]
+
+    server, endpoint = start_moto(options.port)
+    try:
+        results = {mode: steps(mode, endpoint, options.instances) for mode in modes}
+    finally:
+        server.stop()
+
+    print("All checks passed against moto with {} instances".format(options.instances))
+    print("{:<16}".format('step') + ''.join("{:>10}".format(m) for m in modes))
+    for name in results[modes[0]]:
+        print("{:<16}".format(name) + ''.join("{:>9.2f}s".format(results[m][name]) for m in modes))
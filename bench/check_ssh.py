@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Runs aws.py exec, push and pull against a few fake hosts on loopback
+# addresses (see fake_sshd.py) and checks what they report: the exit code
+# summary of exec, that a second push skips files that are already there,
+# that an interrupted upload resumes from its .part file (and starts over when
+# the .part doesn't match), that --relay
+# hands the files on between hosts and that pull brings them back.
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import paramiko
+
+import aws
+import transfer
+from fake_sshd import FakeSSHD
+from sshpool import SSHPool
+
+# exit code of `--cmd` on each reachable host, None for a host nobody answers on
+CODES = [0, 0, 3, 0, None]
+
+
+def make_options(data_dir, *args):
+    options = aws.make_parser().parse_args(list(args) + ['--data-dir', data_dir])
+    options.region = ['us-west-1']
+    return options
+
+def capture(f, *args):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        f(*args)
+    return out.getvalue()
+
+def digest(path):
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+def check(name, ok, output=''):
+    print("{:<40} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        print(output)
+        sys.exit(1)
+
+def make_parser():
+    descr = "Checks aws.py exec/push/pull against in-process SSH servers."
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument("--port", action="store", type=int, default=2222)
+    parser.add_argument("--relay-port", action="store", type=int, default=8765)
+    parser.add_argument("--size", action="store", type=int, default=4 << 20,
+                        help="bytes in the big pushed file")
+
+    return parser
+
+if __name__ == "__main__":
+    options = make_parser().parse_args()
+    tmp = Path(tempfile.mkdtemp())
+    ips = ['127.0.0.{}'.format(i + 2) for i in range(len(CODES))]
+    homes = {}
+    for ip, code in zip(ips, CODES):
+        if code is not None:
+            homes[ip] = str(tmp / ip)
+            os.makedirs(homes[ip])
+            Path(homes[ip], 'code').write_text(str(code))
+    sshd = FakeSSHD(homes, options.port)
+
+    keyfile = str(tmp / 'key.pem')
+    paramiko.RSAKey.generate(2048).write_private_key_file(keyfile)
+    # what `serve` does, so the handlers pick up a pool on our port
+    aws._pools = {keyfile: SSHPool(keyfile, port=options.port, timeout=2)}
+    instances = {'i-{:017x}'.format(i): {'InstanceId': 'i-{:017x}'.format(i),
+                                         'PublicIpAddress': ip, 'PrivateIpAddress': ip,
+                                         'Tags': [{'Key': 'Name', 'Value': 'host{}'.format(i)}]}
+                 for i, ip in enumerate(ips)}
+    reachable = {iid: inst for iid, inst in instances.items()
+                 if inst['PublicIpAddress'] in homes}
+
+    # exec: one line per exit code, unreachable hosts counted apart
+    out = capture(aws.h_exec, make_options(str(tmp), 'exec', '--cmd', 'exit $(cat code)'),
+                  instances, keyfile)
+    codes = [c for c in CODES if c is not None]
+    check("exec exit code summary",
+          " [-] exit 0 : {}".format(codes.count(0)) in out
+          and " [-] exit 3 : {}".format(codes.count(3)) in out
+          and " [-] unreachable : {}".format(CODES.count(None)) in out, out)
+
+    src = tmp / 'payload'
+    src.mkdir()
+    (src / 'small.txt').write_text("hello\n")
+    # a space in the path, for the shell commands --relay runs
+    (src / 'sub dir').mkdir()
+    (src / 'sub dir' / 'big.bin').write_bytes(os.urandom(options.size))
+    files = ['payload/small.txt', 'payload/sub dir/big.bin']
+    push = make_options(str(tmp), 'push', '--path', str(src), '-r')
+
+    out = capture(aws.h_push, push, reachable, keyfile)
+    check("push copies every file",
+          all(digest(Path(homes[ip], f)) == digest(tmp / f) for ip in homes for f in files), out)
+    out = capture(aws.h_push, push, reachable, keyfile)
+    check("second push skips them", out.count("up to date") == len(files) * len(homes), out)
+
+    # an upload cut off halfway leaves a .part behind, only the rest is sent
+    ip = ips[0]
+    big = Path(homes[ip], files[1])
+    half = options.size // 2
+    Path('{}.part'.format(big)).write_bytes(big.read_bytes()[:half])
+    big.unlink()
+    sent = transfer.upload(aws._pools[keyfile], ip, tmp / files[1], files[1])
+    check("upload resumes from .part",
+          sent == options.size - half and digest(big) == digest(tmp / files[1]),
+          "sent {} bytes".format(sent))
+
+    # a .part with other bytes in it is not resumed from
+    Path('{}.part'.format(big)).write_bytes(os.urandom(half))
+    big.unlink()
+    sent = transfer.upload(aws._pools[keyfile], ip, tmp / files[1], files[1])
+    check("upload restarts a mismatched .part",
+          sent == options.size and digest(big) == digest(tmp / files[1]),
+          "sent {} bytes".format(sent))
+
+    # same for downloads
+    local = tmp / 'download.bin'
+    Path('{}.part'.format(local)).write_bytes(big.read_bytes()[:half])
+    got = transfer.download(aws._pools[keyfile], ip, files[1], local)
+    check("download resumes from .part",
+          got == options.size - half and digest(local) == digest(big), "got {} bytes".format(got))
+    local.unlink()
+    Path('{}.part'.format(local)).write_bytes(os.urandom(half))
+    got = transfer.download(aws._pools[keyfile], ip, files[1], local)
+    check("download restarts a mismatched .part",
+          got == options.size and digest(local) == digest(big), "got {} bytes".format(got))
+
+    # --relay: the first host gets the files over sftp, the rest over http from it
+    for home in homes.values():
+        for f in files:
+            Path(home, f).unlink()
+    relay = make_options(str(tmp), 'push', '--path', str(src), '-r', '--relay', '1',
+                         '--relay-port', str(options.relay_port))
+    out = capture(aws.h_push, relay, reachable, keyfile)
+    check("relay reaches every host",
+          out.count("relayed from") == len(files) * (len(homes) - 1)
+          and all(digest(Path(homes[ip], f)) == digest(tmp / f) for ip in homes for f in files),
+          out)
+    check("relay staging dirs are cleaned up",
+          not any(Path(home, transfer.staging_dir(options.relay_port)).exists()
+                  for home in homes.values()))
+
+    pulled = tmp / 'pulled'
+    pull = make_options(str(tmp), 'pull', '--path', files[1], '--dest', str(pulled))
+    out = capture(aws.h_pull, pull, reachable, keyfile)
+    got = sorted(pulled.rglob('big.bin'))
+    check("pull brings back a copy per host",
+          len(got) == len(homes) and all(digest(p) == digest(tmp / files[1]) for p in got), out)
+
+    aws._pools[keyfile].close()
+    sshd.stop()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Deterministic stand-in for AWS. `FakeAWS(n).install()` takes the place of the
+# boto3 path in backend, so everything above it (call, paginate, inventory,
+# aws.py, aws-spot.py) runs unchanged against `n` synthetic instances spread
+# over spot fleets of FLEET_SIZE. Every call sleeps `latency` seconds and is
+# counted per operation.
+
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+from time import sleep
+
+import numpy as np
+
+import backend
+
+TYPES = ['c4.large', 'c4.xlarge', 'c5.large', 'c5.2xlarge', 't2.micro']
+ZONES = ['us-west-1a', 'us-west-1b']
+STATES = ['running', 'running', 'running', 'stopped', 'pending']
+
+PAGE_SIZE = 1000
+FLEET_SIZE = 100
+LAUNCHED = datetime(2026, 10, 1, tzinfo=timezone.utc)
+
+
+def iid_of(i):
+    return 'i-{:017x}'.format(i)
+
+def parse_iso(s):
+    dt = datetime.fromisoformat(str(s).replace('Z', '+00:00'))
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc)
+
+
+class FakeAWS:
+    def __init__(self, n, latency=0.0, seed=0):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        rng = np.random.RandomState(seed)
+
+        types = rng.randint(len(TYPES), size=n)
+        zones = rng.randint(len(ZONES), size=n)
+        states = rng.randint(len(STATES), size=n)
+        hours = rng.randint(24 * 14, size=n)
+        self.instances = {}
+        for i in range(n):
+            iid = iid_of(i)
+            name = 'scheduler' if i == 0 else 'client{}'.format(i)
+            self.instances[iid] = {
+                'InstanceId': iid,
+                'InstanceType': TYPES[types[i]],
+                'State': {'Name': STATES[states[i]]},
+                'LaunchTime': (LAUNCHED + timedelta(hours=int(hours[i]))).isoformat(),
+                'Placement': {'AvailabilityZone': ZONES[zones[i]]},
+                'SubnetId': 'subnet-{:08x}'.format(zones[i]),
+                'PrivateIpAddress': '10.{}.{}.{}'.format(i >> 16, (i >> 8) & 255, i & 255),
+                'PublicIpAddress': '54.{}.{}.{}'.format(i >> 16, (i >> 8) & 255, i & 255),
+                'Tags': [{'Key': 'Name', 'Value': name},
+                         {'Key': 'experiment', 'Value': 'exp{}'.format(i % 7)}]}
+        self.order = list(self.instances.keys())
+        # each instance idles at its own level
+        self.base_cpu = dict(zip(self.order, rng.uniform(0, 100, size=n)))
+
+        self.fleets = {}
+        for f, b in enumerate(range(1, n, FLEET_SIZE)):
+            self.fleets['sfr-{:08x}'.format(f)] = self.order[b:b+FLEET_SIZE]
+
+    def install(self):
+        self.saved = (backend.mode, backend._call_sdk)
+        backend.mode = backend.SDK
+        backend._call_sdk = lambda service, op, region, params, stats: \
+            self.call(service, op, region, **params)
+        return self
+
+    def uninstall(self):
+        backend.mode, backend._call_sdk = self.saved
+
+    def reset_calls(self):
+        self.calls = Counter()
+
+    def call(self, service, op, region, **params):
+        with self.lock:
+            self.calls[op] += 1
+        if self.latency > 0:
+            sleep(self.latency)
+        handler = getattr(self, op, None)
+        if handler is None:
+            raise backend.AwsError('InvalidAction', "{} isn't faked".format(op))
+        return handler(**params)
+
+    def page(self, items, key, token):
+        offset = int(token or 0)
+        res = {key: items[offset:offset+PAGE_SIZE]}
+        if offset + PAGE_SIZE < len(items):
+            res['NextToken'] = str(offset + PAGE_SIZE)
+        return res
+
+    def matches(self, inst, f):
+        name, values = f['Name'], f['Values']
+        if name == 'instance-id':
+            return inst['InstanceId'] in values
+        if name == 'instance-type':
+            return inst['InstanceType'] in values
+        if name == 'instance-state-name':
+            return inst['State']['Name'] in values
+        if name.startswith('tag:'):
+            tags = {t['Key']: t['Value'] for t in inst['Tags']}
+            key = name[4:]
+            return key in tags and any(fnmatchcase(tags[key], v) for v in values)
+        raise backend.AwsError('InvalidParameterValue', "filter {} isn't faked".format(name))
+
+    def describe_instances(self, Filters=(), InstanceIds=None, NextToken=None, **params):
+        iids = self.order if InstanceIds is None else InstanceIds
+        found = [self.instances[iid] for iid in iids if iid in self.instances]
+        found = [inst for inst in found if all(self.matches(inst, f) for f in Filters)]
+        res = self.page(found, 'Instances', NextToken)
+        res['Reservations'] = [{'Instances': res.pop('Instances')}]
+        return res
+
+    def terminate_instances(self, InstanceIds, DryRun=False):
+        missing = [iid for iid in InstanceIds if iid not in self.instances]
+        if len(missing) > 0:
+            raise backend.AwsError('InvalidInstanceID.NotFound', ' '.join(missing))
+        if DryRun:
+            raise backend.AwsError('DryRunOperation', 'Request would have succeeded')
+        res = []
+        for iid in InstanceIds:
+            state = self.instances[iid]['State']
+            res.append({'InstanceId': iid, 'PreviousState': dict(state),
+                        'CurrentState': {'Name': 'shutting-down'}})
+            state['Name'] = 'terminated'
+        return {'TerminatingInstances': res}
+
+    # one point every 5 minutes, wobbling around the instance's base level
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, **params):
+        start, end = parse_iso(StartTime), parse_iso(EndTime)
+        steps = int((end - start).total_seconds() // 300)
+        times = [(start + timedelta(minutes=5 * k)).isoformat() for k in range(steps)]
+        wobble = 10 * np.sin(np.arange(steps) / 12.0)
+
+        results = []
+        for q in MetricDataQueries:
+            iid = q['MetricStat']['Metric']['Dimensions'][0]['Value']
+            values = np.clip(self.base_cpu.get(iid, 0) + wobble, 0, 100)
+            results.append({'Id': q['Id'], 'Label': 'CPUUtilization',
+                            'Timestamps': times, 'Values': values.tolist(),
+                            'StatusCode': 'Complete'})
+        return {'MetricDataResults': results}
+
+    def describe_spot_fleet_requests(self, NextToken=None, **params):
+        configs = [{'SpotFleetRequestId': sfr, 'SpotFleetRequestState': 'active',
+                    'SpotFleetRequestConfig': {'TargetCapacity': 2 * FLEET_SIZE}}
+                   for sfr in self.fleets]
+        return self.page(configs, 'SpotFleetRequestConfigs', NextToken)
+
+    def describe_spot_fleet_instances(self, SpotFleetRequestId, NextToken=None, **params):
+        active = [{'InstanceId': iid, 'InstanceType': self.instances[iid]['InstanceType'],
+                   'SpotInstanceRequestId': 'sir-{}'.format(iid[2:])}
+                  for iid in self.fleets[SpotFleetRequestId]]
+        res = self.page(active, 'ActiveInstances', NextToken)
+        res['SpotFleetRequestId'] = SpotFleetRequestId
+        return res
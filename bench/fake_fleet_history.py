@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Drives the fleet history tracker with a simulated `maintain` fleet whose
+# instance types get interrupted at known rates, then checks the rates and
+# replacement latency it recovers and that a second sync fetches nothing new.
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import fleethistory
+
+# interruptions per instance-hour
+RATES = {'c4.large': 0.02, 'c4.xlarge': 0.05, 'c5.large': 0.01, 'c3.large': 0.2}
+ZONES = ['us-west-1a', 'us-west-1b']
+
+
+# A fleet that keeps `size` instances up. Interrupted instances are replaced
+# after `replace` seconds. Serves describe-spot-fleet-request-history pages of
+# `page_size` records.
+class FakeHistory:
+    def __init__(self, sfr, size, start, end, replace=90, page_size=1000, seed=0):
+        self.sfr = sfr
+        self.page_size = page_size
+        self.calls = 0
+        self.records = []
+        rng = random.Random(seed)
+        n = 0
+
+        def launch(t):
+            nonlocal n
+            n += 1
+            iid = 'i-{:017x}'.format(n)
+            instance_type = rng.choice(sorted(RATES))
+            self.add(t, 'instanceChange', 'launched', iid, json.dumps({
+                'instanceType': instance_type, 'image': 'ami-5d2dcf3e',
+                'productDescription': 'Linux/UNIX', 'availabilityZone': rng.choice(ZONES)}))
+            life = rng.expovariate(RATES[instance_type])
+            return t + timedelta(hours=life), iid
+
+        self.add(start, 'fleetRequestChange', 'active')
+        running = [launch(start) for _ in range(size)]
+        while len(running) > 0:
+            running.sort()
+            t, iid = running.pop(0)
+            if t >= end:
+                continue
+            self.add(t, 'instanceChange', 'terminated', iid)
+            running.append(launch(t + timedelta(seconds=replace)))
+        self.records.sort(key=lambda r: r['Timestamp'])
+
+    def add(self, t, kind, sub, iid=None, desc=None):
+        info = {'EventSubType': sub}
+        if iid is not None:
+            info['InstanceId'] = iid
+        if desc is not None:
+            info['EventDescription'] = desc
+        self.records.append({'EventType': kind, 'Timestamp': t, 'EventInformation': info})
+
+    # only what has happened by `now` is visible
+    def source(self, now):
+        def page(sfr, start, token):
+            self.calls += 1
+            visible = [r for r in self.records if start <= r['Timestamp'] <= now]
+            offset = int(token or 0)
+            res = {'HistoryRecords': visible[offset:offset+self.page_size],
+                   'LastEvaluatedTime': now, 'StartTime': start}
+            if offset + self.page_size < len(visible):
+                res['NextToken'] = str(offset + self.page_size)
+            return res
+        return page
+
+def make_parser():
+    descr = "Checks the fleet history tracker against a simulated fleet."
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument("--size", action="store", type=int, default=100)
+    parser.add_argument("--days", action="store", type=int, default=14)
+
+    return parser
+
+if __name__ == "__main__":
+    options = make_parser().parse_args()
+    end = datetime(2026, 10, 1)
+    start = end - timedelta(days=options.days)
+    fake = FakeHistory('sfr-fake', options.size, start, end)
+    log = fleethistory.HistoryLog(tempfile.mkdtemp())
+
+    # half of the history, then the rest from the cursor
+    middle = start + (end - start) / 2
+    t = perf_counter()
+    first = fleethistory.sync(log, ['sfr-fake'], fake.source(middle), now=middle)
+    second = fleethistory.sync(log, ['sfr-fake'], fake.source(end), now=end)
+    again = fleethistory.sync(log, ['sfr-fake'], fake.source(end), now=end)
+    print("Synced {} + {} + {} events in {} pages, {:.3f}s, {} bytes on disk".format(
+        first['sfr-fake'], second['sfr-fake'], again['sfr-fake'], fake.calls,
+        perf_counter() - t, log.data_path.stat().st_size))
+    assert first['sfr-fake'] + second['sfr-fake'] == len(fake.records)
+    assert again['sfr-fake'] == 0
+
+    lives = fleethistory.lifetimes(fleethistory.HistoryLog(log.path).events(), now=end)
+    by_type = fleethistory.rates(lives, 'type')
+    print("{:<12} {:>10} {:>10} {:>14}".format('type', 'expected', 'measured', 'replaced after'))
+    for instance_type, r in by_type.iterrows():
+        print("{:<12} {:>10.3f} {:>10.3f} {:>13.0f}s".format(
+            instance_type, RATES[instance_type], r['rate'], r['replaced_after']))
+    print(fleethistory.rates(lives, 'zone')[['hours', 'interruptions', 'rate']])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# In-process SSH/SFTP server standing in for a fleet. `FakeSSHD(homes, port)`
+# listens on every loopback address in `homes` ({ip: directory}, e.g.
+# 127.0.0.2), accepts any key, runs exec requests with `sh` in that host's
+# home directory and serves SFTP rooted there, so sshpool, transfer and the
+# aws.py exec/push/pull handlers run unchanged against several "hosts".
+
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, SFTP_OK
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, home):
+        self.home = home
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()),
+                         daemon=True).start()
+        return True
+
+    def _exec(self, channel, command):
+        proc = subprocess.Popen(command, shell=True, cwd=self.home,
+                                env=dict(os.environ, HOME=self.home),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+
+        def feed():
+            for data in iter(lambda: channel.recv(1 << 16), b''):
+                proc.stdin.write(data)
+            proc.stdin.close()
+        threading.Thread(target=feed, daemon=True).start()
+
+        for data in iter(lambda: proc.stdout.read1(1 << 16), b''):
+            channel.sendall(data)
+        channel.send_exit_status(proc.wait())
+        channel.close()
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _SFTP(SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.home = server.home
+
+    def _path(self, path):
+        if path.startswith(self.home):
+            return path
+        return os.path.join(self.home, path.lstrip('/'))
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            res = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                res.append(attr)
+            return res
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def _do(self, f, *args):
+        try:
+            f(*args)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        return self._do(os.remove, self._path(path))
+
+    def rename(self, old, new):
+        return self._do(os.replace, self._path(old), self._path(new))
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        return self._do(os.mkdir, self._path(path))
+
+    def rmdir(self, path):
+        return self._do(os.rmdir, self._path(path))
+
+    def canonicalize(self, path):
+        return self._path(path)
+
+
+class FakeSSHD:
+    def __init__(self, homes, port=2222):
+        self.homes = homes
+        self.port = port
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sockets = []
+        for ip in homes:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, port))
+            sock.listen(64)
+            self.sockets.append(sock)
+            threading.Thread(target=self._accept, args=(sock, homes[ip]), daemon=True).start()
+
+    def _accept(self, sock, home):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn, home), daemon=True).start()
+
+    def _serve(self, conn, home):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', SFTPServer, _SFTP)
+        try:
+            transport.start_server(server=_Server(home))
+        except (paramiko.SSHException, EOFError):
+            return
+        while transport.is_active():
+            transport.join(1)
+
+    def stop(self):
+        for sock in self.sockets:
+            sock.close()
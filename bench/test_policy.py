@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Checks the drop policy on the matrices `aws.py cpu` hands it in the corner
+# cases: nothing selected, nothing stored in the window, only gaps, and a
+# plain idle instance. Runs under pytest or on its own.
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import policy
+
+NOW = pd.Timestamp('2026-10-01 12:00')
+IIDS = ['i-0000000000000001', 'i-0000000000000002']
+
+
+def empty_matrix(iids=IIDS):
+    return pd.DataFrame(index=pd.DatetimeIndex([]), columns=iids, dtype=float)
+
+def nan_matrix(points=30):
+    index = pd.date_range(end=NOW, periods=points, freq=policy.PERIOD)
+    return pd.DataFrame(np.nan, index=index, columns=IIDS)
+
+def assert_no_data(res, iids=IIDS):
+    assert list(res.index) == iids
+    assert (res['decision'] == policy.KEEP).all()
+    assert (res['reason'] == 'not enough data in window').all()
+
+
+def test_evaluate_empty():
+    assert_no_data(policy.evaluate(policy.Policy(), empty_matrix(), {}, NOW))
+
+def test_evaluate_nothing_selected():
+    res = policy.evaluate(policy.Policy(), empty_matrix([]), {}, NOW)
+    assert len(res) == 0
+
+def test_evaluate_all_nan():
+    assert_no_data(policy.evaluate(policy.Policy(), nan_matrix(), {}, NOW))
+
+def test_evaluate_launch_time_without_points():
+    instances = {iid: {'LaunchTime': '2026-10-01T10:00:00.000Z'} for iid in IIDS}
+    res = policy.evaluate(policy.Policy(), empty_matrix(), instances, NOW)
+    assert_no_data(res)
+    assert (res['age'] == 120).all()
+
+def test_replay_empty():
+    assert len(policy.replay(policy.Policy(), empty_matrix(), {})) == 0
+
+def test_replay_all_nan():
+    assert len(policy.replay(policy.Policy(), nan_matrix(), {})) == 0
+
+def test_idle_instance_is_killed():
+    matrix = nan_matrix()
+    matrix[IIDS[0]] = 5.0
+    matrix[IIDS[1]] = 90.0
+    res = policy.evaluate(policy.Policy(), matrix, {}, NOW)
+    assert list(res['decision']) == [policy.KILL, policy.KEEP]
+    assert len(policy.replay(policy.Policy(), matrix, {})) == 1
+
+
+if __name__ == "__main__":
+    tests = [(name, f) for name, f in sorted(globals().items()) if name.startswith('test_')]
+    for name, f in tests:
+        f()
+        print("ok  {}".format(name))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# `aws.py serve` keeps one process running with pandas and boto3 imported, the
+# AWS clients, SSH connections, inventory and CPU store open, and answers
+# aws.py invocations over `<data-dir>/aws.sock`. The client sends one JSON line
+# {"argv": [...], "cwd": ..., "env": {...}} and gets back the command's output
+# as {"out": ...} / {"err": ...} lines, followed by {"exit": code}. Commands
+# are run one at a time. `env` holds the caller's AWS_* variables; when they
+# aren't the daemon's own (another profile, region or credentials) the daemon
+# answers {"local": reason} and the caller runs the command itself.
+
+import io
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from pathlib import Path
+
+SOCKET_NAME = 'aws.sock'
+
+
+def socket_path(data_dir):
+    return Path(data_dir, SOCKET_NAME)
+
+def aws_env(environ=None):
+    environ = os.environ if environ is None else environ
+    return {k: v for k, v in environ.items() if k.startswith('AWS_')}
+
+# anything that needs the terminal (ssh, prompts, windows, --watch loops) or
+# writes files at exit (--trace) runs in the calling process instead
+def forwardable(options):
+    return options.info_type not in ('connect', 'serve') \
+        and not (options.watch or options.graph or options.confirm) \
+        and options.trace is None
+
+def _connect(path):
+    if not path.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+# runs `argv` in the daemon and returns its exit code, or None if there's no
+# daemon listening on `data_dir` or it can't run the command for this caller
+def forward(data_dir, argv):
+    sock = _connect(socket_path(data_dir))
+    if sock is None:
+        return None
+    with sock:
+        request = {'argv': argv, 'cwd': os.getcwd(), 'env': aws_env()}
+        sock.sendall((json.dumps(request) + '\n').encode())
+        for line in sock.makefile('r'):
+            msg = json.loads(line)
+            if 'out' in msg:
+                sys.stdout.write(msg['out'])
+                sys.stdout.flush()
+            elif 'err' in msg:
+                sys.stderr.write(msg['err'])
+            elif 'exit' in msg:
+                return msg['exit']
+            elif 'local' in msg:
+                return None
+    # the command may have done something already, so it isn't rerun here
+    print("serve went away before the command finished", file=sys.stderr)
+    return 1
+
+
+class _Stream(io.TextIOBase):
+    def __init__(self, sock, key):
+        self.sock = sock
+        self.key = key
+        self.lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if len(s) > 0:
+            with self.lock:
+                self.sock.sendall((json.dumps({self.key: s}) + '\n').encode())
+        return len(s)
+
+def _exit_code(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+def handle(sock, make_parser, run):
+    request = json.loads(sock.makefile('r').readline())
+    if request.get('env') != aws_env():
+        sock.sendall((json.dumps({'local': "different AWS environment"}) + '\n').encode())
+        return
+    home = os.getcwd()
+    try:
+        os.chdir(request['cwd'])
+        with redirect_stdout(_Stream(sock, 'out')), redirect_stderr(_Stream(sock, 'err')):
+            try:
+                run(make_parser().parse_args(request['argv']))
+                code = 0
+            except SystemExit as e:
+                code = _exit_code(e)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+        sock.sendall((json.dumps({'exit': code}) + '\n').encode())
+    finally:
+        os.chdir(home)
+
+# `run(options)` runs one parsed command line, see aws.run
+def serve(data_dir, make_parser, run):
+    path = socket_path(data_dir)
+    Path(data_dir).mkdir(parents=True, exist_ok=True)
+    sock = _connect(path)
+    if sock is not None:
+        sock.close()
+        print("Already serving on {}".format(path))
+        return
+    if path.exists():
+        path.unlink()
+
+    # paid once here instead of by the first command
+    import pandas
+    import policy
+    import sshpool
+    import tsstore
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(path))
+    os.chmod(str(path), 0o600)
+    server.listen(16)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving on {}".format(path), flush=True)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    handle(conn, make_parser, run)
+                except (OSError, ValueError) as e:
+                    # the client hung up or sent garbage
+                    print("Dropped a request: {}".format(e), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        path.unlink()
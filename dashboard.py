@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+# Live terminal view for `cpu --watch`. A background thread reloads the
+# instance list every --ttl seconds and the CPU store every --metrics-every
+# seconds and hands over only the instances whose data changed. It also runs
+# the terminations, so the screen never waits on AWS. The screen
+# keeps what it drew last and only rewrites rows whose text changed, and only
+# the visible rows are formatted, so it stays responsive with thousands of
+# instances.
+#
+#   up/down, pgup/pgdn  move         s  cycle sort (cpu, window, name)
+#   space               select       a  select all shown, c clears
+#   /                   filter       t  mark selected (or current) for terminate
+#   x                   terminate marked instances, after confirming
+#   q                   quit
+
+import math
+import sys
+import threading
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+from queue import Queue, Empty
+from time import monotonic
+
+from selector import parse_tags
+
+SORTS = ['cpu', 'window', 'name']
+SPARKS = ' ▁▂▃▄▅▆▇█'
+# 5 minute points shown in the sparkline
+SPARK_POINTS = 24
+# rows above the list: summary and column names
+HEADER = 2
+
+
+def wanted(options):
+    return options.info_type == 'cpu' and options.watch and sys.stdout.isatty() \
+        and not (options.graph or options.output or options.drop or options.backtest
+                 or options.no_dashboard)
+
+def sparkline(values):
+    chars = []
+    for v in values[-SPARK_POINTS:]:
+        if math.isnan(v):
+            chars.append(' ')
+        else:
+            chars.append(SPARKS[min(max(int(round(v / 100 * (len(SPARKS) - 1))), 0), len(SPARKS) - 1)])
+    return ''.join(chars)
+
+def mean(values):
+    present = [v for v in values if not math.isnan(v)]
+    return sum(present) / len(present) if present else math.nan
+
+def format_cpu(v):
+    return '     -' if math.isnan(v) else '{:6.1f}'.format(v)
+
+def matches(instance, iid, text):
+    if '=' in text:
+        key, pattern = text.split('=', 1)
+        value = parse_tags(instance).get(key)
+        return value is not None and fnmatchcase(value, pattern)
+    text = text.lower()
+    name = parse_tags(instance).get('Name', '')
+    return any(text in s.lower() for s in (iid, name, instance['InstanceType'],
+                                           instance['State']['Name']))
+
+
+class Row:
+    __slots__ = ('iid', 'instance', 'name', 'values', 'current', 'window', 'version')
+
+    def __init__(self, iid, instance):
+        self.iid = iid
+        self.name = ''
+        self.values = []
+        self.current = self.window = math.nan
+        self.version = 0
+        self.set_instance(instance)
+
+    def set_instance(self, instance):
+        self.instance = instance
+        self.name = parse_tags(instance).get('Name', '')
+        self.version += 1
+
+    def set_values(self, values, window_points):
+        self.values = values
+        self.current = values[-1] if values else math.nan
+        self.window = mean(values[-window_points:])
+        self.version += 1
+
+
+# `load()` returns the selected instances, `refresh(instances)` brings the CPU
+# store up to date and returns it and `kill(instances)` terminates them and
+# returns {iid: outcome}
+class Dashboard:
+    def __init__(self, options, load, refresh, kill):
+        self.load = load
+        self.refresh = refresh
+        self.kill = kill
+        self.inventory_every = options.ttl
+        self.metrics_every = options.metrics_every
+        self.window_points = max(options.window // 5, 1)
+        self.history = timedelta(minutes=max(options.window, SPARK_POINTS * 5))
+        self.dry_run = options.dry_run
+
+        self.rows = {}
+        self.selected = set()
+        self.marked = set()
+        self.filter = ''
+        self.sort = SORTS[0]
+        self.order = []
+        self.cursor = 0
+        self.top = 0
+        self.message = ''
+        self.loaded_at = self.fetched_at = None
+        # the order is only worked out again after new data or a key press
+        self.dirty = True
+
+        # what's on screen: one (text, attr) per line, and formatted rows by iid
+        self.drawn = []
+        self.texts = {}
+
+        self.updates = Queue()
+        # instances to terminate, handed to the worker
+        self.kills = Queue()
+        self.stopping = threading.Event()
+        # set to stop the worker's wait early
+        self.wake = threading.Event()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+
+    # runs in the background thread, the UI thread only sees what's queued
+    def _work(self):
+        instances = {}
+        last = {}
+        next_load = next_fetch = monotonic()
+        while not self.stopping.is_set():
+            try:
+                self._run_kills()
+                if monotonic() >= next_load:
+                    instances = self.load()
+                    self.updates.put(('instances', instances))
+                    next_load = monotonic() + self.inventory_every
+                    next_fetch = min(next_fetch, monotonic())
+                if monotonic() >= next_fetch:
+                    store = self.refresh(instances)
+                    start = datetime.utcnow() - self.history
+                    changed = {}
+                    for iid in instances:
+                        t = store.last_time(iid)
+                        if t != last.get(iid):
+                            last[iid] = t
+                            _, values = store.read(iid, start=start)
+                            changed[iid] = [float(v) for v in values]
+                    self.updates.put(('values', changed))
+                    next_fetch = monotonic() + self.metrics_every
+            except Exception as e:
+                self.updates.put(('error', str(e)))
+                next_load = max(next_load, monotonic() + 10)
+                next_fetch = max(next_fetch, monotonic() + 10)
+            self.wake.wait(max(min(next_load, next_fetch) - monotonic(), 0))
+            self.wake.clear()
+        # terminations asked for right before quitting still happen
+        self._run_kills()
+
+    def _run_kills(self):
+        while True:
+            try:
+                targets = self.kills.get_nowait()
+            except Empty:
+                return
+            try:
+                self.updates.put(('killed', (targets, self.kill(targets))))
+            finally:
+                self.kills.task_done()
+
+    # applies what the worker queued, returns whether the row order may have changed
+    def _apply(self):
+        changed = False
+        while True:
+            try:
+                kind, data = self.updates.get_nowait()
+            except Empty:
+                return changed
+            changed = True
+            if kind == 'instances':
+                for iid in list(self.rows):
+                    if iid not in data:
+                        del self.rows[iid]
+                        self.texts.pop(iid, None)
+                for iid, instance in data.items():
+                    if iid in self.rows:
+                        if self.rows[iid].instance is not instance:
+                            self.rows[iid].set_instance(instance)
+                    else:
+                        self.rows[iid] = Row(iid, instance)
+                self.selected &= set(self.rows)
+                self.marked &= set(self.rows)
+                self.loaded_at = monotonic()
+            elif kind == 'values':
+                for iid, values in data.items():
+                    if iid in self.rows:
+                        self.rows[iid].set_values(values, self.window_points)
+                self.fetched_at = monotonic()
+            elif kind == 'killed':
+                targets, outcomes = data
+                counts = {}
+                for iid in targets:
+                    outcome = outcomes.get(iid, 'no response')
+                    counts[outcome] = counts.get(outcome, 0) + 1
+                self.message = "terminated: " + ", ".join(
+                    "{} {}".format(n, o) for o, n in sorted(counts.items()))
+                # the next inventory load drops them
+                if not self.dry_run:
+                    for iid in targets:
+                        self.rows.pop(iid, None)
+                        self.texts.pop(iid, None)
+                    self.selected &= set(self.rows)
+                    self.marked &= set(self.rows)
+            else:
+                self.message = "error: {}".format(data)
+
+    def _arrange(self):
+        current = self.order[self.cursor] if self.cursor < len(self.order) else None
+        rows = self.rows.values()
+        if self.filter:
+            rows = [r for r in rows if matches(r.instance, r.iid, self.filter)]
+        attr = 'current' if self.sort == 'cpu' else 'window'
+
+        # busiest first, instances without data last
+        def busiest(r):
+            v = getattr(r, attr)
+            return (math.isnan(v), 0 if math.isnan(v) else -v, r.iid)
+
+        key = (lambda r: (r.name, r.iid)) if self.sort == 'name' else busiest
+        self.order = [r.iid for r in sorted(rows, key=key)]
+        # once moved, the cursor follows the instance it was on, and goes back
+        # to the top if that one is filtered out
+        if self.cursor > 0:
+            self.cursor = self.order.index(current) if current in self.order else 0
+
+    def _row_text(self, row):
+        key = (row.version, row.iid in self.selected, row.iid in self.marked)
+        cached = self.texts.get(row.iid)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        flags = ('T' if row.iid in self.marked else ' ') + ('*' if row.iid in self.selected else ' ')
+        text = "{} {:<20.20} {:<19} {:<11.11} {:<13.13} {} {} {}".format(
+            flags, row.name, row.iid, row.instance['InstanceType'],
+            row.instance['State']['Name'], format_cpu(row.current), format_cpu(row.window),
+            sparkline(row.values))
+        self.texts[row.iid] = (key, text)
+        return text
+
+    def _lines(self, height, curses):
+        def ago(t):
+            return '-' if t is None else '{:.0f}s ago'.format(monotonic() - t)
+        summary = "{} instances, {} shown | sort: {} | filter: {} | {} selected, {} marked | " \
+                  "inventory {}, metrics {}".format(
+                      len(self.rows), len(self.order), self.sort, self.filter or '-',
+                      len(self.selected), len(self.marked), ago(self.loaded_at), ago(self.fetched_at))
+        columns = "   {:<20} {:<19} {:<11} {:<13} {:>6} {:>6} {}".format(
+            'name', 'id', 'type', 'state', 'cpu', '{}m'.format(self.window_points * 5),
+            'last {}m'.format(SPARK_POINTS * 5))
+        lines = [(summary, curses.A_BOLD), (columns, curses.A_UNDERLINE)]
+
+        visible = height - HEADER - 1
+        if self.cursor < self.top:
+            self.top = self.cursor
+        elif self.cursor >= self.top + visible:
+            self.top = self.cursor - visible + 1
+        self.top = max(min(self.top, len(self.order) - visible), 0)
+        for i in range(self.top, min(self.top + visible, len(self.order))):
+            row = self.rows[self.order[i]]
+            attr = curses.A_REVERSE if i == self.cursor else curses.A_NORMAL
+            if row.iid in self.marked:
+                attr |= curses.color_pair(1)
+            lines.append((self._row_text(row), attr))
+        while len(lines) < height - 1:
+            lines.append(('', curses.A_NORMAL))
+
+        keys = "q quit  / filter  s sort  space select  a all  c clear  t mark  x terminate{}".format(
+            " (dry run)" if self.dry_run else "")
+        lines.append((self.message or keys, curses.A_BOLD if self.message else curses.A_DIM))
+        return lines
+
+    # only lines that differ from what's on screen are rewritten
+    def _draw(self, screen, curses):
+        height, width = screen.getmaxyx()
+        lines = self._lines(height, curses)
+        if len(self.drawn) != len(lines):
+            self.drawn = [None] * len(lines)
+        for y, line in enumerate(lines):
+            if self.drawn[y] == line:
+                continue
+            text, attr = line
+            try:
+                screen.addnstr(y, 0, text, width - 1, attr)
+                screen.clrtoeol()
+            except curses.error:
+                pass
+            self.drawn[y] = line
+        screen.refresh()
+
+    def _prompt(self, screen, curses, label):
+        height, width = screen.getmaxyx()
+        text = ''
+        screen.timeout(-1)
+        try:
+            while True:
+                screen.addnstr(height - 1, 0, label + text, width - 1, curses.A_BOLD)
+                screen.clrtoeol()
+                screen.refresh()
+                key = screen.get_wch()
+                if key in ('\n', '\r', curses.KEY_ENTER):
+                    return text
+                if key == '\x1b':
+                    return None
+                if key in ('\b', '\x7f', curses.KEY_BACKSPACE):
+                    text = text[:-1]
+                elif isinstance(key, str) and key.isprintable():
+                    text += key
+        finally:
+            screen.timeout(250)
+            self.drawn = []
+
+    def _terminate(self, screen, curses):
+        targets = {iid: self.rows[iid].instance for iid in self.marked}
+        if len(targets) == 0:
+            self.message = "nothing is marked, use t first"
+            return
+        answer = self._prompt(screen, curses, "Terminate {} instances{}? [y/N] ".format(
+            len(targets), " (dry run)" if self.dry_run else ""))
+        if answer is None or answer.strip().lower() != 'y':
+            self.message = "aborted"
+            return
+        self.kills.put(targets)
+        self.wake.set()
+        self.message = "terminating {} instances...".format(len(targets))
+        self.marked.clear()
+
+    # returns False to quit
+    def _key(self, screen, curses, key):
+        height, _ = screen.getmaxyx()
+        page = max(height - HEADER - 1, 1)
+        current = self.order[self.cursor] if self.cursor < len(self.order) else None
+        self.message = ''
+        self.dirty = True
+        if key in ('q', 'Q'):
+            return False
+        elif key in (curses.KEY_DOWN, 'j'):
+            self.cursor += 1
+        elif key in (curses.KEY_UP, 'k'):
+            self.cursor -= 1
+        elif key == curses.KEY_NPAGE:
+            self.cursor += page
+        elif key == curses.KEY_PPAGE:
+            self.cursor -= page
+        elif key == curses.KEY_HOME:
+            self.cursor = 0
+        elif key == curses.KEY_END:
+            self.cursor = len(self.order) - 1
+        elif key == 's':
+            self.sort = SORTS[(SORTS.index(self.sort) + 1) % len(SORTS)]
+        elif key == '/':
+            text = self._prompt(screen, curses, "filter (text or KEY=GLOB): ")
+            if text is not None:
+                self.filter = text.strip()
+        elif key == ' ' and current is not None:
+            self.selected ^= {current}
+            self.cursor += 1
+        elif key == 'a':
+            self.selected |= set(self.order)
+        elif key == 'c':
+            self.selected.clear()
+        elif key == 't':
+            targets = self.selected or ({current} if current is not None else set())
+            if targets <= self.marked:
+                self.marked -= targets
+            else:
+                self.marked |= targets
+            self.selected.clear()
+        elif key == 'x':
+            self._terminate(screen, curses)
+        elif key == curses.KEY_RESIZE:
+            screen.clear()
+            self.drawn = []
+        self.cursor = min(max(self.cursor, 0), max(len(self.order) - 1, 0))
+        return True
+
+    def main(self, screen):
+        import curses
+        curses.curs_set(0)
+        if curses.has_colors():
+            curses.use_default_colors()
+            curses.init_pair(1, curses.COLOR_RED, -1)
+        screen.timeout(250)
+        self.worker.start()
+        try:
+            while True:
+                if self._apply() or self.dirty:
+                    self._arrange()
+                    self.dirty = False
+                self._draw(screen, curses)
+                try:
+                    key = screen.get_wch()
+                except curses.error:
+                    continue
+                if not self._key(screen, curses, key):
+                    break
+        finally:
+            self.stopping.set()
+            self.wake.set()
+            self.kills.join()
+
+
+def run(options, load, refresh, kill):
+    import curses
+    curses.wrapper(Dashboard(options, load, refresh, kill).main)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# Spot fleet request history, kept under `<data-dir>/fleet-history`. Each sync
+# pages describe-spot-fleet-request-history from the last evaluated time of the
+# previous one, so only new events are fetched. Events are stored as fixed-size
+# records with their strings (fleet ids, instance ids, types, ...) interned in
+# the index, which keeps a month of a busy fleet to a few hundred KB.
+#
+#   <path>/events.dat  - packed records, see RECORD
+#   <path>/index.json  - {"size": n, "cursors": {sfr: time}, "strings": {table: [...]}}
+#
+# Instance types and zones only appear in the `launched` event of an instance,
+# so they're carried over to every later event of the same instance.
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import backend
+
+RECORD = np.dtype([('t', '<i8'), ('fleet', '<u4'), ('kind', '<u4'), ('sub', '<u4'),
+                   ('iid', '<u4'), ('type', '<u4'), ('zone', '<u4')])
+TABLES = {'fleet': 'fleets', 'kind': 'kinds', 'sub': 'subtypes', 'iid': 'instances',
+          'type': 'types', 'zone': 'zones'}
+
+# how far back the first sync of a fleet goes, the API keeps 30 days
+FIRST_SYNC = timedelta(days=30)
+
+# rates from fewer instance-hours than this aren't trusted
+MIN_HOURS = 10.0
+
+UNKNOWN = ''
+
+
+# naive times are UTC, like everywhere else here
+def to_epoch(t):
+    return int(pd.Timestamp(t).timestamp())
+
+
+class HistoryLog:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.data_path = self.path / 'events.dat'
+        self.index_path = self.path / 'index.json'
+
+        self.size = 0
+        self.cursors = {}
+        self.strings = {table: [UNKNOWN] for table in TABLES.values()}
+        if self.index_path.exists():
+            with open(str(self.index_path)) as f:
+                saved = json.load(f)
+            self.size = saved['size']
+            self.cursors = saved['cursors']
+            self.strings = saved['strings']
+        self.codes = {table: {s: i for i, s in enumerate(values)}
+                      for table, values in self.strings.items()}
+
+        # drop anything written after the last commit
+        if self.data_path.exists():
+            if os.path.getsize(str(self.data_path)) != self.size * RECORD.itemsize:
+                os.truncate(str(self.data_path), self.size * RECORD.itemsize)
+        else:
+            self.data_path.touch()
+
+        # type and zone of every instance seen launching
+        self.placement = {}
+        records = self._records()
+        launched = records[records['sub'] == self.code('sub', 'launched')]
+        for r in launched:
+            self.placement[int(r['iid'])] = (int(r['type']), int(r['zone']))
+
+    def code(self, field, value):
+        table = TABLES[field]
+        codes = self.codes[table]
+        if value not in codes:
+            codes[value] = len(self.strings[table])
+            self.strings[table].append(value)
+        return codes[value]
+
+    def cursor(self, sfr):
+        t = self.cursors.get(sfr)
+        return None if t is None else datetime.utcfromtimestamp(t)
+
+    def _records(self):
+        if self.size == 0:
+            return np.empty(0, dtype=RECORD)
+        return np.memmap(str(self.data_path), dtype=RECORD, mode='r', shape=(self.size,))
+
+    # `events` are (time, kind, subtype, iid, type, zone) for one fleet and
+    # `evaluated` is where the next sync of that fleet starts
+    def append(self, sfr, events, evaluated):
+        cursor = self.cursors.get(sfr)
+        fleet = self.code('fleet', sfr)
+        seen = set()
+        if cursor is not None:
+            # an event exactly at the cursor can come back on the next sync
+            old = self._records()
+            old = old[(old['fleet'] == fleet) & (old['t'] == cursor)]
+            seen = set((int(r['kind']), int(r['sub']), int(r['iid'])) for r in old)
+
+        records = np.empty(len(events), dtype=RECORD)
+        n = 0
+        for t, kind, sub, iid, instance_type, zone in sorted(events, key=lambda e: e[0]):
+            r = (self.code('kind', kind), self.code('sub', sub), self.code('iid', iid))
+            if r in seen:
+                continue
+            seen.add(r)
+            placement = (self.code('type', instance_type), self.code('zone', zone))
+            if sub == 'launched':
+                self.placement[r[2]] = placement
+            elif instance_type == UNKNOWN:
+                placement = self.placement.get(r[2], placement)
+            records[n] = (t, fleet) + r + placement
+            n += 1
+
+        with open(str(self.data_path), 'ab') as f:
+            f.write(records[:n].tobytes())
+        self.size += n
+        self.cursors[sfr] = max(evaluated, cursor or evaluated)
+        return n
+
+    def commit(self):
+        tmp = self.index_path.with_suffix('.tmp')
+        with open(str(tmp), 'w') as f:
+            json.dump({'size': self.size, 'cursors': self.cursors, 'strings': self.strings}, f)
+        os.replace(str(tmp), str(self.index_path))
+
+    def events(self):
+        records = np.array(self._records())
+        res = pd.DataFrame({'time': pd.to_datetime(records['t'], unit='s')})
+        for field, table in TABLES.items():
+            values = np.array(self.strings[table], dtype=object)
+            res[field] = pd.Categorical.from_codes(records[field], values)
+        return res.sort_values('time', kind='stable').reset_index(drop=True)
+
+
+def open_log(data_dir):
+    return HistoryLog(Path(data_dir, 'fleet-history'))
+
+# a source is called as source(sfr, start, token) and returns one page of
+# describe-spot-fleet-request-history, which lets tests drive a fake fleet
+def aws_source(region):
+    def source(sfr, start, token):
+        params = {'SpotFleetRequestId': sfr, 'StartTime': start}
+        if token:
+            params['NextToken'] = token
+        return backend.call('ec2', 'describe_spot_fleet_request_history', region, **params)
+    return source
+
+def parse_record(record):
+    info = record.get('EventInformation', {})
+    instance_type, zone = UNKNOWN, UNKNOWN
+    # launches describe the instance as json
+    try:
+        desc = json.loads(info.get('EventDescription', ''))
+        instance_type = desc.get('instanceType', UNKNOWN)
+        zone = desc.get('availabilityZone', UNKNOWN)
+    except (ValueError, AttributeError):
+        pass
+    return (to_epoch(record['Timestamp']), record.get('EventType', UNKNOWN),
+            info.get('EventSubType', UNKNOWN), info.get('InstanceId', UNKNOWN),
+            instance_type, zone)
+
+def fetch(source, sfr, start):
+    events = []
+    token = None
+    while True:
+        page = source(sfr, start, token)
+        events += [parse_record(r) for r in page.get('HistoryRecords', [])]
+        token = page.get('NextToken')
+        if not token:
+            return events, to_epoch(page.get('LastEvaluatedTime', start))
+
+# pages every fleet in `sfrs` from its cursor, concurrently, and returns the
+# number of new events per fleet
+def sync(log, sfrs, source, now=None, workers=8):
+    now = datetime.utcnow() if now is None else now
+
+    def get(sfr):
+        start = log.cursor(sfr) or now - FIRST_SYNC
+        return fetch(source, sfr, start)
+
+    res = {}
+    if len(sfrs) == 0:
+        return res
+    with ThreadPoolExecutor(max_workers=min(len(sfrs), workers)) as pool:
+        for sfr, (events, evaluated) in zip(sfrs, pool.map(get, sfrs)):
+            res[sfr] = log.append(sfr, events, evaluated)
+    log.commit()
+    return res
+
+
+# One row per instance seen launching: when it ran, and whether it was
+# interrupted (terminated while its fleet was still up) and how long the
+# fleet took to launch the next instance after that.
+def lifetimes(events, now=None):
+    now = pd.Timestamp(datetime.utcnow() if now is None else now)
+    cancelled = events[(events['kind'] == 'fleetRequestChange')
+                       & events['sub'].astype(str).str.startswith('cancelled')]
+    cancelled_at = cancelled.groupby('fleet', observed=True)['time'].min().to_dict()
+
+    launched = events[events['sub'] == 'launched']
+    terminated = events[events['sub'] == 'terminated'].groupby('iid', observed=True)['time'].min()
+
+    res = launched.drop_duplicates('iid')[['fleet', 'iid', 'type', 'zone', 'time']].rename(
+        columns={'time': 'launched'}).set_index('iid')
+    res['terminated'] = terminated.reindex(res.index)
+    fleet_end = pd.to_datetime(res['fleet'].astype(object).map(cancelled_at))
+    res['interrupted'] = res['terminated'].notna() & ~(res['terminated'] >= fleet_end)
+    end = res['terminated'].fillna(fleet_end).fillna(now)
+    res['hours'] = (end - res['launched']) / pd.Timedelta(hours=1)
+
+    # the next launch in the same fleet after each interruption
+    res['replaced_after'] = np.nan
+    for fleet, group in res[res['interrupted']].groupby('fleet', observed=True):
+        launches = np.sort(launched.loc[launched['fleet'] == fleet, 'time'].values)
+        gone = group['terminated'].values
+        nxt = np.searchsorted(launches, gone, side='left')
+        ok = nxt < len(launches)
+        latency = np.full(len(gone), np.nan)
+        latency[ok] = (launches[nxt[ok]] - gone[ok]) / np.timedelta64(1, 's')
+        res.loc[group.index, 'replaced_after'] = latency
+    return res
+
+# interruptions per instance-hour and replacement latency in seconds, by `by`
+def rates(lives, by):
+    grouped = lives.groupby(by, observed=True)
+    res = pd.DataFrame({'instances': grouped.size(),
+                        'hours': grouped['hours'].sum(),
+                        'interruptions': grouped['interrupted'].sum()})
+    res['rate'] = res['interruptions'] / res['hours']
+    res['replaced_after'] = grouped['replaced_after'].median()
+    return res.sort_values('rate', ascending=False)
+
+# observed interruption rates per type for pricing, where there's enough history
+def interruption_rates(data_dir, min_hours=MIN_HOURS):
+    log = open_log(data_dir)
+    if log.size == 0:
+        return {}
+    by_type = rates(lifetimes(log.events()), 'type')
+    by_type = by_type[(by_type['hours'] >= min_hours) & (by_type.index != UNKNOWN)]
+    return by_type['rate'].to_dict()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Local cache of describe-instances per region, kept in
+# `<data-dir>/inventory-<region>.json`. Inside the TTL the cached copy is used
+# as is. Once it expires only the instances that aren't terminated are fetched
+# (filtered server side) and merged into the cache; anything that didn't come
+# back has been terminated since and is dropped.
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from time import time
+
+import tracing
+
+LIVE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
+stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+
+# cache already loaded in this process, keyed by path, with the file's mtime
+# so a long-running process (`aws.py serve`) notices writes by other processes
+_memory = {}
+# held around every read-modify-write of a cache file, the dashboard loads
+# from a background thread
+_lock = threading.RLock()
+
+
+# lists fetched with pushed down filters are cached separately
+def cache_path(data_dir, region, filters=None):
+    if not filters:
+        return Path(data_dir, 'inventory-{}.json'.format(region))
+    key = hashlib.sha1(json.dumps(filters, sort_keys=True).encode()).hexdigest()[:12]
+    return Path(data_dir, 'inventory-{}-{}.json'.format(region, key))
+
+def live_filters(filters):
+    res = [f for f in filters if f['Name'] != 'instance-state-name']
+    states = LIVE_STATES
+    for f in filters:
+        if f['Name'] == 'instance-state-name':
+            states = [s for s in states if s in f['Values']]
+    res.append({'Name': 'instance-state-name', 'Values': states})
+    return res
+
+def _mtime(path):
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _read(path):
+    with _lock:
+        mtime = _mtime(path)
+        if mtime is None:
+            return None
+        if path in _memory and _memory[path][0] == mtime:
+            return _memory[path][1]
+        try:
+            with tracing.span('read', 'cache', path=str(path)) as stats:
+                with open(str(path)) as f:
+                    cache = json.load(f)
+                stats['bytes'] = f.tell()
+                stats['items'] = len(cache['instances'])
+        except ValueError:
+            return None
+        _memory[path] = (mtime, cache)
+        return cache
+
+def _write(path, cache):
+    # per process, so `serve` and a standalone run don't share a temp file
+    tmp = path.with_name('{}.{}.tmp'.format(path.stem, os.getpid()))
+    with _lock, tracing.span('write', 'cache', path=str(path)) as stats:
+        with open(str(tmp), 'w') as f:
+            json.dump(cache, f)
+            stats['bytes'] = f.tell()
+        os.replace(str(tmp), str(path))
+        stats['items'] = len(cache['instances'])
+        _memory[path] = (_mtime(path), cache)
+
+def merge(cached, fresh):
+    # survivors keep their position so the listing order stays stable
+    res = {iid: fresh[iid] for iid in cached if iid in fresh}
+    res.update(fresh)
+    return res
+
+# `fetch(region, filters)` does the actual describe-instances call
+def load(region, data_dir, ttl, fetch, refresh=False, filters=None):
+    filters = filters or []
+    path = cache_path(data_dir, region, filters)
+    cache = None if refresh else _read(path)
+
+    if cache is not None and time() - cache['fetched_at'] < ttl:
+        stats['hits'] += 1
+        return cache['instances']
+
+    stats['misses'] += 1
+    fresh = fetch(region, live_filters(filters))
+    # the fetch isn't under the lock, so merge into whatever is there now
+    with _lock:
+        if not refresh:
+            cache = _read(path)
+        if cache is not None:
+            stats['refreshes'] += 1
+            instances = merge(cache['instances'], fresh)
+        else:
+            instances = fresh
+        _write(path, {'fetched_at': time(), 'instances': instances})
+    return instances
+
+# drop instances we know are gone from every cached list without waiting for the TTL
+def forget(region, data_dir, iids):
+    for path in Path(data_dir).glob('inventory-{}*.json'.format(region)):
+        with _lock:
+            cache = _read(path)
+            if cache is None:
+                continue
+            instances = {iid: inst for iid, inst in cache['instances'].items()
+                         if iid not in iids}
+            _write(path, {'fetched_at': cache['fetched_at'], 'instances': instances})
+
+# new instances won't be in any cached list, so the next load refreshes
+def expire(region, data_dir):
+    for path in Path(data_dir).glob('inventory-{}*.json'.format(region)):
+        with _lock:
+            cache = _read(path)
+            if cache is not None:
+                _write(path, {'fetched_at': 0, 'instances': cache['instances']})
+
+def reset_stats():
+    for k in stats:
+        stats[k] = 0
+
+def report():
+    total = stats['hits'] + stats['misses']
+    print("Inventory cache: {} hits, {} misses ({} incremental refreshes) of {} lookups".format(
+        stats['hits'], stats['misses'], stats['refreshes'], total))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# Launching instances and waiting until they're usable. Instances are requested
+# in batches (one RunInstances call per batch). Tags that are the same for the
+# whole batch go in the launch request; templated ones differ per instance and
+# cost a CreateTags call each afterwards, since a launch request can only give
+# all of its instances the same tags.
+# Readiness is polled with describe-instance-status on just the new ids, backing
+# off while nothing changes, and every host that comes up is handed straight to
+# an SSH check, so the first usable host doesn't wait for the slowest one.
+
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, perf_counter
+
+import backend
+
+# instances requested per RunInstances call
+LAUNCH_BATCH = 100
+# DescribeInstanceStatus takes at most 100 ids when they're listed
+STATUS_BATCH = 100
+# CreateTags and DescribeInstances take at most 1000 ids
+TAG_BATCH = 1000
+
+POLL_MIN = 1.0
+POLL_MAX = 15.0
+
+
+# `templates` are KEY=TEMPLATE strings with {basename} and {i} filled in per instance
+def instance_tags(templates, basename, i):
+    res = {}
+    for pair in templates:
+        if '=' not in pair:
+            raise ValueError("Expected KEY=TEMPLATE, got '{}'".format(pair))
+        k, v = pair.split('=', 1)
+        res[k] = v.format(basename=basename, i=i)
+    return res
+
+def backoff(start=POLL_MIN, cap=POLL_MAX, factor=1.5):
+    delay = start
+    while True:
+        yield delay
+        delay = min(cap, delay * factor)
+
+def chunks(items, size):
+    return [items[b:b+size] for b in range(0, len(items), size)]
+
+# Launches `count` instances numbered from `start`. Tags that are the same for
+# every instance go into the launch request itself, the templated ones are
+# returned per instance for tag_instances. Returns [(iid, index)].
+def run_instances(region, count, params, shared_tags, start=0, dry_run=False, workers=8):
+    if len(shared_tags) > 0:
+        params = dict(params, TagSpecifications=[{
+            'ResourceType': 'instance',
+            'Tags': [{'Key': k, 'Value': v} for k, v in shared_tags.items()]}])
+
+    def batch(indices):
+        try:
+            # take a partial batch rather than nothing when capacity is short
+            output = backend.call('ec2', 'run_instances', region, MinCount=1,
+                                  MaxCount=len(indices), DryRun=dry_run, **params)
+        except backend.AwsError as e:
+            if e.code == 'DryRunOperation':
+                return [], None
+            return [], e
+        return [(inst['InstanceId'], i)
+                for inst, i in zip(output['Instances'], indices)], None
+
+    indices = chunks(list(range(start, start + count)), LAUNCH_BATCH)
+    launched = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, min(len(indices), workers))) as pool:
+        for res, error in pool.map(batch, indices):
+            launched += res
+            if error is not None:
+                errors.append(error)
+    return launched, errors
+
+# `tags` maps iid -> {key: value}. Instances with the same tags share one call,
+# so a templated tag like Name={basename}{i} means one call per instance.
+def tag_instances(region, tags, workers=8):
+    groups = {}
+    for iid, t in tags.items():
+        if len(t) > 0:
+            groups.setdefault(tuple(sorted(t.items())), []).append(iid)
+
+    jobs = [(pairs, iids) for pairs, group in groups.items()
+            for iids in chunks(group, TAG_BATCH)]
+
+    def create(job):
+        pairs, iids = job
+        backend.call('ec2', 'create_tags', region, Resources=iids,
+                     Tags=[{'Key': k, 'Value': v} for k, v in pairs])
+
+    if len(jobs) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=min(len(jobs), workers)) as pool:
+        list(pool.map(create, jobs))
+
+def describe(region, iids):
+    res = {}
+    for batch in chunks(list(iids), TAG_BATCH):
+        for page in backend.paginate('ec2', 'describe_instances', region, InstanceIds=batch):
+            for r in page['Reservations']:
+                for inst in r['Instances']:
+                    res[inst['InstanceId']] = inst
+    return res
+
+# Returns the state name of each of `iids`. EC2 is eventually consistent, so
+# ids fresh from RunInstances can be unknown for a while. Those are left out,
+# which callers treat as still pending.
+def instance_states(region, iids):
+    res = {}
+    for batch in chunks(list(iids), STATUS_BATCH):
+        while len(batch) > 0:
+            try:
+                for page in backend.paginate('ec2', 'describe_instance_status', region,
+                                             InstanceIds=batch, IncludeAllInstances=True):
+                    for status in page['InstanceStatuses']:
+                        res[status['InstanceId']] = status['InstanceState']['Name']
+                break
+            except backend.AwsError as e:
+                if e.code != 'InvalidInstanceID.NotFound':
+                    raise
+                # the message names the unknown ids, ask again for the rest
+                unknown = set(re.findall(r'i-[0-9a-f]+', e.message))
+                if len(unknown & set(batch)) == 0:
+                    break
+                batch = [iid for iid in batch if iid not in unknown]
+    return res
+
+def address(inst):
+    return inst.get('PublicIpAddress') or inst.get('PrivateIpAddress')
+
+# retries until `ip` accepts an SSH session and runs a command
+def wait_ssh(pool, ip, timeout=300):
+    deadline = perf_counter() + timeout
+    delays = backoff(start=2.0)
+    while True:
+        try:
+            if pool.run(ip, 'true') == 0:
+                return True
+        except Exception:
+            pool.close(ip)
+        if perf_counter() >= deadline:
+            return False
+        sleep(min(next(delays), max(0, deadline - perf_counter())))
+
+
+# Waits for instances to be running and reachable over SSH while more keep
+# arriving: `add(iids)` hands over new ids, one thread polls every pending id
+# together and each host is checked in a single pool of `workers` threads as
+# soon as it's running. `on_ready(iid, inst)` runs in the checking thread right
+# after it passes. `close()` waits for everything added so far and returns
+# {iid: seconds since `t0`} for the usable hosts (or just running ones when
+# `pool` is None) and the failed ids. Each id gets `timeout` from its `add`.
+class ReadyWaiter:
+    def __init__(self, region, pool=None, t0=None, on_ready=None, workers=16,
+                 timeout=600, ssh_timeout=300):
+        self.region = region
+        self.pool = pool
+        self.t0 = perf_counter() if t0 is None else t0
+        self.on_ready = on_ready
+        self.timeout = timeout
+        self.ssh_timeout = ssh_timeout
+        self.ready = {}
+        self.failed = set()
+        # iid -> deadline
+        self.pending = {}
+        self.closing = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.poller = threading.Thread(target=self._poll, daemon=True)
+        self.poller.start()
+
+    def add(self, iids):
+        with self.cond:
+            deadline = perf_counter() + self.timeout
+            for iid in iids:
+                self.pending.setdefault(iid, deadline)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.poller.join()
+        self.executor.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+        return self.ready, self.failed
+
+    def _check(self, inst):
+        iid = inst['InstanceId']
+        ok = self.pool is None or (address(inst) is not None
+                                   and wait_ssh(self.pool, address(inst), self.ssh_timeout))
+        with self.cond:
+            if ok:
+                self.ready[iid] = perf_counter() - self.t0
+            else:
+                self.failed.add(iid)
+        if ok and self.on_ready is not None:
+            self.on_ready(iid, inst)
+
+    def _poll(self):
+        delays = backoff()
+        while True:
+            with self.cond:
+                if len(self.pending) == 0:
+                    if self.closing:
+                        return
+                    self.cond.wait()
+                    continue
+                pending = list(self.pending)
+            try:
+                states = instance_states(self.region, pending)
+                running = [iid for iid in pending if states.get(iid) == 'running']
+                # the ips only show up in describe-instances
+                found = describe(self.region, running) if len(running) > 0 else {}
+            except Exception as e:
+                # handed to whoever calls close()
+                with self.cond:
+                    self.error = e
+                    self.failed.update(self.pending)
+                    self.pending.clear()
+                    self.closing = True
+                return
+            dead = [iid for iid in pending if states.get(iid) in ('shutting-down', 'terminated')]
+            for inst in found.values():
+                self.executor.submit(self._check, inst)
+            if len(running) > 0:
+                # something moved, look again soon
+                delays = backoff()
+
+            now = perf_counter()
+            with self.cond:
+                for iid in found:
+                    del self.pending[iid]
+                for iid in dead + [iid for iid, t in self.pending.items() if t <= now]:
+                    if self.pending.pop(iid, None) is not None:
+                        self.failed.add(iid)
+                if len(self.pending) > 0:
+                    # new ids wake the poller early
+                    added = self.cond.wait(min(next(delays),
+                                               max(0, min(self.pending.values()) - now)))
+                    if added:
+                        delays = backoff()
+
+# Waits for `iids` to be running and reachable over SSH, see ReadyWaiter.
+def wait_ready(region, iids, pool=None, t0=None, on_ready=None, workers=16,
+               timeout=600, ssh_timeout=300):
+    waiter = ReadyWaiter(region, pool, t0, on_ready, workers, timeout, ssh_timeout)
+    waiter.add(iids)
+    return waiter.close()
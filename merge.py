@@ -3,13 +3,47 @@
 import pandas as pd
 import argparse
 import glob
+import json
+import os
+import pickle
+import re
+import shutil
+from time import sleep, perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import unquote
+
+import tracing
 
 def make_parser():
     descr = "Merges all .pkl files into a single .pkl file."
     parser = argparse.ArgumentParser(description=descr)
 
-    parser.add_argument('resultsdir', action="store")
-    parser.add_argument('output_name', action="store")
+    parser.add_argument('resultsdir', action="store", nargs='?')
+    parser.add_argument('output_name', action="store", nargs='?')
+    parser.add_argument('--workers', action="store", type=int, default=os.cpu_count())
+    parser.add_argument('--chunksize', action="store", type=int, default=500)
+    parser.add_argument('--parquet', action="store",
+                        help="also write a parquet dataset partitioned by dataset here")
+    parser.add_argument('--full', action="store_true",
+                        help="ignore the manifest and merge everything again")
+    parser.add_argument('--watch', action="store_true")
+    parser.add_argument('--interval', action="store", type=int, default=60)
+    parser.add_argument('--trace', action="store", metavar="FILE",
+                        help="record a span per merge step, .json for a Chrome trace")
+
+    # query options
+    parser.add_argument('--query', action="store", metavar="PARQUET_DIR",
+                        help="query a dataset written with --parquet instead of merging")
+    parser.add_argument('--where', action="store",
+                        help="row filter, e.g. \"avg_fit_time > 10 and classifier == 'SVC'\"")
+    parser.add_argument('--group-by', action="store", nargs='*', default=[])
+    parser.add_argument('--agg', action="store", nargs='*', default=[],
+                        metavar="FUNC:COLUMN", help="count, sum, min, max or mean")
+    parser.add_argument('--top-k', action="store", type=int)
+    parser.add_argument('--sort', action="store", metavar="COLUMN")
+    parser.add_argument('--ascending', action="store_true")
+    parser.add_argument('--columns', action="store", nargs='*', default=[])
+    parser.add_argument('--csv', action="store")
 
     return parser
 
@@ -42,6 +76,43 @@ def sortCSVString(string):
         res.append('{}={}'.format(k, v))
     return ','.join(res)
 
+# Vectorized sortCSVString over a whole column. Only the distinct strings are
+# split and sorted, every row then just picks up its canonical form.
+def normalize_parameters(params):
+    codes, uniques = pd.factorize(params)
+    if len(uniques) == 0:
+        return params.copy()
+    pairs = pd.Series(uniques, dtype=object).str.split(',').explode()
+    keys = pairs.str.extract(r'^([^=]*)', expand=False)
+    pairs = pd.DataFrame({'row': pairs.index, 'key': keys.values, 'pair': pairs.values})
+    # like the dict in sortCSVString, a repeated key keeps its last value
+    pairs = pairs.drop_duplicates(['row', 'key'], keep='last') \
+                 .sort_values(['row', 'key'], kind='stable')
+
+    # lay the sorted pairs out as row x position and join a column at a time
+    pos = pairs.groupby('row').cumcount().values
+    wide = pairs.set_index(['row', pos])['pair'].unstack() \
+                .reindex(range(len(uniques)))
+    canonical = wide[0].astype(object)
+    for col in wide.columns[1:]:
+        present = wide[col].notna()
+        canonical[present] = canonical[present] + ',' + wide[col][present]
+
+    res = pd.Series(canonical.values[codes], index=params.index, dtype=object)
+    res[codes == -1] = None
+    return res
+
+def parameter_ids(canonical):
+    return pd.util.hash_pandas_object(canonical.fillna(''), index=False).values
+
+KEY = ['dataset', 'classifier', 'param_id']
+
+def normalize(df):
+    if 'parameters' in df.columns:
+        df['parameters'] = normalize_parameters(df['parameters'])
+        df['param_id'] = parameter_ids(df['parameters'])
+    return df
+
 def chunk(lst, size):
     acc = []
     count = 0
@@ -74,21 +145,480 @@ def merge(resultsdir, tmpdir, chunksize=500):
         df.to_pickle("{}/int-{}.pkl".format(tmpdir, i))
     print("\r[Done]                                                         ")
 
-def merge_all(resultsdir):
-    files = glob.glob("{}/*.pkl".format(resultsdir))
-    df = pd.DataFrame()
-    for i, f in enumerate(files):
+# errors pandas raises for empty or half-written pickles
+BAD_PICKLE = (EOFError, pickle.UnpicklingError, ValueError, AttributeError, ImportError)
+
+# column recording which result file a row came from, only kept in the store
+SOURCE = '_source'
+
+def read_chunk(files):
+    frames = []
+    rows = {}
+    skipped = []
+    for f in files:
         try:
-            new = pd.read_pickle(f)
-            print("\r[{}/{}] : {} -> {}".format(i+1, len(files), f, new['dataset'].values[0]), end=" "*40)
-            df = pd.concat([df, new])
-        except EOFError:
-            pass
-            # print("Found empty file called {}!".format(f))
-    return df.sort_values('dataset').reset_index(drop=True)
+            if os.path.getsize(f) == 0:
+                skipped.append(f)
+                continue
+            df = pd.read_pickle(f)
+        except BAD_PICKLE + (OSError,):
+            skipped.append(f)
+            continue
+        df[SOURCE] = f
+        frames.append(df)
+        rows[f] = len(df)
+    if len(frames) == 0:
+        return None, rows, skipped
+    return pd.concat(frames, ignore_index=True), rows, skipped
+
+# read_chunk plus its timing, so the parent can trace what the workers did
+def read_chunk_timed(files):
+    start = perf_counter()
+    res = read_chunk(files)
+    return res, start, perf_counter() - start, os.getpid()
+
+def tree_reduce(frames, fanout=8):
+    frames = [f for f in frames if f is not None]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    while len(frames) > 1:
+        frames = [pd.concat(frames[i:i+fanout], ignore_index=True)
+                  for i in range(0, len(frames), fanout)]
+    return frames[0]
+
+def merge_files(files, workers=None, chunksize=500):
+    chunks = [f_lst for _, f_lst in chunk(files, chunksize)]
+
+    frames = [None] * len(chunks)
+    rows = {}
+    skipped = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(read_chunk_timed, f_lst): i for i, f_lst in enumerate(chunks)}
+        for done, future in enumerate(as_completed(futures)):
+            (frames[futures[future]], r, s), start, duration, pid = future.result()
+            if tracing.enabled:
+                tracing.add('read_chunk', 'merge', start, duration, pid=pid, tid=pid,
+                            items=sum(r.values()), files=len(chunks[futures[future]]),
+                            skipped=len(s), bytes=sum(os.path.getsize(f) for f in r))
+            rows.update(r)
+            skipped += s
+            print("\r[{}/{}] chunks read".format(done+1, len(chunks)), end=" "*40, flush=True)
+    print()
+    if len(skipped) > 0:
+        print("Skipped {} empty or truncated files".format(len(skipped)))
+
+    with tracing.span('tree_reduce', 'merge', frames=len(frames)) as stats:
+        df = tree_reduce(frames)
+        stats['items'] = len(df)
+    return df, rows, skipped
+
+# `mtimes` maps each result file to its mtime, see dedup below
+def finish(df, mtimes):
+    if len(df) == 0:
+        return df.drop(columns=[SOURCE], errors='ignore')
+    # The same run can land in several result files, keep the row from the most
+    # recently written one. Rows come in scandir and chunk order, so they are
+    # put in file mtime order first (rows of one file keep their order).
+    if 'param_id' in df.columns:
+        df = df.sort_values(SOURCE, key=lambda src: src.map(mtimes), kind='stable')
+        before = len(df)
+        df = df.drop_duplicates(KEY, keep='last')
+        print("Dropped {} duplicate rows".format(before - len(df)))
+    df = df.drop(columns=[SOURCE])
+    return df.sort_values('dataset', kind='stable').reset_index(drop=True)
+
+def merge_all(resultsdir, workers=None, chunksize=500):
+    files = glob.glob("{}/*.pkl".format(resultsdir))
+    df, rows, _ = merge_files(files, workers, chunksize)
+    return finish(normalize(df), {f: os.path.getmtime(f) for f in rows})
+
+# The incremental store lives next to the output in `<output>.d/`: a few part
+# pickles holding the merged rows (tagged with SOURCE) and a manifest of every
+# file merged so far as {path: [size, mtime, rows, part]}, plus the datasets in
+# each part. Reruns only read files that are new or whose size/mtime changed;
+# rows from changed or deleted files are dropped from their parts first. The
+# datasets those rows belong to are the only ones the outputs need redone.
+# Parts are never written in place: new and rewritten ones get fresh numbers,
+# and the old ones are only removed once the manifest no longer names them,
+# so a crash at any point leaves a manifest whose parts all exist.
+MAX_PARTS = 32
+
+def store_dir(output_name):
+    return "{}.d".format(output_name)
+
+def load_manifest(store):
+    path = os.path.join(store, 'manifest.json')
+    if not os.path.exists(path):
+        return {'files': {}, 'next_part': 0, 'datasets': {}}
+    with open(path) as f:
+        manifest = json.load(f)
+    # manifests from before the datasets were tracked
+    manifest.setdefault('datasets', {})
+    return manifest
+
+def save_manifest(store, manifest):
+    path = os.path.join(store, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+def part_path(store, part):
+    return os.path.join(store, 'part-{:05d}.pkl'.format(part))
+
+def manifest_parts(manifest):
+    return sorted(set(v[3] for v in manifest['files'].values()))
+
+# removes the part files the saved manifest doesn't name, including any left
+# by a run that crashed before saving its manifest
+def remove_old_parts(store, manifest):
+    keep = set(part_path(store, p) for p in manifest_parts(manifest))
+    for name in os.listdir(store):
+        path = os.path.join(store, name)
+        if name.startswith('part-') and path not in keep:
+            os.remove(path)
+
+def datasets_in(df):
+    if 'dataset' not in df.columns:
+        return []
+    return sorted(df['dataset'].dropna().unique().tolist())
+
+def scan(resultsdir):
+    res = {}
+    for entry in os.scandir(resultsdir):
+        if entry.name.endswith('.pkl') and entry.is_file():
+            st = entry.stat()
+            res[entry.path] = [st.st_size, st.st_mtime]
+    return res
+
+# Returns the datasets whose merged rows changed, or None after a full merge,
+# when everything has to be written again.
+def incremental_merge(resultsdir, output_name, workers=None, chunksize=500, full=False):
+    store = store_dir(output_name)
+    os.makedirs(store, exist_ok=True)
+    manifest = load_manifest(store)
+    if full:
+        # the old parts stay until the new manifest is saved
+        manifest = {'files': {}, 'next_part': manifest['next_part'], 'datasets': {}}
+    known = manifest['files']
+
+    current = scan(resultsdir)
+    todo = [f for f, (size, mtime) in current.items()
+            if f not in known or known[f][:2] != [size, mtime]]
+    stale = set(f for f in known if f not in current or f in todo)
+    print("{} files, {} new or changed, {} removed".format(
+        len(current), len(todo), len([f for f in known if f not in current])))
+    touched = set()
+    if not full and len(todo) == 0 and len(stale) == 0:
+        return touched
+
+    # upsert: drop rows that came from files we're about to re-read
+    stale_parts = sorted(set(known[f][3] for f in stale))
+    for f in stale:
+        del known[f]
+    referenced = set(v[3] for v in known.values())
+    renumbered = {}
+    for part in stale_parts:
+        df = pd.read_pickle(part_path(store, part))
+        dropped = df[SOURCE].isin(stale)
+        touched.update(datasets_in(df[dropped]))
+        if part not in referenced:
+            # every row came from stale files
+            continue
+        df = df[~dropped]
+        renumbered[part] = manifest['next_part']
+        manifest['next_part'] += 1
+        df.to_pickle(part_path(store, renumbered[part]))
+        manifest['datasets'][str(renumbered[part])] = datasets_in(df)
+    for v in known.values():
+        v[3] = renumbered.get(v[3], v[3])
+
+    rows = {}
+    if len(todo) > 0:
+        df, rows, _ = merge_files(todo, workers, chunksize)
+        if len(df) > 0:
+            with tracing.span('normalize', 'merge', items=len(df)):
+                df = normalize(df)
+            part = manifest['next_part']
+            with tracing.span('write_part', 'cache', items=len(df)):
+                df.to_pickle(part_path(store, part))
+            manifest['next_part'] += 1
+            manifest['datasets'][str(part)] = datasets_in(df)
+            touched.update(manifest['datasets'][str(part)])
+            for f, n in rows.items():
+                known[f] = current[f] + [n, part]
+
+    parts = manifest_parts(manifest)
+    if len(parts) > MAX_PARTS:
+        parts = [compact_parts(store, manifest, parts)]
+    manifest['datasets'] = {str(p): manifest['datasets'][str(p)]
+                            for p in parts if str(p) in manifest['datasets']}
+    save_manifest(store, manifest)
+    remove_old_parts(store, manifest)
+    # files that were skipped (still being written?) are retried next time
+    return None if full else touched
+
+def compact_parts(store, manifest, parts):
+    part = manifest['next_part']
+    manifest['next_part'] += 1
+    df = tree_reduce([pd.read_pickle(part_path(store, p)) for p in parts])
+    df.to_pickle(part_path(store, part))
+    for v in manifest['files'].values():
+        v[3] = part
+    manifest['datasets'][str(part)] = datasets_in(df)
+    return part
+
+# the merged rows, or only those of `datasets`, reading just the parts that have them
+def read_store(output_name, datasets=None):
+    store = store_dir(output_name)
+    manifest = load_manifest(store)
+    parts = manifest_parts(manifest)
+    mtimes = {f: v[1] for f, v in manifest['files'].items()}
+    if datasets is None:
+        return finish(tree_reduce([pd.read_pickle(part_path(store, p)) for p in parts]), mtimes)
+
+    frames = []
+    for p in parts:
+        listed = manifest['datasets'].get(str(p))
+        if listed is not None and datasets.isdisjoint(listed):
+            continue
+        df = pd.read_pickle(part_path(store, p))
+        frames.append(df[df['dataset'].isin(datasets)])
+    return finish(tree_reduce(frames), mtimes)
+
+# Persistent set of (dataset, classifier, param_id) that have results, so
+# "was this run already computed?" is one hash lookup instead of a rescan of
+# the outputs.
+def index_path(output_name):
+    return os.path.join(store_dir(output_name), 'index.pkl')
+
+def write_index(df, output_name):
+    if 'param_id' not in df.columns:
+        return
+    df[KEY].to_pickle(index_path(output_name))
+
+def load_index(output_name):
+    keys = pd.read_pickle(index_path(output_name))
+    return set(zip(keys['dataset'], keys['classifier'], keys['param_id']))
+
+def is_computed(index, dataset, classifier, parameters):
+    canonical = normalize_parameters(pd.Series([parameters]))
+    return (dataset, classifier, parameter_ids(canonical)[0]) in index
+
+# Writes `df` as a dataset partitioned by dataset. With `datasets`, `df` only
+# holds the rows of those and just their partitions are replaced, the rest of
+# an existing dataset is left alone.
+def write_parquet(df, path, datasets=None):
+    if datasets is None or not os.path.exists(path):
+        # to_parquet adds files to existing partitions instead of replacing them
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        df.to_parquet(path, partition_cols=['dataset'], index=False)
+        return
+
+    # partitions are written next to the dataset and then swapped in
+    staging = path.rstrip(os.sep) + '.tmp'
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    if len(df) > 0:
+        df.to_parquet(staging, partition_cols=['dataset'], index=False)
+    for name in os.listdir(path):
+        # hive partition directories are dataset=<uri-escaped value>
+        if name.startswith('dataset=') and unquote(name[len('dataset='):]) in datasets:
+            shutil.rmtree(os.path.join(path, name))
+    if os.path.exists(staging):
+        for name in os.listdir(staging):
+            os.rename(os.path.join(staging, name), os.path.join(path, name))
+        shutil.rmtree(staging)
+
+# Streaming queries over the parquet dataset. Only the columns a query touches
+# are read, one record batch at a time, and only partial aggregates or the
+# running top-k are kept between batches, so memory doesn't grow with the
+# number of result rows.
+AGGS = ['count', 'sum', 'min', 'max', 'mean']
+
+def parse_aggs(specs):
+    res = []
+    for spec in specs:
+        func, _, col = spec.partition(':')
+        if func not in AGGS or col == '':
+            raise ValueError("Bad aggregation '{}', expected FUNC:COLUMN with FUNC in {}".format(
+                spec, ', '.join(AGGS)))
+        res.append((func, col))
+    return res
+
+def columns_in(expr, known):
+    return [c for c in known if re.search(r'\b{}\b'.format(re.escape(c)), expr)]
+
+def query_batches(path, columns):
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    for batch in dataset.to_batches(columns=columns):
+        df = batch.to_pandas()
+        # hive partition columns come back as categoricals
+        for c in df.columns:
+            if isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = df[c].astype(str)
+        yield df
+
+def partial_aggregate(df, group_by, aggs):
+    cols = {}
+    for func, col in aggs:
+        if func in ('count', 'mean'):
+            cols['{}__count'.format(col)] = (col, 'count')
+        if func in ('sum', 'mean'):
+            cols['{}__sum'.format(col)] = (col, 'sum')
+        if func in ('min', 'max'):
+            cols['{}__{}'.format(col, func)] = (col, func)
+    if len(group_by) == 0:
+        df = df.assign(_all=0)
+        group_by = ['_all']
+    return df.groupby(group_by, sort=False).agg(**cols)
+
+def reduce_partials(partials):
+    merged = pd.concat(partials)
+    funcs = {c: ('sum' if c.endswith(('__count', '__sum')) else c.rsplit('__', 1)[1])
+             for c in merged.columns}
+    return merged.groupby(level=list(range(merged.index.nlevels)), sort=False).agg(funcs)
+
+def combine_partials(partials, aggs):
+    merged = reduce_partials(partials)
+
+    res = pd.DataFrame(index=merged.index)
+    for func, col in aggs:
+        name = '{}_{}'.format(func, col)
+        if func == 'mean':
+            res[name] = merged['{}__sum'.format(col)] / merged['{}__count'.format(col)]
+        else:
+            res[name] = merged['{}__{}'.format(col, func)]
+    if res.index.names == ['_all']:
+        return res.reset_index(drop=True)
+    return res.reset_index()
+
+def top_k(df, group_by, sort, k, ascending):
+    df = df.sort_values(sort, ascending=ascending, kind='stable')
+    if len(group_by) == 0:
+        return df.head(k)
+    return df.groupby(group_by, sort=False).head(k)
+
+def run_query(options):
+    aggs = parse_aggs(options.agg)
+    if options.top_k is not None and options.sort is None:
+        raise ValueError("--top-k needs --sort")
+
+    known = order + ['param_id']
+    # with --agg, --sort refers to an output column like max_avg_fit_time
+    wanted = list(options.group_by) + [col for _, col in aggs]
+    if len(aggs) == 0:
+        if options.sort is not None:
+            wanted.append(options.sort)
+        wanted += options.columns or known
+    needed = wanted + (columns_in(options.where, known) if options.where else [])
+    needed = list(dict.fromkeys(needed))
+
+    partials = []
+    running = None
+    written = 0
+    for df in query_batches(options.query, needed):
+        if options.where:
+            df = df.query(options.where)
+        if len(df) == 0:
+            continue
+        if len(aggs) > 0:
+            partials.append(partial_aggregate(df, options.group_by, aggs))
+            # keep the list of partials short
+            if len(partials) > 64:
+                partials = [reduce_partials(partials)]
+        elif options.top_k is not None:
+            df = df[list(dict.fromkeys(wanted))]
+            running = top_k(df if running is None else pd.concat([running, df]),
+                            options.group_by, options.sort, options.top_k, options.ascending)
+        else:
+            # plain filters stream straight to the output
+            df = df[list(dict.fromkeys(wanted))]
+            if options.csv:
+                df.to_csv(options.csv, mode='w' if written == 0 else 'a',
+                          header=written == 0, index=False)
+            else:
+                print(df.to_string(index=False, header=written == 0))
+            written += len(df)
+
+    if len(aggs) > 0:
+        if len(partials) == 0:
+            return
+        res = combine_partials(partials, aggs)
+        if options.sort is not None:
+            res = res.sort_values(options.sort, ascending=options.ascending)
+        if options.top_k is not None:
+            res = res.head(options.top_k)
+    elif options.top_k is not None:
+        if running is None:
+            return
+        res = running
+    else:
+        return
+
+    if options.csv:
+        res.to_csv(options.csv, index=False)
+    else:
+        print(res.to_string(index=False))
+
+# Brings the outputs up to date after incremental_merge. Only the rows of
+# `datasets` are read back from the store and redone, and only their parquet
+# partitions are replaced. The output pickle can't be patched in place, so it
+# is still read and written whole, with the other datasets' rows taken from
+# the previous one. `datasets=None` rewrites everything.
+def write_outputs(parser, datasets=None):
+    if not os.path.exists(parser.output_name) \
+       or (parser.parquet != None and not os.path.exists(parser.parquet)):
+        datasets = None
+    with tracing.span('read_store', 'cache') as stats:
+        changed = read_store(parser.output_name, datasets)
+        stats['items'] = len(changed)
+
+    if datasets is None:
+        combined = changed
+    else:
+        with tracing.span('update_output', 'cache', items=len(changed)):
+            combined = pd.read_pickle(parser.output_name)
+            if 'dataset' in combined.columns:
+                combined = combined[~combined['dataset'].isin(datasets)]
+            combined = pd.concat([combined, changed], ignore_index=True) \
+                         .sort_values('dataset', kind='stable').reset_index(drop=True)
+    with tracing.span('write_output', 'cache', items=len(combined)):
+        combined.to_pickle(parser.output_name)
+        write_index(combined, parser.output_name)
+    if parser.parquet != None:
+        with tracing.span('write_parquet', 'cache', items=len(changed)):
+            write_parquet(changed, parser.parquet, datasets)
+    print("Wrote {} rows to {}, {}".format(
+        len(combined), parser.output_name,
+        "all datasets" if datasets is None else "{} datasets redone".format(len(datasets))))
 
 if __name__ == "__main__":
-    parser = make_parser().parse_args()
+    argparser = make_parser()
+    parser = argparser.parse_args()
+    if parser.trace != None:
+        tracing.start(parser.trace)
+
+    if parser.query != None:
+        with tracing.span('query', 'merge'):
+            run_query(parser)
+        exit(0)
+    if parser.resultsdir == None or parser.output_name == None:
+        argparser.error("resultsdir and output_name are required unless --query is given")
+
+    touched = incremental_merge(parser.resultsdir, parser.output_name,
+                                parser.workers, parser.chunksize, parser.full)
+    if touched is None or len(touched) > 0 or not os.path.exists(parser.output_name):
+        write_outputs(parser, touched)
 
-    combined = merge_all(parser.resultsdir)
-    combined.to_pickle(parser.output_name)
+    try:
+        while parser.watch:
+            sleep(parser.interval)
+            touched = incremental_merge(parser.resultsdir, parser.output_name,
+                                        parser.workers, parser.chunksize)
+            if len(touched) > 0:
+                write_outputs(parser, touched)
+    except KeyboardInterrupt:
+        pass
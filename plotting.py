@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Draws CPU history for fleets of any size. The time axis is in minutes before
+# the end of the window, so the axes stay put between `--watch` refreshes and
+# only the data is redrawn (blitted). Modes:
+#   lines   - one line per instance, LTTB-downsampled to `max_points`
+#   bands   - fleet percentiles over time
+#   heatmap - instance x time image, idlest instances at the bottom
+# With an output file the figure is rendered without pyplot, so it works
+# without a display, and the suffix (.png, .svg, ...) picks the format.
+
+import numpy as np
+
+# `auto` draws lines up to this many instances, a heatmap past it
+MAX_LINES = 20
+# heatmaps label every row up to this many instances
+MAX_LABELS = 40
+PERCENTILES = [5, 25, 50, 75, 95]
+# CloudWatch period the points are aligned to, heatmap columns are this wide
+PERIOD = '5min'
+
+
+# Largest-Triangle-Three-Buckets: keeps `n` of the points, picking from each
+# bucket the one that makes the biggest triangle with the point kept before
+# it and the average of the next bucket. Peaks survive, unlike with striding.
+def lttb(x, y, n):
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    keep = np.empty(n, dtype=int)
+    keep[0], keep[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            nlo, nhi = edges[i + 1], edges[i + 2]
+        else:
+            nlo, nhi = size - 1, size
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+# averages groups of columns so there are at most `n`, ignoring NaNs
+def bin_columns(values, n):
+    cols = values.shape[1]
+    if cols <= n:
+        return values, np.arange(cols)
+    starts = np.linspace(0, cols, n + 1).astype(int)[:-1]
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0), starts, axis=1)
+    counts = np.add.reduceat(present, starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan), starts
+
+# minutes from `end` for every row of `matrix`
+def minutes_before(matrix, end):
+    return (matrix.index.values - np.datetime64(end)) / np.timedelta64(1, 'm')
+
+def pick_mode(mode, matrix):
+    if mode != 'auto':
+        return mode
+    return 'lines' if matrix.shape[1] <= MAX_LINES else 'heatmap'
+
+
+class CpuPlot:
+    def __init__(self, mode='auto', minutes=60, max_points=500, output=None):
+        self.mode = mode
+        self.minutes = minutes
+        self.max_points = max_points
+        self.output = output
+        self.fig = None
+        self.instances = None
+        self.artists = []
+        self.background = None
+
+    @property
+    def live(self):
+        return self.output is None
+
+    # draws `matrix` (time x instance, see aws.cpu_matrix) ending at `end`,
+    # reusing the figure from the last call when the instances are the same
+    def update(self, matrix, end):
+        mode = pick_mode(self.mode, matrix)
+        if self.fig is None or list(matrix.columns) != self.instances or mode != self.drawn_mode:
+            self._build(matrix, mode)
+        getattr(self, '_update_' + mode)(matrix, end)
+        self.title.set_text("CPU of {} instances, {} to {:%Y-%m-%d %H:%M} UTC".format(
+            matrix.shape[1], format_window(self.minutes), end))
+
+        if not self.live:
+            self.fig.savefig(self.output, bbox_inches='tight')
+        else:
+            self._blit()
+
+    # keeps a live window responsive for `seconds`, stops --watch once it's closed
+    def wait(self, seconds):
+        import matplotlib.pyplot as plt
+        if not plt.fignum_exists(self.fig.number):
+            raise KeyboardInterrupt
+        self.fig.canvas.start_event_loop(seconds)
+
+    def _build(self, matrix, mode):
+        if self.live:
+            import matplotlib.pyplot as plt
+            if self.fig is not None:
+                plt.close(self.fig)
+            self.fig = plt.figure(figsize=(12, 6))
+        else:
+            from matplotlib.figure import Figure
+            self.fig = Figure(figsize=(12, 6))
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.ax.set_xlim(-self.minutes, 0)
+        self.ax.set_xlabel("minutes ago")
+        self.title = self.ax.set_title("")
+        self.instances = list(matrix.columns)
+        self.drawn_mode = mode
+        self.artists = [self.title]
+        getattr(self, '_build_' + mode)(matrix)
+        self.ax.set_autoscale_on(False)
+
+        if self.live:
+            import matplotlib.pyplot as plt
+            # animated artists are left out of full redraws and blitted on top
+            for artist in self.artists:
+                artist.set_animated(True)
+            self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+            plt.show(block=False)
+            self.fig.canvas.draw()
+
+    def _on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+
+    def _blit(self):
+        canvas = self.fig.canvas
+        if self.background is None:
+            canvas.draw()
+        canvas.restore_region(self.background)
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+    def _build_lines(self, matrix):
+        self.lines = []
+        for iid in matrix.columns:
+            line, = self.ax.plot([], [], linestyle='-', label=iid)
+            self.lines.append(line)
+        self.artists += self.lines
+        self.ax.set_ylim(0, 100)
+        self.ax.set_ylabel("CPU %")
+        self.ax.grid()
+        if len(self.lines) <= MAX_LINES:
+            self.ax.legend(loc='upper left', fontsize='small')
+
+    def _update_lines(self, matrix, end):
+        x = minutes_before(matrix, end)
+        for line, iid in zip(self.lines, matrix.columns):
+            y = matrix[iid].values
+            present = ~np.isnan(y)
+            xs, ys = x[present], y[present]
+            keep = lttb(xs, ys, self.max_points)
+            line.set_data(xs[keep], ys[keep])
+            # markers only while single points can be told apart
+            line.set_marker('o' if len(keep) <= 100 else '')
+
+    def _build_bands(self, matrix):
+        self.fills = []
+        inner = len(PERCENTILES) // 2
+        for i in range(inner):
+            self.fills.append(self.ax.fill_between([], [], [], alpha=0.2 + 0.2 * i,
+                                                   color='tab:blue', linewidth=0))
+        self.median, = self.ax.plot([], [], color='tab:blue',
+                                    label='median, {}'.format(', '.join(
+                                        '{}-{}%'.format(PERCENTILES[i], PERCENTILES[-1 - i])
+                                        for i in range(inner))))
+        self.artists += self.fills + [self.median]
+        self.ax.set_ylim(0, 100)
+        self.ax.set_ylabel("CPU %")
+        self.ax.grid()
+        self.ax.legend(loc='upper left', fontsize='small')
+
+    def _update_bands(self, matrix, end):
+        x = minutes_before(matrix, end)
+        values = matrix.values
+        rows = ~np.isnan(values).all(axis=1)
+        x, values = x[rows], values[rows]
+        pct = np.nanpercentile(values, PERCENTILES, axis=1) if len(x) > 0 \
+            else np.empty((len(PERCENTILES), 0))
+        pct, starts = bin_columns(pct, self.max_points)
+        x = x[starts] if len(starts) > 0 else x
+
+        inner = len(PERCENTILES) // 2
+        # a filled polygon can't be moved, so each band is replaced
+        for i in range(inner):
+            old = self.fills[i]
+            self.fills[i] = self.ax.fill_between(x, pct[i], pct[-1 - i], alpha=old.get_alpha(),
+                                                 color='tab:blue', linewidth=0,
+                                                 animated=self.live)
+            self.artists[self.artists.index(old)] = self.fills[i]
+            old.remove()
+        self.median.set_data(x, pct[inner])
+
+    def _build_heatmap(self, matrix):
+        # idlest instances at the bottom, the order is kept while the instances don't change
+        order = np.argsort(-np.nan_to_num(matrix.mean().values))
+        self.rows = [matrix.columns[i] for i in order]
+        self.image = self.ax.imshow(np.full((len(order), 1), np.nan), aspect='auto',
+                                    interpolation='nearest', cmap='viridis',
+                                    vmin=0, vmax=100, origin='upper',
+                                    extent=[-self.minutes, 0, len(order), 0])
+        self.fig.colorbar(self.image, ax=self.ax, label="CPU %")
+        self.artists.append(self.image)
+        if len(order) <= MAX_LABELS:
+            self.ax.set_yticks(np.arange(len(order)) + 0.5)
+            self.ax.set_yticklabels(self.rows, fontsize='small')
+        else:
+            self.ax.set_ylabel("{} instances".format(len(order)))
+            self.ax.set_yticks([])
+
+    def _update_heatmap(self, matrix, end):
+        from pandas.tseries.frequencies import to_offset
+        if len(matrix) == 0:
+            return
+        # one column per period, gaps stay empty instead of stretching their neighbours
+        matrix = matrix[self.rows].resample(PERIOD).mean()
+        x = minutes_before(matrix, end)
+        values, starts = bin_columns(matrix.values.T, self.max_points)
+        width = to_offset(PERIOD).nanos / 60e9
+        self.image.set_data(np.ma.masked_invalid(values))
+        self.image.set_extent([x[0], x[-1] + width, len(self.rows), 0])
+
+
+def format_window(minutes):
+    if minutes % 60 == 0:
+        return "last {}h".format(minutes // 60)
+    return "last {}m".format(minutes)
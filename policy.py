@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Idle-instance policy for `cpu --drop`. Everything is evaluated at once over
+# the aligned time x instance CPU matrix: a rolling mean per instance, a
+# hysteresis check that it has stayed under the threshold, and the minimum age,
+# protected tags, cooldown and kill rate on top. Every instance gets a reason,
+# whether it's dropped or kept.
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from selector import Index, split_pair, parse_time
+
+PERIOD = pd.Timedelta(minutes=5)
+
+KILL = 'kill'
+KEEP = 'keep'
+
+
+class Policy:
+    def __init__(self, threshold=55.0, window=60, hysteresis=3, min_age=30,
+                 cooldown=10, max_kills_per_hour=10, protect=()):
+        self.threshold = threshold
+        # minutes
+        self.window = window
+        self.min_age = min_age
+        self.cooldown = cooldown
+        # number of consecutive windowed points that have to be under the threshold
+        self.hysteresis = hysteresis
+        self.max_kills_per_hour = max_kills_per_hour
+        self.protect = list(protect)
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(threshold=options.threshold, window=options.window,
+                   hysteresis=options.hysteresis, min_age=options.min_age,
+                   cooldown=options.cooldown, max_kills_per_hour=options.max_kill_rate,
+                   protect=options.protect)
+
+    def history_needed(self):
+        return pd.Timedelta(minutes=self.window) + PERIOD * (self.hysteresis + 1)
+
+    def min_points(self):
+        # at least half of the window has to have datapoints
+        return max(1, int(np.ceil(self.window / 5 / 2)))
+
+    # rolling means for the whole matrix, computed once and reused by replay
+    def windowed(self, matrix):
+        return matrix.rolling('{}min'.format(self.window),
+                              min_periods=self.min_points()).mean()
+
+    def sustained(self, windowed):
+        below = (windowed < self.threshold).astype(float)
+        below[windowed.isna()] = np.nan
+        return below.rolling(self.hysteresis, min_periods=self.hysteresis).sum() == self.hysteresis
+
+    def protected(self, instances, iids):
+        if len(self.protect) == 0:
+            return np.zeros(len(iids), dtype=bool)
+        index = Index({iid: instances[iid] for iid in iids if iid in instances})
+        hit = set()
+        for pair in self.protect:
+            hit |= index.tag_glob(*split_pair(pair))
+        return np.array([iid in hit for iid in iids])
+
+
+def launch_times(instances, matrix):
+    # instances we have no metadata for use their first datapoint instead
+    valid = matrix.notna().values
+    first = np.full(len(matrix.columns), np.datetime64('NaT'), dtype='datetime64[ns]')
+    if len(matrix) > 0:
+        has = valid.any(axis=0)
+        first[has] = matrix.index.values[valid.argmax(axis=0)[has]]
+
+    res = []
+    for i, iid in enumerate(matrix.columns):
+        inst = instances.get(iid, {})
+        if 'LaunchTime' in inst:
+            res.append(pd.Timestamp(parse_time(inst['LaunchTime']), unit='s'))
+        else:
+            res.append(first[i])
+    return pd.DatetimeIndex(res)
+
+# Decides what to do with every instance given its current windowed CPU and
+# whether that has been under the threshold long enough. `recent_kills` are
+# the times of earlier kills, used for cooldown and rate.
+def decide(policy, iids, current, below, launched, protected, now, recent_kills):
+    age = np.asarray((now - launched) / pd.Timedelta(minutes=1), dtype=float)
+    below = below.astype(bool)
+
+    no_data = np.isnan(current)
+    young = age < policy.min_age
+    candidate = below & ~no_data & ~young & ~protected
+
+    reasons = np.array(['{:.1f} >= {}'.format(c, policy.threshold) if c >= policy.threshold
+                        else 'under {} for < {} points'.format(policy.threshold, policy.hysteresis)
+                        for c in np.nan_to_num(current)], dtype=object)
+    reasons[young] = ['only {:.0f} min old'.format(a) for a in age[young]]
+    reasons[protected] = 'protected tag'
+    reasons[no_data] = 'not enough data in window'
+
+    decision = np.full(len(iids), KEEP, dtype=object)
+    kills = [t for t in recent_kills if now - t < pd.Timedelta(hours=1)]
+    last_kill = max(kills) if len(kills) > 0 else None
+
+    if candidate.any():
+        if last_kill is not None and now - last_kill < pd.Timedelta(minutes=policy.cooldown):
+            reasons[candidate] = 'idle, but in cooldown after a kill at {}'.format(last_kill)
+        else:
+            budget = max(0, policy.max_kills_per_hour - len(kills))
+            # the idlest instances go first
+            order = np.argsort(np.where(candidate, current, np.inf), kind='stable')
+            chosen = order[:min(budget, int(candidate.sum()))]
+            decision[chosen] = KILL
+            reasons[candidate] = 'idle, but over the limit of {} kills/hour'.format(
+                policy.max_kills_per_hour)
+            reasons[chosen] = ['{:.1f} < {} for {} points'.format(
+                current[i], policy.threshold, policy.hysteresis) for i in chosen]
+
+    return pd.DataFrame({'cpu': current, 'age': age, 'decision': decision,
+                         'reason': reasons}, index=iids)
+
+def prepare(policy, matrix, instances):
+    windowed = policy.windowed(matrix)
+    sustained = policy.sustained(windowed)
+    return (windowed.values, sustained.values, launch_times(instances, matrix),
+            policy.protected(instances, list(matrix.columns)))
+
+def evaluate(policy, matrix, instances, now, recent_kills=()):
+    windowed, sustained, launched, protected = prepare(policy, matrix, instances)
+    if len(matrix) == 0:
+        windowed = np.full((1, len(matrix.columns)), np.nan)
+        sustained = np.zeros((1, len(matrix.columns)), dtype=bool)
+    return decide(policy, matrix.columns, windowed[-1], sustained[-1], launched,
+                  protected, now, list(recent_kills))
+
+# Steps through stored history as if the policy had been running all along.
+# Killed instances drop out from then on.
+def replay(policy, matrix, instances):
+    windowed, sustained, launched, protected = prepare(policy, matrix, instances)
+
+    alive = np.ones(len(matrix.columns), dtype=bool)
+    kills = []
+    events = []
+    for row, now in enumerate(matrix.index):
+        cols = np.flatnonzero(alive)
+        if len(cols) == 0:
+            break
+        res = decide(policy, matrix.columns[cols], windowed[row, cols], sustained[row, cols],
+                     launched[cols], protected[cols], now, kills)
+        for iid, r in res[res['decision'] == KILL].iterrows():
+            events.append({'time': now, 'iid': iid, 'cpu': r['cpu'], 'reason': r['reason']})
+            kills.append(now)
+            alive[matrix.columns.get_loc(iid)] = False
+    return pd.DataFrame(events, columns=['time', 'iid', 'cpu', 'reason'])
+
+
+# kill times are remembered across runs for the cooldown and the rate limit
+def state_path(data_dir):
+    return Path(data_dir, 'policy-state.json')
+
+def load_kills(data_dir):
+    path = state_path(data_dir)
+    if not path.exists():
+        return []
+    with open(str(path)) as f:
+        return [pd.Timestamp(t) for t in json.load(f)['kills']]
+
+def save_kills(data_dir, kills, now):
+    kills = [t for t in kills if now - t < pd.Timedelta(hours=24)]
+    path = state_path(data_dir)
+    with open(str(path) + '.tmp', 'w') as f:
+        json.dump({'kills': [t.isoformat() for t in kills]}, f)
+    os.replace(str(path) + '.tmp', str(path))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Instance selection. An Index is built once per inventory (tags, state, type
+# and launch time) so every predicate is a few dict/set lookups instead of a
+# pass over all instances per name. `pushdown_filters` turns whatever
+# predicates EC2 can evaluate itself into describe-instances `Filters`.
+
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+
+GLOB_CHARS = '*?['
+
+
+def parse_tags(instance):
+    res = {}
+    if 'Tags' in instance:
+        for tag in instance['Tags']:
+            res[tag['Key']] = tag['Value']
+    return res
+
+def parse_time(s):
+    dt = datetime.fromisoformat(s.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+# accepts an ISO timestamp or an age like 30m, 6h or 2d
+def parse_bound(s):
+    units = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+    if s[-1] in units and s[:-1].isdigit():
+        delta = timedelta(**{units[s[-1]]: int(s[:-1])})
+        return (datetime.now(timezone.utc) - delta).timestamp()
+    return parse_time(s)
+
+def split_pair(s):
+    if '=' not in s:
+        raise ValueError("Expected KEY=PATTERN, got '{}'".format(s))
+    return s.split('=', 1)
+
+
+class Index:
+    def __init__(self, instances):
+        self.instances = instances
+        self.by_tag = defaultdict(lambda: defaultdict(set))
+        self.by_state = defaultdict(set)
+        self.by_type = defaultdict(set)
+        launches = []
+
+        for iid, inst in instances.items():
+            for k, v in parse_tags(inst).items():
+                self.by_tag[k][v].add(iid)
+            self.by_state[inst.get('State', {}).get('Name')].add(iid)
+            self.by_type[inst.get('InstanceType')].add(iid)
+            if 'LaunchTime' in inst:
+                launches.append((parse_time(inst['LaunchTime']), iid))
+
+        launches.sort()
+        self.launch_times = [t for t, _ in launches]
+        self.launch_iids = [iid for _, iid in launches]
+
+    def tag_glob(self, key, pattern):
+        values = self.by_tag.get(key, {})
+        if not any(c in pattern for c in GLOB_CHARS):
+            return set(values.get(pattern, ()))
+        res = set()
+        for v, iids in values.items():
+            if fnmatchcase(v, pattern):
+                res |= iids
+        return res
+
+    def tag_regex(self, key, regex):
+        r = re.compile(regex)
+        res = set()
+        for v, iids in self.by_tag.get(key, {}).items():
+            if r.search(v):
+                res |= iids
+        return res
+
+    def launched(self, after=None, before=None):
+        lo = 0 if after is None else bisect_left(self.launch_times, after)
+        hi = len(self.launch_times) if before is None else bisect_right(self.launch_times, before)
+        return set(self.launch_iids[lo:hi])
+
+    def any_of(self, table, values):
+        res = set()
+        for v in values:
+            res |= table.get(v, set())
+        return res
+
+
+_last_index = None
+
+def get_index(instances):
+    global _last_index
+    # the inventory cache hands back the same dict while it's fresh
+    if _last_index is None or _last_index.instances is not instances:
+        _last_index = Index(instances)
+    return _last_index
+
+def select(instances, options):
+    index = get_index(instances)
+    keep = None
+
+    def narrow(iids):
+        return iids if keep is None else keep & iids
+
+    # --iid and --nametag are a union that -i inverts, like before
+    if len(options.iid) > 0 or len(options.nametag) > 0:
+        named = set(iid for iid in options.iid if iid in instances)
+        for name in options.nametag:
+            named |= index.by_tag.get('Name', {}).get(name, set())
+        if options.inverse:
+            named = set(instances.keys()) - named
+        keep = named
+
+    for pair in options.tag:
+        keep = narrow(index.tag_glob(*split_pair(pair)))
+    for pair in options.tag_regex:
+        keep = narrow(index.tag_regex(*split_pair(pair)))
+    if len(options.instance_type) > 0:
+        keep = narrow(index.any_of(index.by_type, options.instance_type))
+    if len(options.in_state) > 0:
+        keep = narrow(index.any_of(index.by_state, options.in_state))
+    if options.launched_after is not None or options.launched_before is not None:
+        after = None if options.launched_after is None else parse_bound(options.launched_after)
+        before = None if options.launched_before is None else parse_bound(options.launched_before)
+        keep = narrow(index.launched(after, before))
+
+    if keep is None:
+        return instances
+    return {iid: data for iid, data in instances.items() if iid in keep}
+
+def pushdown_filters(options):
+    filters = []
+
+    # the union of --iid and --nametag can't be expressed as filters, which are ANDed
+    if not options.inverse:
+        if len(options.iid) > 0 and len(options.nametag) == 0:
+            filters.append({'Name': 'instance-id', 'Values': list(options.iid)})
+        elif len(options.nametag) > 0 and len(options.iid) == 0:
+            filters.append({'Name': 'tag:Name', 'Values': list(options.nametag)})
+
+    # EC2 understands * and ? but not [...]
+    pushed = set()
+    for pair in options.tag:
+        k, v = split_pair(pair)
+        if '[' not in v and k not in pushed:
+            filters.append({'Name': 'tag:{}'.format(k), 'Values': [v]})
+            pushed.add(k)
+    if len(options.instance_type) > 0:
+        filters.append({'Name': 'instance-type', 'Values': list(options.instance_type)})
+    if len(options.in_state) > 0:
+        filters.append({'Name': 'instance-state-name', 'Values': list(options.in_state)})
+
+    return filters
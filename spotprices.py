@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Spot price history for the overrides in a fleet config, kept in a
+# SeriesStore under `<data-dir>/spot-prices` with one key per type and AZ
+# (`c4.large@us-west-1a`). Each update only asks for points after the newest
+# one already stored. Prices are summarised per unit of WeightedCapacity, and
+# the interruption-adjusted cost adds the work lost to interruptions at an
+# hourly rate per type.
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import backend
+from tsstore import SeriesStore
+
+PRODUCT = 'Linux/UNIX'
+
+# interruptions per instance-hour when nothing better is known
+DEFAULT_RATE = 0.05
+
+
+def series_key(instance_type, zone):
+    return '{}@{}'.format(instance_type, zone)
+
+def open_store(data_dir):
+    return SeriesStore(Path(data_dir, 'spot-prices'))
+
+def subnet_zones(region, subnets):
+    output = backend.call('ec2', 'describe_subnets', region, SubnetIds=sorted(subnets))
+    return {s['SubnetId']: s['AvailabilityZone'] for s in output['Subnets']}
+
+# every override in the fleet config with its AZ and weight
+def overrides(config, region):
+    res = []
+    for i, ltc in enumerate(config.get('LaunchTemplateConfigs', [])):
+        for o in ltc.get('Overrides', []):
+            res.append((i, o))
+
+    zones = subnet_zones(region, set(o['SubnetId'] for _, o in res if 'SubnetId' in o))
+    rows = []
+    for i, o in res:
+        zone = o.get('AvailabilityZone', zones.get(o.get('SubnetId')))
+        rows.append({'config': i, 'type': o['InstanceType'], 'zone': zone,
+                     'weight': float(o.get('WeightedCapacity', 1)), 'override': o})
+    return pd.DataFrame(rows, columns=['config', 'type', 'zone', 'weight', 'override'])
+
+def fetch(region, types, zones, start, product=PRODUCT):
+    params = {'InstanceTypes': sorted(types),
+              'ProductDescriptions': [product],
+              'Filters': [{'Name': 'availability-zone', 'Values': sorted(zones)}],
+              'StartTime': start}
+    res = {}
+    for page in backend.paginate('ec2', 'describe_spot_price_history', region, **params):
+        for p in page['SpotPriceHistory']:
+            key = series_key(p['InstanceType'], p['AvailabilityZone'])
+            res.setdefault(key, []).append((p['Timestamp'], float(p['SpotPrice'])))
+    return res
+
+# Fetches whatever is newer than the store for the (type, zone) pairs in
+# `wanted`. Pairs that are already up to date share a request with the others
+# per starting point, so a rerun usually makes one call.
+def update(store, region, wanted, days, product=PRODUCT, now=None):
+    now = datetime.utcnow() if now is None else now
+    oldest = now - timedelta(days=days)
+
+    starts = {}
+    for instance_type, zone in wanted:
+        last = store.last_time(series_key(instance_type, zone))
+        start = oldest if last is None else max(oldest, last)
+        starts.setdefault(start, set()).add((instance_type, zone))
+
+    def get(item):
+        start, pairs = item
+        return fetch(region, set(t for t, _ in pairs), set(z for _, z in pairs), start, product)
+
+    added = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(len(starts), 8))) as pool:
+        for points in pool.map(get, starts.items()):
+            for key, pts in points.items():
+                times = pd.to_datetime([t for t, _ in pts], utc=True).tz_localize(None)
+                added += store.append(key, times.values, [v for _, v in pts])
+    store.commit()
+    return added
+
+# mean and percentile of a step function, each price weighted by how long it held
+def time_weighted(times, prices, start, end):
+    if len(times) == 0:
+        return np.nan, np.nan, np.nan
+    order = np.argsort(times, kind='stable')
+    times = np.asarray(times)[order].astype('datetime64[s]').astype(np.int64)
+    prices = np.asarray(prices)[order]
+    start = np.datetime64(start, 's').astype(np.int64)
+    end = np.datetime64(end, 's').astype(np.int64)
+
+    # the price at `start` is the last one set before it
+    first = max(0, np.searchsorted(times, start, side='right') - 1)
+    times, prices = np.maximum(times[first:], start), prices[first:]
+    held = np.diff(np.append(times, max(end, times[-1])))
+    if held.sum() == 0:
+        return prices[-1], prices[-1], prices[-1]
+
+    mean = np.average(prices, weights=held)
+    by_price = np.argsort(prices)
+    cum = np.cumsum(held[by_price]) / held.sum()
+    p95 = prices[by_price][np.searchsorted(cum, 0.95)]
+    return prices[-1], mean, p95
+
+# `rates` are interruptions per instance-hour by type, and every interruption
+# costs `restart_hours` of the instance's work
+def summarize(store, table, days, rates=None, restart_hours=0.5, now=None):
+    now = datetime.utcnow() if now is None else now
+    start = now - timedelta(days=days)
+    rates = rates or {}
+
+    current, mean, p95 = [], [], []
+    for instance_type, zone in zip(table['type'], table['zone']):
+        times, prices = store.read(series_key(instance_type, zone))
+        c, m, p = time_weighted(times, prices, start, now)
+        current.append(c)
+        mean.append(m)
+        p95.append(p)
+
+    res = table.drop(columns=['override']).copy()
+    res['current'] = current
+    res['mean'] = mean
+    res['p95'] = p95
+    res['per_unit'] = res['mean'] / res['weight']
+    res['rate'] = [rates.get(t, DEFAULT_RATE) for t in res['type']]
+    res['adjusted'] = res['per_unit'] * (1 + res['rate'] * restart_hours)
+    return res.sort_values('adjusted', na_position='last')
+
+# Keeps the `top` overrides that are cheapest per adjusted unit in each launch
+# template config. The bid is per unit-hour, like a weighted fleet's SpotPrice,
+# and covers the 95th percentile of every kept override plus `margin`.
+def optimize(config, table, summary, top, margin=0.2):
+    config = dict(config)
+    ltcs = [dict(ltc) for ltc in config.get('LaunchTemplateConfigs', [])]
+    ranked = summary.dropna(subset=['adjusted'])
+
+    kept = []
+    for i, ltc in enumerate(ltcs):
+        rows = ranked[ranked['config'] == i].head(top)
+        ltc['Overrides'] = [table.loc[j, 'override'] for j in rows.index]
+        kept.append(rows)
+    config['LaunchTemplateConfigs'] = ltcs
+
+    kept = pd.concat(kept) if len(kept) > 0 else ranked.head(0)
+    if len(kept) > 0:
+        bid = (kept['p95'] / kept['weight']).max() * (1 + margin)
+        config['SpotPrice'] = '{:.4f}'.format(bid)
+    return config
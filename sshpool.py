@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Pool of open SSH connections keyed by IP so several commands (or SFTP
+# sessions) against the same host share one handshake. Safe to use from a
+# thread pool: each host is only ever connected once.
+
+import threading
+from pathlib import Path
+
+from paramiko import RSAKey, SSHClient, AutoAddPolicy
+
+import tracing
+
+USERNAME = 'ubuntu'
+
+print_lock = threading.Lock()
+
+
+def emit(prefix, line):
+    with print_lock:
+        print("{} {}".format(prefix, line), flush=True)
+
+
+class SSHPool:
+    def __init__(self, keyfile, username=USERNAME, port=22, timeout=15):
+        self.key = RSAKey.from_private_key_file(str(Path(keyfile).expanduser()))
+        self.username = username
+        self.port = port
+        self.timeout = timeout
+        self.clients = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def _host_lock(self, ip):
+        with self.lock:
+            return self.locks.setdefault(ip, threading.Lock())
+
+    def client(self, ip):
+        with self._host_lock(ip):
+            c = self.clients.get(ip)
+            if c is not None and c.get_transport() is not None \
+               and c.get_transport().is_active():
+                return c
+
+            c = SSHClient()
+            c.set_missing_host_key_policy(AutoAddPolicy())
+            with tracing.span('connect', 'ssh', host=ip):
+                c.connect(hostname=ip, port=self.port, username=self.username,
+                          pkey=self.key, timeout=self.timeout,
+                          allow_agent=False, look_for_keys=False)
+            c.get_transport().set_keepalive(30)
+            self.clients[ip] = c
+            return c
+
+    def transport(self, ip):
+        return self.client(ip).get_transport()
+
+    def sftp(self, ip):
+        return self.client(ip).open_sftp()
+
+    # runs `cmd` and streams its output line by line through `on_line`
+    def run(self, ip, cmd, on_line=None):
+        with tracing.span('run', 'ssh', host=ip, cmd=cmd[:80]) as stats:
+            chan = self.transport(ip).open_session()
+            chan.set_combine_stderr(True)
+            chan.exec_command(cmd)
+            output = chan.makefile('r')
+            lines = 0
+            for line in output:
+                lines += 1
+                if on_line is not None:
+                    on_line(line.rstrip('\n'))
+            status = chan.recv_exit_status()
+            chan.close()
+            stats['items'] = lines
+            stats['status'] = status
+            return status
+
+    def close(self, ip=None):
+        with self.lock:
+            ips = list(self.clients.keys()) if ip is None else [ip]
+            for i in ips:
+                c = self.clients.pop(i, None)
+                if c is not None:
+                    c.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Optional tracing for the command line tools. With `--trace FILE` every AWS
+# call, SSH/SFTP operation, cache read/write and merge chunk records a span
+# (name, category, start, duration and whatever counters the caller sets:
+# bytes, items, retries, ...). At exit the spans are written as a Chrome trace
+# (`.json`, open it in chrome://tracing or Perfetto) or one span per line
+# (anything else), and the biggest time sinks are printed.
+#
+#   with tracing.span('describe_instances', 'aws', region=region) as s:
+#       ...
+#       s['items'] = len(instances)
+#
+# When tracing is off `span` hands back one shared do-nothing context manager,
+# so an instrumented call costs a function call and a global lookup.
+
+import atexit
+import json
+import os
+import threading
+from time import perf_counter
+
+enabled = False
+path = None
+
+_spans = []
+_lock = threading.Lock()
+_t0 = perf_counter()
+
+# counters set on the shared dict when tracing is off go nowhere
+_scratch = {}
+
+
+class _Off:
+    def __enter__(self):
+        return _scratch
+
+    def __exit__(self, *exc):
+        return False
+
+_OFF = _Off()
+
+
+class Span:
+    __slots__ = ('name', 'cat', 'args', 'start')
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self.args
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        add(self.name, self.cat, self.start, perf_counter() - self.start, **self.args)
+        return False
+
+
+def span(name, cat='', **args):
+    if not enabled:
+        return _OFF
+    return Span(name, cat, args)
+
+# for spans timed somewhere else, like a worker process (perf_counter is the
+# same clock across processes on one machine)
+def add(name, cat, start, duration, pid=None, tid=None, **args):
+    record = {'name': name, 'cat': cat, 'start': start, 'dur': duration,
+              'pid': os.getpid() if pid is None else pid,
+              'tid': threading.get_ident() if tid is None else tid,
+              'args': args}
+    with _lock:
+        _spans.append(record)
+
+def start(trace_path):
+    global enabled, path
+    enabled = True
+    path = trace_path
+    atexit.register(finish)
+
+def write(trace_path):
+    with _lock:
+        spans = list(_spans)
+    with open(trace_path, 'w') as f:
+        if trace_path.endswith('.json'):
+            events = [{'name': s['name'], 'cat': s['cat'], 'ph': 'X',
+                       'ts': (s['start'] - _t0) * 1e6, 'dur': s['dur'] * 1e6,
+                       'pid': s['pid'], 'tid': s['tid'], 'args': s['args']}
+                      for s in spans]
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        else:
+            for s in spans:
+                f.write(json.dumps({'name': s['name'], 'cat': s['cat'],
+                                    'ts': round(s['start'] - _t0, 6), 'dur': round(s['dur'], 6),
+                                    'pid': s['pid'], 'tid': s['tid'], **s['args']},
+                                   default=str) + '\n')
+
+# total time, count and counters per (category, name), largest total first
+def summary():
+    res = {}
+    with _lock:
+        spans = list(_spans)
+    for s in spans:
+        key = (s['cat'], s['name'])
+        agg = res.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0,
+                                   'bytes': 0, 'items': 0, 'retries': 0, 'errors': 0})
+        agg['count'] += 1
+        agg['total'] += s['dur']
+        agg['max'] = max(agg['max'], s['dur'])
+        for counter in ('bytes', 'items', 'retries'):
+            value = s['args'].get(counter)
+            if isinstance(value, (int, float)):
+                agg[counter] += value
+        if 'error' in s['args']:
+            agg['errors'] += 1
+    return sorted(res.items(), key=lambda kv: kv[1]['total'], reverse=True)
+
+def report(top=15):
+    rows = summary()
+    if len(rows) == 0:
+        return
+    print("Top time sinks ({} spans):".format(sum(r['count'] for _, r in rows)))
+    print("{:<10} {:<32} {:>7} {:>10} {:>10} {:>10} {:>12} {:>9} {:>8}".format(
+        'category', 'span', 'count', 'total (s)', 'mean (ms)', 'max (ms)', 'bytes', 'items', 'retries'))
+    for (cat, name), r in rows[:top]:
+        print("{:<10} {:<32} {:>7} {:>10.3f} {:>10.1f} {:>10.1f} {:>12} {:>9} {:>8}".format(
+            cat, name[:32], r['count'], r['total'], 1000 * r['total'] / r['count'],
+            1000 * r['max'], r['bytes'], r['items'], r['retries']))
+
+def finish():
+    global enabled
+    if not enabled:
+        return
+    enabled = False
+    write(path)
+    report()
+    print("Wrote trace to {}".format(path))
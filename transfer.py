@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# File distribution over pooled SSH connections. Uploads and downloads go
+# through a `.part` file so an interrupted transfer picks up where it stopped
+# (once the bytes already there hash the same as the start of the source),
+# and files whose size and sha256 already match on the other side are skipped.
+
+import hashlib
+import os
+import shlex
+import stat
+import tarfile
+import threading
+from time import perf_counter
+from pathlib import Path, PurePosixPath
+from urllib.parse import quote
+
+import tracing
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK = 1 << 20
+
+_hashes = {}
+_hash_lock = threading.Lock()
+
+
+def sha256_file(path):
+    st = os.stat(path)
+    key = (str(path), st.st_size, st.st_mtime)
+    with _hash_lock:
+        if key in _hashes:
+            return _hashes[key]
+    h = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''):
+            h.update(block)
+    with _hash_lock:
+        _hashes[key] = h.hexdigest()
+    return _hashes[key]
+
+# sha256 of the first `length` bytes of a local file
+def sha256_prefix(path, length):
+    h = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        while length > 0:
+            block = f.read(min(CHUNK, length))
+            if not block:
+                break
+            h.update(block)
+            length -= len(block)
+    return h.hexdigest()
+
+# with `length`, only the first `length` bytes are hashed
+def remote_sha256(pool, ip, path, length=None):
+    lines = []
+    if length is None:
+        cmd = 'sha256sum -- {}'.format(shlex.quote(str(path)))
+    else:
+        cmd = 'head -c {} -- {} | sha256sum'.format(length, shlex.quote(str(path)))
+    status = pool.run(ip, cmd, lines.append)
+    if status != 0 or len(lines) == 0:
+        return None
+    return lines[0].split()[0]
+
+def remote_size(sftp, path):
+    try:
+        return sftp.stat(str(path)).st_size
+    except IOError:
+        return None
+
+def remote_makedirs(sftp, path):
+    parts = PurePosixPath(path).parts
+    for i in range(1, len(parts) + 1):
+        d = str(PurePosixPath(*parts[:i]))
+        if remote_size(sftp, d) is None:
+            sftp.mkdir(d)
+
+# (local path, path relative to the pushed root) for everything under `path`
+def local_files(path, recursive):
+    path = Path(path)
+    if path.is_dir():
+        if not recursive:
+            raise ValueError("{} is a directory, use -r".format(path))
+        return [(p, PurePosixPath(path.name, *p.relative_to(path).parts))
+                for p in sorted(path.rglob('*')) if p.is_file()]
+    return [(path, PurePosixPath(path.name))]
+
+def remote_files(sftp, path, recursive):
+    path = PurePosixPath(path)
+    attr = sftp.stat(str(path))
+    if not stat.S_ISDIR(attr.st_mode):
+        return [(path, PurePosixPath(path.name))]
+    if not recursive:
+        raise ValueError("{} is a directory, use -r".format(path))
+
+    res = []
+    todo = [path]
+    while todo:
+        d = todo.pop()
+        for entry in sftp.listdir_attr(str(d)):
+            p = d / entry.filename
+            if stat.S_ISDIR(entry.st_mode):
+                todo.append(p)
+            else:
+                res.append((p, PurePosixPath(path.name, *p.relative_to(path).parts)))
+    return sorted(res)
+
+# returns the number of bytes actually sent, 0 if the file was already there
+def upload(pool, ip, local, remote, on_progress=None):
+    with tracing.span('upload', 'sftp', host=ip, path=str(remote)) as stats:
+        stats['bytes'] = sent = _upload(pool, ip, local, remote, on_progress)
+        return sent
+
+def _upload(pool, ip, local, remote, on_progress):
+    size = os.path.getsize(str(local))
+    sftp = pool.sftp(ip)
+    try:
+        if remote_size(sftp, remote) == size \
+           and remote_sha256(pool, ip, remote) == sha256_file(local):
+            return 0
+
+        parent = str(PurePosixPath(remote).parent)
+        if parent != '.':
+            remote_makedirs(sftp, parent)
+
+        part = '{}.part'.format(remote)
+        offset = remote_size(sftp, part) or 0
+        # a .part that isn't a prefix of this file is started over
+        if offset > size or (offset > 0 and remote_sha256(pool, ip, part, offset)
+                             != sha256_prefix(local, offset)):
+            offset = 0
+        with open(str(local), 'rb') as src, \
+             sftp.open(part, 'ab' if offset > 0 else 'wb') as dst:
+            dst.set_pipelined(True)
+            src.seek(offset)
+            for block in iter(lambda: src.read(CHUNK), b''):
+                dst.write(block)
+                if on_progress is not None:
+                    on_progress(len(block))
+        sftp.posix_rename(part, str(remote))
+        return size - offset
+    finally:
+        sftp.close()
+
+def download(pool, ip, remote, local, on_progress=None):
+    with tracing.span('download', 'sftp', host=ip, path=str(remote)) as stats:
+        stats['bytes'] = received = _download(pool, ip, remote, local, on_progress)
+        return received
+
+def _download(pool, ip, remote, local, on_progress):
+    local = Path(local)
+    sftp = pool.sftp(ip)
+    try:
+        size = sftp.stat(str(remote)).st_size
+        if local.exists() and local.stat().st_size == size \
+           and remote_sha256(pool, ip, remote) == sha256_file(local):
+            return 0
+
+        local.parent.mkdir(parents=True, exist_ok=True)
+        part = Path('{}.part'.format(local))
+        offset = part.stat().st_size if part.exists() else 0
+        if offset > size or (offset > 0 and remote_sha256(pool, ip, remote, offset)
+                             != sha256_prefix(part, offset)):
+            offset = 0
+        with sftp.open(str(remote), 'rb') as src, \
+             open(str(part), 'ab' if offset > 0 else 'wb') as dst:
+            src.seek(offset)
+            src.prefetch(size - offset)
+            for block in iter(lambda: src.read(CHUNK), b''):
+                dst.write(block)
+                if on_progress is not None:
+                    on_progress(len(block))
+        os.replace(str(part), str(local))
+        return size - offset
+    finally:
+        sftp.close()
+
+# has `ip` fetch `remote` over http from a seeded peer, resuming with wget -c
+def relay(pool, ip, seed_ip, port, remote, size):
+    quoted = shlex.quote(str(remote))
+    parent = shlex.quote(str(PurePosixPath(remote).parent))
+    part = shlex.quote('{}.part'.format(remote))
+    url = shlex.quote('http://{}:{}/{}'.format(seed_ip, port, quote(str(remote))))
+    cmd = ("mkdir -p {parent} && "
+           "wget -q -c --retry-connrefused --tries=5 -O {part} {url} && "
+           "[ $(stat -c %s {part}) -eq {size} ] && mv {part} {remote}").format(
+               remote=quoted, parent=parent, part=part, url=url, size=size)
+    return pool.run(ip, cmd)
+
+def staging_dir(port):
+    return '.relay-{}'.format(port)
+
+# Serves only `remotes` (paths relative to the home directory), hard linked
+# into a staging directory, on the private address `bind_ip`. Returns once the
+# server accepts connections, non-zero if it never came up.
+def serve(pool, ip, bind_ip, port, remotes):
+    stage = staging_dir(port)
+    links = " && ".join(
+        "mkdir -p {parent} && ln -f {r} {link}".format(
+            r=shlex.quote(str(r)), link=shlex.quote(str(PurePosixPath(stage, r))),
+            parent=shlex.quote(str(PurePosixPath(stage, r).parent))) for r in remotes)
+    wait = ("import socket, time\n"
+            "for _ in range(100):\n"
+            "    try:\n"
+            "        socket.create_connection(({!r}, {}), 1).close()\n"
+            "        break\n"
+            "    except OSError:\n"
+            "        time.sleep(0.1)\n"
+            "else:\n"
+            "    raise SystemExit(1)\n").format(bind_ip, port)
+    cmd = ("rm -rf {stage} && mkdir -p {stage} && {links} && "
+           "(nohup python3 -m http.server {port} --bind {bind} --directory {stage} "
+           "> /dev/null 2>&1 &) && python3 -c {wait}").format(
+               stage=stage, links=links, port=port, bind=shlex.quote(bind_ip),
+               wait=shlex.quote(wait))
+    return pool.run(ip, cmd)
+
+def stop_serving(pool, ip, port):
+    # the brackets stop pkill from matching the shell running it
+    return pool.run(ip, "pkill -f '[h]ttp.server {}' ; rm -rf {}".format(
+        port, staging_dir(port)))
+
+
+# file-like sink that pushes everything written to it down an SSH channel
+class ChannelWriter:
+    def __init__(self, chan, on_progress=None):
+        self.chan = chan
+        self.on_progress = on_progress
+        self.bytes = 0
+
+    def write(self, data):
+        self.chan.sendall(data)
+        self.bytes += len(data)
+        if self.on_progress is not None:
+            self.on_progress(len(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+UNPACK = {
+    'none': 'tar -x -f -',
+    'gz': 'tar -xz -f -',
+    'zst': 'zstd -dc | tar -x -f -',
+}
+
+# Tars `local_dir` on the fly into a remote `tar -x` running in `remote_dir`.
+# Nothing is written to disk on either side and packing, sending and
+# unpacking all overlap. Returns (exit status, raw bytes, sent bytes, seconds).
+def stream_dir(transport, local_dir, remote_dir='.', compression='gz', on_progress=None):
+    if compression == 'zst' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+
+    with tracing.span('stream_dir', 'ssh', path=str(local_dir), compression=compression) as stats:
+        res = _stream_dir(transport, local_dir, remote_dir, compression, on_progress)
+        stats['bytes'] = res[2]
+        stats['status'] = res[0]
+        return res
+
+def _stream_dir(transport, local_dir, remote_dir, compression, on_progress):
+    local_dir = Path(local_dir)
+    raw = sum(p.stat().st_size for p in local_dir.rglob('*') if p.is_file())
+
+    chan = transport.open_session()
+    chan.set_combine_stderr(True)
+    chan.exec_command("mkdir -p {0} && cd {0} && {1}".format(
+        shlex.quote(str(remote_dir)), UNPACK[compression]))
+
+    start = perf_counter()
+    sink = ChannelWriter(chan, on_progress)
+    if compression == 'zst':
+        compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+        with compressor.stream_writer(sink, closefd=False) as zsink:
+            with tarfile.open(fileobj=zsink, mode='w|') as tar:
+                tar.add(str(local_dir), arcname=local_dir.name)
+    else:
+        mode = 'w|gz' if compression == 'gz' else 'w|'
+        with tarfile.open(fileobj=sink, mode=mode) as tar:
+            tar.add(str(local_dir), arcname=local_dir.name)
+    chan.shutdown_write()
+
+    output = chan.makefile('r').read().strip()
+    status = chan.recv_exit_status()
+    chan.close()
+    if status != 0 and output:
+        print(output)
+    return status, raw, sink.bytes, perf_counter() - start
+
+
+class Meter:
+    def __init__(self):
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.bytes += n
+
+def format_rate(nbytes, seconds):
+    mb = nbytes / float(1 << 20)
+    return "{:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(mb, seconds, mb / max(seconds, 1e-9))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# Append-only time-series store. Every key (instance id, instance type, ...)
+# owns a list of segments inside one flat file of (time, value) records, so an
+# append only writes the new points and a range read only touches the segments
+# that overlap the range. `compact` rewrites the file so each key has a single
+# sorted segment again.
+#
+#   <path>/points.dat    - packed records, see RECORD
+#   <path>/index.json    - {"size": n, "data": file, "keys": {key: [[offset, count, tmin, tmax], ...]}}
+#
+# Compaction writes a new points-<generation>.dat next to the old file and
+# switches over by committing an index that names it, so a crash at any point
+# leaves an index and a data file that belong together. Data files the index
+# doesn't name are left over from such a crash and go with the next compaction.
+#
+# Several processes can have the store open (`serve`, a dashboard and a
+# standalone run). Writes take an exclusive flock on <path>/lock from the first
+# append until the commit, and reload the index first, so every writer appends
+# at the real end of the file and commits on top of the others' segments.
+
+import fcntl
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+import tracing
+
+RECORD = np.dtype([('t', '<i8'), ('v', '<f8')])
+
+# rewrite the store once keys average more segments than this
+MAX_SEGMENTS = 32
+
+
+def to_epoch(times):
+    return np.asarray(times).astype('datetime64[s]').astype('<i8')
+
+def from_epoch(times):
+    return np.asarray(times, dtype='<i8').astype('datetime64[s]')
+
+
+class SeriesStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path / 'index.json'
+        self.lock_path = self.path / 'lock'
+        # open while this process holds the write lock
+        self._lock_file = None
+        self._lock()
+        self._unlock()
+
+    # takes the write lock and reloads what other processes committed
+    def _lock(self):
+        if self._lock_file is not None:
+            return
+        self._lock_file = open(str(self.lock_path), 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._load()
+
+    def _unlock(self):
+        if self._lock_file is None:
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+
+    def _load(self):
+        self.size = 0
+        self.index = {}
+        data = 'points.dat'
+        if self.index_path.exists():
+            with open(str(self.index_path)) as f:
+                saved = json.load(f)
+            self.size = saved['size']
+            self.index = saved['keys']
+            data = saved.get('data', data)
+        self.data_path = self.path / data
+
+        # drop anything written after the last commit, nobody else is writing
+        if self.data_path.exists():
+            if os.path.getsize(str(self.data_path)) > self.size * RECORD.itemsize:
+                os.truncate(str(self.data_path), self.size * RECORD.itemsize)
+        else:
+            self.data_path.touch()
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def last_time(self, key):
+        segments = self.index.get(key)
+        if not segments:
+            return None
+        return from_epoch(max(s[3] for s in segments)).item()
+
+    # Appends are only visible to other processes once committed, and the
+    # store stays locked for writing until then.
+    def append(self, key, times, values):
+        self._lock()
+        times, first = np.unique(to_epoch(times), return_index=True)
+        values = np.asarray(values, dtype='<f8')[first]
+
+        # the store is append-only, points at or before the last one are dropped
+        segments = self.index.get(key, [])
+        if segments:
+            keep = times > max(s[3] for s in segments)
+            times, values = times[keep], values[keep]
+        if len(times) == 0:
+            return 0
+
+        records = np.empty(len(times), dtype=RECORD)
+        records['t'] = times
+        records['v'] = values
+        with open(str(self.data_path), 'ab') as f:
+            offset = f.seek(0, os.SEEK_END) // RECORD.itemsize
+            f.write(records.tobytes())
+
+        segments.append([offset, len(records), int(times[0]), int(times[-1])])
+        self.index[key] = segments
+        self.size = offset + len(records)
+        return len(records)
+
+    # makes the appends so far durable and visible, and releases the write lock
+    def commit(self):
+        if self._lock_file is None:
+            # nothing appended, and the index may be behind another writer's
+            return
+        try:
+            self._write_index()
+        finally:
+            self._unlock()
+
+    def _write_index(self):
+        tmp = self.index_path.with_suffix('.tmp')
+        with tracing.span('commit', 'store', path=str(self.path)) as stats:
+            # the points have to be on disk before an index that covers them
+            fd = os.open(str(self.data_path), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with open(str(tmp), 'w') as f:
+                json.dump({'size': self.size, 'data': self.data_path.name,
+                           'keys': self.index}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(str(tmp), str(self.index_path))
+            stats['items'] = self.size
+
+    def _points(self):
+        if self.size == 0:
+            return np.empty(0, dtype=RECORD)
+        return np.memmap(str(self.data_path), dtype=RECORD, mode='r',
+                         shape=(self.size,))
+
+    def read(self, key, start=None, end=None):
+        lo = None if start is None else int(to_epoch(start))
+        hi = None if end is None else int(to_epoch(end))
+
+        points = self._points()
+        parts = []
+        for offset, count, tmin, tmax in self.index.get(key, []):
+            if (lo is not None and tmax < lo) or (hi is not None and tmin > hi):
+                continue
+            seg = points[offset:offset+count]
+            if lo is not None:
+                seg = seg[seg['t'] >= lo]
+            if hi is not None:
+                seg = seg[seg['t'] <= hi]
+            parts.append(np.array(seg))
+
+        if len(parts) == 0:
+            return from_epoch([]), np.empty(0)
+        res = np.concatenate(parts)
+        return from_epoch(res['t']), res['v']
+
+    def fragmented(self):
+        if len(self.index) == 0:
+            return False
+        segments = sum(len(s) for s in self.index.values())
+        return segments / len(self.index) > MAX_SEGMENTS
+
+    def compact(self):
+        self._lock()
+        try:
+            with tracing.span('compact', 'store', path=str(self.path)) as stats:
+                self._compact()
+                stats['items'] = self.size
+        finally:
+            self._unlock()
+
+    def _compact(self):
+        points = self._points()
+        generation = int(self.data_path.stem.partition('-')[2] or 0) + 1
+        new_path = self.path / 'points-{}.dat'.format(generation)
+        index = {}
+        size = 0
+        with open(str(new_path), 'wb') as f:
+            for key, segments in self.index.items():
+                if not segments:
+                    continue
+                recs = np.concatenate([points[o:o+c] for o, c, _, _ in segments])
+                recs = recs[np.argsort(recs['t'], kind='stable')]
+                recs = recs[np.concatenate(([True], recs['t'][1:] != recs['t'][:-1]))]
+                f.write(recs.tobytes())
+                index[key] = [[size, len(recs), int(recs['t'][0]), int(recs['t'][-1])]]
+                size += len(recs)
+            # on disk before the index that points at it
+            f.flush()
+            os.fsync(f.fileno())
+        del points
+
+        self.data_path = new_path
+        self.index = index
+        self.size = size
+        self._write_index()
+        for old in self.path.glob('points*.dat'):
+            if old != self.data_path:
+                old.unlink()
+
+
+# one-time import of the old per-instance `{iid}.pkl` caches
+def migrate_pickles(store, data_dir):
+    pkls = sorted(Path(data_dir).glob('*.pkl'))
+    if len(pkls) == 0:
+        return 0
+
+    import pandas as pd
+
+    legacy = Path(data_dir, 'legacy')
+    legacy.mkdir(exist_ok=True)
+    for pkl in pkls:
+        data = pd.read_pickle(str(pkl))
+        if len(data) > 0:
+            store.append(pkl.stem, data.index.values, data[data.columns[0]].values)
+        store.commit()
+        os.replace(str(pkl), str(legacy / pkl.name))
+    return len(pkls)